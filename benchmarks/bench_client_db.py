@@ -0,0 +1,65 @@
+"""
+Бенчмарк записи списков при запуске клиента (database_load): замена списка известных пользователей
+и добавление контактов. Сравнивается прежняя запись по одному ORM-объекту, с проверкой count() и commit()
+на каждый контакт, и пакетная запись ClientDB.add_users/add_contacts одной транзакцией.
+Запуск из корня проекта: python benchmarks/bench_client_db.py [число пользователей ...]
+По умолчанию 10 000 и 100 000 пользователей.
+"""
+
+import os
+import sys
+from tempfile import TemporaryDirectory
+from time import perf_counter
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from sqlalchemy.orm import clear_mappers
+from client_DB import ClientDB
+
+# Контактов у пользователя при запуске
+CONTACTS = 200
+
+
+def load_by_row(database, users, contacts):
+    """Запись, как её выполнял database_load до пакетных методов"""
+    database.session.query(database.KnownUsers).delete()
+    for user in users:
+        database.session.add(database.KnownUsers(user))
+    database.session.commit()
+    for contact in contacts:
+        if not database.session.query(database.Contacts).filter_by(name=contact).count():
+            database.session.add(database.Contacts(contact))
+            database.session.commit()
+
+
+def load_bulk(database, users, contacts):
+    """Пакетная запись"""
+    database.add_users(users)
+    database.add_contacts(contacts)
+
+
+def measure(directory, load, users, contacts):
+    """Время загрузки списков в новую базу в секундах"""
+    database = ClientDB('bench', f'sqlite:///{directory}/{load.__name__}_{len(users)}.db3')
+    start = perf_counter()
+    load(database, users, contacts)
+    elapsed = perf_counter() - start
+    database.session.close()
+    database.database_engine.dispose()
+    clear_mappers()
+    return elapsed
+
+
+def main():
+    sizes = [int(arg) for arg in sys.argv[1:]] or [10000, 100000]
+    print(f'{"пользователей":<16}{"по одному, с":>14}{"пакетом, с":>14}{"ускорение":>12}')
+    with TemporaryDirectory() as directory:
+        for size in sizes:
+            users = [f'user_{i}' for i in range(size)]
+            contacts = users[:CONTACTS]
+            before = measure(directory, load_by_row, users, contacts)
+            after = measure(directory, load_bulk, users, contacts)
+            print(f'{size:<16}{before:>14.3f}{after:>14.3f}{before / after:>11.1f}x')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,95 @@
+"""
+Бенчмарк поиска по истории сообщений клиента на большой базе: редкое и частое слово, префикс,
+поиск в переписке с одним собеседником. Сравнивается перебор всей таблицы через LIKE
+и полнотекстовый индекс ClientDB.search_history (FTS5).
+Запуск из корня проекта: python benchmarks/bench_client_search.py [число сообщений] [повторов]
+По умолчанию 1 000 000 сообщений, подготовка базы занимает около минуты.
+"""
+
+import os
+import sys
+import sqlite3
+from random import Random
+from tempfile import TemporaryDirectory
+from time import perf_counter
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from sqlalchemy.orm import clear_mappers
+from client_DB import ClientDB
+
+# Словарь сообщений: слово с номером i встречается примерно в 1 / (i + 1) сообщений
+WORDS = [f'слово{i}' for i in range(5000)]
+# Собеседников у пользователя
+PEERS = 100
+# Слов в сообщении
+MESSAGE_WORDS = 8
+
+
+def fill(path, messages):
+    """Заполнение истории сообщениями; полнотекстовый индекс пополняют триггеры базы"""
+    ClientDB('bench', f'sqlite:///{path}').session.close()
+    clear_mappers()
+    random = Random(1)
+    weights = [1 / (i + 1) for i in range(len(WORDS))]
+    connection = sqlite3.connect(path)
+    connection.executemany(
+        'INSERT INTO message_history (from_user, to_user, message, date) VALUES (?, ?, ?, CURRENT_TIMESTAMP)',
+        ((f'user_{i % PEERS}', 'bench', ' '.join(random.choices(WORDS, weights, k=MESSAGE_WORDS)))
+         for i in range(messages)))
+    connection.commit()
+    connection.close()
+
+
+def search_like(database, words, peer=None, limit=20):
+    """Поиск перебором: все слова должны входить в текст сообщения"""
+    sql = 'SELECT id FROM message_history WHERE ' + ' AND '.join('message LIKE ?' for _ in words.split())
+    params = [f'%{word.rstrip("*")}%' for word in words.split()]
+    if peer:
+        sql += ' AND (from_user = ? OR to_user = ?)'
+        params += [peer, peer]
+    with database.database_engine.connect() as connection:
+        return connection.exec_driver_sql(sql + f' ORDER BY id DESC LIMIT {limit}', tuple(params)).all()
+
+
+def search_fts(database, words, peer=None, limit=20):
+    """Поиск по полнотекстовому индексу"""
+    return database.search_history(words, peer, limit)
+
+
+def measure(search, database, words, peer, repeats):
+    """Время одного поиска в миллисекундах"""
+    start = perf_counter()
+    for _ in range(repeats):
+        search(database, words, peer)
+    return (perf_counter() - start) / repeats * 1e3
+
+
+def main():
+    messages = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+    repeats = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+    cases = (
+        ('редкое слово', WORDS[-1], None),
+        ('два слова', f'{WORDS[10]} {WORDS[50]}', None),
+        ('префикс', f'{WORDS[4999][:-1]}*', None),
+        ('редкое, собеседник', WORDS[-1], 'user_7'),
+        ('частое слово', WORDS[0], None),
+        ('частое, собеседник', WORDS[0], 'user_7'),
+    )
+    with TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'bench.db3')
+        start = perf_counter()
+        fill(path, messages)
+        print(f'База на {messages} сообщений подготовлена за {perf_counter() - start:.1f} с, повторов: {repeats}')
+        database = ClientDB('bench', f'sqlite:///{path}')
+        print(f'{"запрос":<22}{"LIKE, мс":>12}{"FTS5, мс":>12}{"ускорение":>12}')
+        for case, words, peer in cases:
+            before = measure(search_like, database, words, peer, repeats)
+            after = measure(search_fts, database, words, peer, repeats)
+            print(f'{case:<22}{before:>12.1f}{after:>12.1f}{before / after:>11.1f}x')
+        database.session.close()
+        database.database_engine.dispose()
+        clear_mappers()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,45 @@
+"""
+Сравнение кодеков JSON и двоичного: размер кадра на проводе и скорость кодирования/декодирования.
+Запуск из корня проекта: python benchmarks/bench_codec.py
+"""
+
+import os
+import sys
+from logging import getLogger, INFO
+from timeit import repeat
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from common.variables import *
+from common.utils import encode_message, decode_message, encode_binary, decode_binary, pack_frame
+
+SAMPLES = {
+    'presence': {ACTION: PRESENCE, TIME: 1700000000.123, USER: {ACCOUNT_NAME: 'user_1234'}},
+    'message': {ACTION: MESSAGE, SENDER: 'user_1234', DESTINATION: 'user_5678', TIME: 1700000000.123,
+                MESSAGE_TEXT: 'Привет! Как дела?'},
+    'response_200': {RESPONSE: 200},
+    'users_1000': {RESPONSE: 202, LIST_INFO: [f'user_{i}' for i in range(1000)]},
+}
+
+CODECS = {
+    CODEC_JSON: (encode_message, decode_message),
+    CODEC_BINARY: (encode_binary, decode_binary),
+}
+
+
+def main():
+    # Отладочная запись вызовов @log выключена, чтобы измерять только кодеки.
+    for name in ('server', 'client'):
+        getLogger(name).setLevel(INFO)
+    print(f'{"сообщение":<14}{"кодек":<6}{"байт":>8}{"кодир., мкс":>14}{"декод., мкс":>14}')
+    for name, message in SAMPLES.items():
+        number = 200 if name == 'users_1000' else 20000
+        for codec, (encode, decode) in CODECS.items():
+            payload = encode(message)
+            size = len(pack_frame(payload))
+            encode_time = min(repeat(lambda: encode(message), number=number, repeat=5)) / number * 1e6
+            decode_time = min(repeat(lambda: decode(payload), number=number, repeat=5)) / number * 1e6
+            print(f'{name:<14}{codec:<6}{size:>8}{encode_time:>14.2f}{decode_time:>14.2f}')
+
+
+if __name__ == '__main__':
+    main()
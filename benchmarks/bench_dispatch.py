@@ -0,0 +1,91 @@
+"""
+Микро-бенчмарк разбора сообщений сервером: цепочка elif (как было) против реестра обработчиков.
+Запуск из корня проекта: python benchmarks/bench_dispatch.py
+"""
+
+import os
+import sys
+from logging import getLogger, INFO
+from timeit import repeat
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from common.variables import *
+from common.utils import send_message, FrameEncoder
+from server import Server
+
+logger = getLogger('server')
+
+
+class FakeDB:
+    """Заглушка базы данных, чтобы измерять только разбор сообщения"""
+
+    def user_login(self, *args):
+        pass
+
+    def users_list(self):
+        return []
+
+
+class FakeClient:
+    """Заглушка соединения"""
+
+    encoder = FrameEncoder()
+
+    def sendall(self, data):
+        pass
+
+    def getpeername(self):
+        return '127.0.0.1', 7777
+
+
+def legacy_process_client_message(server, message, client):
+    """Прежняя цепочка elif из Server.process_client_message (ветки до USERS_REQUEST включительно)"""
+
+    logger.debug(f'Разбор сообщения от клиента : {message}')
+    if ACTION in message and message[ACTION] == PRESENCE and TIME in message and USER in message:
+        return
+    elif ACTION in message and message[ACTION] == MESSAGE and DESTINATION in message and TIME in message \
+            and SENDER in message and MESSAGE_TEXT in message:
+        server.messages.append(message)
+        return
+    elif ACTION in message and message[ACTION] == EXIT and ACCOUNT_NAME in message:
+        return
+    elif ACTION in message and message[ACTION] == GET_CONTACTS and USER in message and \
+            server.names[message[USER]] == client:
+        return
+    elif ACTION in message and message[ACTION] == ADD_CONTACT and ACCOUNT_NAME in message and USER in message \
+            and server.names[message[USER]] == client:
+        return
+    elif ACTION in message and message[ACTION] == REMOVE_CONTACT and ACCOUNT_NAME in message and USER in message \
+            and server.names[message[USER]] == client:
+        return
+    elif ACTION in message and message[ACTION] == USERS_REQUEST and ACCOUNT_NAME in message \
+            and server.names[message[ACCOUNT_NAME]] == client:
+        response = RESPONSE_202
+        response[LIST_INFO] = [user[0] for user in server.database.users_list()]
+        send_message(client, response)
+
+
+def main(number=200000):
+    # Отладочные записи выключены, как на рабочем сервере: измеряется стоимость самого разбора.
+    logger.setLevel(INFO)
+    server = Server('', DEFAULT_PORT, FakeDB())
+    client = FakeClient()
+    server.names['user1'] = client
+    samples = {
+        'message': {ACTION: MESSAGE, SENDER: 'user1', DESTINATION: 'user2', TIME: 1.1, MESSAGE_TEXT: 'text'},
+        'get_users': {ACTION: USERS_REQUEST, TIME: 1.1, ACCOUNT_NAME: 'user1'},
+    }
+    print(f'{"действие":<12}{"elif, нс":>12}{"реестр, нс":>14}')
+    for name, message in samples.items():
+        results = []
+        for dispatch in (lambda: legacy_process_client_message(server, message, client),
+                         lambda: server.process_client_message(message, client)):
+            best = min(repeat(dispatch, number=number, repeat=5))
+            server.messages.clear()
+            results.append(best / number * 1e9)
+        print(f'{name:<12}{results[0]:>12.0f}{results[1]:>14.0f}')
+
+
+if __name__ == '__main__':
+    main()
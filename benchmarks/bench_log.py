@@ -0,0 +1,69 @@
+"""
+Бенчмарк накладных расходов декоратора log: вызов функции без декоратора, с прежним декоратором
+(f-строка с параметрами на каждый вызов) и с текущим – при выключенном и включённом уровне DEBUG,
+а также с выборкой sample=100. Записи уходят в обработчик, который ничего не пишет,
+чтобы измерялся сам декоратор, а не вывод в файл.
+Запуск из корня проекта: python benchmarks/bench_log.py [число вызовов]
+"""
+
+import os
+import sys
+from logging import getLogger, NullHandler, DEBUG, INFO
+from time import perf_counter
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from decos import log, use_logger
+
+LOGGER = getLogger('bench_log')
+LOGGER.addHandler(NullHandler())
+LOGGER.propagate = False
+
+# Сообщение, с которым вызывается функция, как у encode_message
+MESSAGE = {'action': 'message', 'time': 1.5, 'from': 'user_1', 'to': 'user_2', 'mess_text': 'Привет' * 10}
+
+
+def old_log(func_to_log):
+    """Декоратор в прежнем виде: параметры форматируются при каждом вызове"""
+
+    def log_saver(*args, **kwargs):
+        LOGGER.debug(f'Была вызвана функция {func_to_log.__name__} c параметрами {args} , {kwargs}. '
+                     f'Вызов из модуля {func_to_log.__module__}')
+        return func_to_log(*args, **kwargs)
+
+    return log_saver
+
+
+def handle(message):
+    return message
+
+
+def measure(func, calls):
+    """Время одного вызова в наносекундах"""
+    start = perf_counter()
+    for _ in range(calls):
+        func(MESSAGE)
+    return (perf_counter() - start) / calls * 1e9
+
+
+def main():
+    calls = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+    use_logger(LOGGER)
+    cases = (
+        ('без декоратора', handle),
+        ('прежний log', old_log(handle)),
+        ('log', log(handle)),
+        ('log(sample=100)', log(sample=100)(handle)),
+        ('log(timing=True)', log(timing=True)(handle)),
+    )
+    print(f'Вызовов: {calls}')
+    print(f'{"функция":<20}{"DEBUG выкл., нс":>18}{"DEBUG вкл., нс":>18}')
+    for case, func in cases:
+        LOGGER.setLevel(INFO)
+        disabled = measure(func, calls)
+        LOGGER.setLevel(DEBUG)
+        enabled = measure(func, calls)
+        print(f'{case:<20}{disabled:>18.0f}{enabled:>18.0f}')
+
+
+if __name__ == '__main__':
+    main()
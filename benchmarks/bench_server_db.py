@@ -0,0 +1,104 @@
+"""
+Бенчмарк базы данных сервера на большом числе пользователей: вход и выход, добавление, удаление и получение контактов.
+Сравнивается база без индексов миграций на журнале SQLite по умолчанию и база с индексами и профилем
+SERVER_DATABASE_PROFILE (WAL, synchronous NORMAL, кеш, mmap).
+Запуск из корня проекта: python benchmarks/bench_server_db.py [число пользователей] [число операций]
+По умолчанию 1 000 000 пользователей, подготовка базы занимает около минуты.
+"""
+
+import os
+import sys
+import shutil
+import sqlite3
+from random import Random
+from tempfile import TemporaryDirectory
+from time import perf_counter
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from sqlalchemy.orm import clear_mappers
+from server_DB import ServerDB
+
+# Контактов у каждого пользователя в заполненной базе
+CONTACTS_PER_USER = 3
+# Индексы, которые добавляет миграция 1
+MIGRATION_INDEXES = ('Contacts_user_contact', 'Login_history_name_date_time', 'History_user')
+
+
+def fill(path, users):
+    """Заполнение базы пользователями, их контактами, историей входов и счётчиками"""
+    ServerDB(f'sqlite:///{path}', profile={}).session.close()
+    clear_mappers()
+    connection = sqlite3.connect(path)
+    connection.executemany('INSERT INTO Users (id, name, last_login) VALUES (?, ?, CURRENT_TIMESTAMP)',
+                           ((i, f'user_{i}') for i in range(1, users + 1)))
+    connection.executemany('INSERT INTO History (user, sent, accepted) VALUES (?, 0, 0)',
+                           ((i,) for i in range(1, users + 1)))
+    connection.executemany('INSERT INTO Login_history (name, date_time, ip, port) '
+                           'VALUES (?, CURRENT_TIMESTAMP, "127.0.0.1", 7777)',
+                           ((i,) for i in range(1, users + 1)))
+    connection.executemany('INSERT INTO Contacts (user, contact) VALUES (?, ?)',
+                           ((i, (i + shift) % users + 1) for i in range(1, users + 1)
+                            for shift in range(1, CONTACTS_PER_USER + 1)))
+    connection.commit()
+    connection.close()
+
+
+def open_database(seed, path, tuned):
+    """Копия заполненной базы: с профилем и индексами или без них"""
+    shutil.copy(seed, path)
+    if tuned:
+        return ServerDB(f'sqlite:///{path}')
+    database = ServerDB(f'sqlite:///{path}', profile={})
+    with database.database_engine.begin() as connection:
+        for index in MIGRATION_INDEXES:
+            connection.exec_driver_sql(f'DROP INDEX {index}')
+    return database
+
+
+def measure(database, users, operations):
+    """Время одной операции каждого вида в микросекундах"""
+    random = Random(1)
+    # Имена без повторов: каждый вход добавляет строку активного пользователя, повторный вход без выхода
+    # нарушил бы уникальность Active_users.user.
+    names = [f'user_{i}' for i in random.sample(range(1, users + 1), operations)]
+    contacts = [f'user_{random.randint(1, users)}' for _ in range(operations)]
+    cases = (
+        ('user_login', lambda name, contact: database.user_login(name, '127.0.0.1', 7777)),
+        ('user_logout', lambda name, contact: database.user_logout(name)),
+        ('add_contact', lambda name, contact: database.add_contact(name, contact)),
+        ('get_contacts', lambda name, contact: database.get_contacts(name)),
+        ('remove_contact', lambda name, contact: database.remove_contact(name, contact)),
+        ('process_message', lambda name, contact: database.process_message(name, contact)),
+    )
+    results = {}
+    for case, operation in cases:
+        start = perf_counter()
+        for name, contact in zip(names, contacts):
+            operation(name, contact)
+        results[case] = (perf_counter() - start) / operations * 1e6
+    return results
+
+
+def main():
+    users = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+    operations = int(sys.argv[2]) if len(sys.argv) > 2 else 200
+    with TemporaryDirectory() as directory:
+        seed = os.path.join(directory, 'seed.db3')
+        start = perf_counter()
+        fill(seed, users)
+        print(f'База на {users} пользователей подготовлена за {perf_counter() - start:.1f} с, операций: {operations}')
+        results = {}
+        for tuned in (False, True):
+            database = open_database(seed, os.path.join(directory, f'bench_{tuned}.db3'), tuned)
+            results[tuned] = measure(database, users, operations)
+            database.session.close()
+            database.database_engine.dispose()
+            clear_mappers()
+    print(f'{"операция":<18}{"по умолчанию, мкс":>20}{"профиль+индексы, мкс":>24}{"ускорение":>12}')
+    for case in results[False]:
+        before, after = results[False][case], results[True][case]
+        print(f'{case:<18}{before:>20.0f}{after:>24.0f}{before / after:>11.1f}x')
+
+
+if __name__ == '__main__':
+    main()
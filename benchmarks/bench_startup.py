@@ -0,0 +1,99 @@
+"""
+Бенчмарк запуска клиента: время от старта процесса client.py до получения сервером сообщения о присутствии
+и до приглашения ввести команду (база открыта, списки пользователей и контактов загружены).
+Сервер заменён заглушкой в этом же процессе, чтобы измерялся только клиент.
+Клиент запускается как обычно – с записью байт-кода в __pycache__, первый запуск прогревочный и не учитывается.
+Запуск из корня проекта: python benchmarks/bench_startup.py [число запусков]
+python benchmarks/bench_startup.py --importtime [число строк] – самые долгие импорты client.py и server.py
+по данным python -X importtime.
+"""
+
+import os
+import sys
+import subprocess
+from socket import create_server
+from statistics import median
+from tempfile import TemporaryDirectory
+from time import perf_counter
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+from common.variables import ACTION, PRESENCE, RESPONSE, LIST_INFO, REQUEST_ID
+from common.utils import FrameDecoder, FrameEncoder, get_message, send_message
+
+# Приглашение, которое клиент выводит, когда готов к работе
+PROMPT = 'Введите команду: '.encode()
+
+
+def environment():
+    """Окружение клиента: байт-код и кеш проверок классов записываются, как при обычном запуске"""
+    env = dict(os.environ)
+    env.pop('PYTHONDONTWRITEBYTECODE', None)
+    return env
+
+
+def start_client(listener, directory):
+    """Один запуск клиента. Возвращает время до приветствия и до готовности в миллисекундах."""
+    port = listener.getsockname()[1]
+    start = perf_counter()
+    client = subprocess.Popen([sys.executable, os.path.join(ROOT, 'client.py'), '127.0.0.1', str(port), '-n', 'bench'],
+                              cwd=directory, env=environment(), stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                              stderr=subprocess.DEVNULL)
+    sock, _ = listener.accept()
+    decoder, encoder = FrameDecoder(), FrameEncoder()
+    message = get_message(sock, decoder)
+    presence = perf_counter()
+    assert message[ACTION] == PRESENCE
+    send_message(sock, {RESPONSE: 200}, encoder)
+    # Запросы списков пользователей и контактов при загрузке базы
+    for _ in range(2):
+        request = get_message(sock, decoder)
+        send_message(sock, {RESPONSE: 202, LIST_INFO: ['bench'], REQUEST_ID: request.get(REQUEST_ID)}, encoder)
+    output = b''
+    while not output.endswith(PROMPT):
+        data = client.stdout.read1(4096)
+        if not data:
+            raise RuntimeError('Клиент завершился до приглашения ввести команду')
+        output += data
+    ready = perf_counter()
+    client.communicate(b'exit\n', timeout=10)
+    sock.close()
+    return (presence - start) * 1e3, (ready - start) * 1e3
+
+
+def measure(runs):
+    with TemporaryDirectory() as directory, create_server(('127.0.0.1', 0)) as listener:
+        start_client(listener, directory)
+        results = [start_client(listener, directory) for _ in range(runs)]
+    print(f'Запусков: {runs}, медиана')
+    print(f'{"до сообщения о присутствии, мс":<36}{median(result[0] for result in results):>8.1f}')
+    print(f'{"до готовности к вводу, мс":<36}{median(result[1] for result in results):>8.1f}')
+
+
+def importtime(module):
+    """Импорты модуля по данным -X importtime: (время с учётом вложенных в мкс, имя) по убыванию времени"""
+    profile = subprocess.run([sys.executable, '-X', 'importtime', '-c', f'import {module}'], cwd=ROOT,
+                             env=environment(), capture_output=True, text=True).stderr
+    rows = []
+    for line in profile.splitlines():
+        if line.startswith('import time:') and 'cumulative' not in line:
+            _, cumulative, name = line[len('import time:'):].split('|')
+            rows.append((int(cumulative), name.rstrip()))
+    return sorted(rows, reverse=True)
+
+
+def main():
+    if len(sys.argv) > 1 and sys.argv[1] == '--importtime':
+        lines = int(sys.argv[2]) if len(sys.argv) > 2 else 15
+        for module in ('client', 'server'):
+            # Первый импорт записывает байт-код, измеряется второй.
+            importtime(module)
+            print(f'import {module}, мкс с учётом вложенных:')
+            for cumulative, name in importtime(module)[:lines]:
+                print(f'{cumulative:>10} {name}')
+        return
+    measure(int(sys.argv[1]) if len(sys.argv) > 1 else 10)
+
+
+if __name__ == '__main__':
+    main()
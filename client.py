@@ -1,33 +1,219 @@
 import sys
 from argparse import ArgumentParser
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+from itertools import count
 from json import JSONDecodeError
 from logging import getLogger
-from socket import socket, SOCK_STREAM, AF_INET
+from queue import Queue
+from socket import socket, SOCK_STREAM, AF_INET, SHUT_RDWR, IPPROTO_TCP, TCP_NODELAY
 from threading import Thread, Lock
 import logs.config_client_log
-from time import time, sleep
-from client_DB import ClientDB
+from time import time, sleep, ctime
 from common.variables import *
 from common.utils import *
 from errors import IncorrectDataReceivedError, ReqFieldMissingError, ServerError
-from decos import log
+from decos import log, use_logger
 from metaclasses import ClientVerifier
 
 # Инициализация клиентского логгера
 logger = getLogger('client')
 
-sock_lock = Lock()
 database_lock = Lock()
 
 
+class ClientTransport(Thread, metaclass=ClientVerifier):
+    def __init__(self, sock, decoder, encoder, request_ids=False):
+        """
+        Транспорт клиента – единственный поток, который читает из сокета.
+        Принятые кадры разбираются на ответы сервера и сообщения чата: ответ по идентификатору запроса получает
+        ожидающий его запрос, сообщения чата попадают в очередь messages. Блокировка берётся только на время отправки,
+        recv выполняется без блокировок и без таймаута, поэтому сообщение обрабатывается сразу после приёма.
+        request_ids – сервер подтвердил, что возвращает идентификаторы запросов. Иначе ответы без идентификатора
+        сопоставляются с запросами по порядку.
+        """
+
+        self.sock = sock
+        self.sock.settimeout(None)
+        # Кадры отправляются целиком, задержка по алгоритму Нейгла им не нужна.
+        self.sock.setsockopt(IPPROTO_TCP, TCP_NODELAY, 1)
+        self.decoder = decoder
+        # Кодировщик кадров с кодеком, согласованным с сервером.
+        self.encoder = encoder
+        # Сообщения чата для ClientReader. None в очереди означает, что соединение закрыто.
+        self.messages = Queue()
+        # Запросы, ожидающие ответа: идентификатор запроса – Future для ответа, в порядке отправки.
+        # None – запрос, время ожидания которого истекло: ответ на него отбрасывается.
+        self.pending = {}
+        self.request_ids = count(1)
+        self.request_ids_negotiated = request_ids
+        # Защищает кодировщик, отправку и очередь ожидающих запросов.
+        self.send_lock = Lock()
+        self.closed = False
+        super().__init__(daemon=True)
+
+    def run(self):
+        """
+        Основной цикл приёма. Работает до потери соединения или до вызова close.
+        """
+
+        while True:
+            try:
+                message = get_message(self.sock, self.decoder)
+            except IncorrectDataReceivedError:
+                # Кадр пропущен, и следующие можно было бы принять, но после ошибки в сжатом кадре
+                # или в заголовке поток уже не разобрать. Принятые до ошибки сообщения обрабатываются,
+                # соединение закрывается.
+                logger.critical('Не удалось декодировать полученное сообщение, соединение закрыто.')
+                while self.decoder.backlog:
+                    self.dispatch(self.decoder.backlog.popleft())
+                break
+            # ConnectionError и его подклассы – тоже OSError.
+            except (OSError, JSONDecodeError):
+                if not self.closed:
+                    logger.critical('Потеряно соединение с сервером.')
+                break
+            else:
+                self.dispatch(message)
+
+        with self.send_lock:
+            self.closed = True
+            for future in self.pending.values():
+                if future is not None:
+                    future.set_exception(ConnectionResetError())
+            self.pending.clear()
+        self.messages.put(None)
+
+    def dispatch(self, message):
+        """
+        Метод разбора принятого сообщения: ответ сервера получает запрос с тем же идентификатором,
+        остальные сообщения передаются в очередь сообщений чата. Туда же попадают ответы без идентификатора,
+        не относящиеся ни к одному запросу, – ошибки на сообщения, не требующие ответа.
+        """
+
+        if RESPONSE not in message:
+            self.messages.put(message)
+            return
+        with self.send_lock:
+            if REQUEST_ID in message:
+                matched = message[REQUEST_ID] in self.pending
+                future = self.pending.pop(message[REQUEST_ID], None)
+            elif self.pending and not self.request_ids_negotiated:
+                # Сервер без поддержки идентификаторов отвечает на запросы по порядку.
+                matched = True
+                future = self.pending.pop(next(iter(self.pending)))
+            else:
+                matched = False
+                future = None
+        if future is not None:
+            future.set_result(message)
+        elif matched:
+            logger.debug(f'Ответ на запрос, время ожидания которого истекло, отброшен: {message}')
+        elif REQUEST_ID not in message:
+            self.messages.put(message)
+        else:
+            logger.error(f'Получен ответ сервера на неизвестный или просроченный запрос: {message}')
+
+    def send(self, message):
+        """
+        Метод отправки сообщения, не требующего ответа.
+        """
+
+        with self.send_lock:
+            send_message(self.sock, message, self.encoder)
+
+    def submit(self, message):
+        """
+        Метод отправки запроса без ожидания ответа. Возвращает Future, которое получит ответ сервера.
+        К копии запроса добавляется идентификатор, поэтому запросов в пути может быть сколько угодно.
+        """
+
+        future = Future()
+        with self.send_lock:
+            if self.closed:
+                raise ServerError('Соединение с сервером закрыто')
+            request_id = next(self.request_ids)
+            message = dict(message)
+            message[REQUEST_ID] = request_id
+            # Запрос встаёт в очередь раньше, чем на него может прийти ответ.
+            self.pending[request_id] = future
+            try:
+                send_message(self.sock, message, self.encoder)
+            except OSError:
+                del self.pending[request_id]
+                raise ServerError('Потеряно соединение с сервером')
+        return future
+
+    def request(self, message, timeout=REQUEST_TIMEOUT):
+        """
+        Метод отправки запроса и ожидания ответа сервера. Возвращает ответ.
+        """
+
+        return self.request_many((message,), timeout)[0]
+
+    def request_many(self, messages, timeout=REQUEST_TIMEOUT):
+        """
+        Метод отправки нескольких запросов подряд и ожидания всех ответов – один обмен с сервером вместо обмена
+        на каждый запрос. Возвращает ответы в порядке запросов.
+        Если соединение закрыто или ответы не пришли за timeout секунд, бросает ServerError.
+        """
+
+        futures = [self.submit(message) for message in messages]
+        if wait(futures, timeout).not_done and self.abandon(futures):
+            raise ServerError('Сервер не ответил на запрос')
+        try:
+            return [future.result() for future in futures]
+        except ConnectionError:
+            raise ServerError('Потеряно соединение с сервером')
+
+    def abandon(self, futures):
+        """
+        Метод отказа от ожидания ответов на запросы после таймаута, чтобы опоздавший ответ не достался
+        другому запросу. С идентификаторами запросов ожидание просто удаляется. Сервер без идентификаторов отвечает
+        по порядку, поэтому запрос остаётся в очереди без Future, и следующий по порядку ответ отбрасывается.
+        Возвращает True, если хотя бы один запрос так и остался без ответа.
+        """
+
+        abandoned = False
+        with self.send_lock:
+            for request_id, future in list(self.pending.items()):
+                if future is not None and future in futures:
+                    abandoned = True
+                    if self.request_ids_negotiated:
+                        del self.pending[request_id]
+                    else:
+                        self.pending[request_id] = None
+        return abandoned
+
+    def close(self, message=None):
+        """
+        Метод закрытия соединения. message – последнее сообщение серверу, например о выходе.
+        Поток приёма завершается, не сообщая о потере соединения, даже если сервер закроет его первым.
+        """
+
+        with self.send_lock:
+            self.closed = True
+            if message is not None:
+                try:
+                    send_message(self.sock, message, self.encoder)
+                except OSError:
+                    pass
+        try:
+            self.sock.shutdown(SHUT_RDWR)
+        except OSError:
+            pass
+        self.join()
+        self.sock.close()
+
+
 class Client(Thread):
-    def __init__(self, account_name, sock, database):
+    def __init__(self, account_name, transport, database):
         """
         Основной класс формирования и отправки сообщений на сервер и взаимодействия с пользователем.
         """
 
         self.account_name = account_name
-        self.sock = sock
+        # Транспорт, через который идёт вся работа с сокетом.
+        self.transport = transport
         self.database = database
         super().__init__()
 
@@ -71,17 +257,56 @@ class ClientSender(Client, metaclass=ClientVerifier):
         with database_lock:
             self.database.save_message(self.account_name, to, message)
 
-        # print(sock_lock)
-        with sock_lock:
-            try:
-                self.sock.send(encode_message(message_dict))
-                logger.info(f'Отправлено сообщение для пользователя {to}')
-            except OSError as err:
-                if err.errno:
-                    logger.critical('Потеряно соединение с сервером.')
-                    exit(1)
-                else:
-                    logger.error('Не удалось передать сообщение.')
+        try:
+            self.transport.send(message_dict)
+            logger.info(f'Отправлено сообщение для пользователя {to}')
+        except OSError as err:
+            if err.errno:
+                logger.critical('Потеряно соединение с сервером.')
+                exit(1)
+            else:
+                logger.error('Не удалось передать сообщение.')
+
+    def create_group_message(self):
+        """
+        Метод запрашивает группу и текст сообщения и отправляет сообщение в групповой чат.
+        """
+
+        group = input('Введите название группы: ')
+        message = input('Введите сообщение для отправки: ')
+        message_dict = {
+            ACTION: GROUP_MESSAGE,
+            SENDER: self.account_name,
+            GROUP: group,
+            TIME: time(),
+            MESSAGE_TEXT: message
+        }
+        with database_lock:
+            self.database.save_message(self.account_name, group, message)
+
+        try:
+            self.transport.send(message_dict)
+            logger.info(f'Отправлено сообщение в группу {group}')
+        except OSError as err:
+            if err.errno:
+                logger.critical('Потеряно соединение с сервером.')
+                exit(1)
+            else:
+                logger.error('Не удалось передать сообщение.')
+
+    def edit_groups(self, command):
+        """
+        Метод вступления в групповой чат и выхода из него
+        """
+
+        group = input('Введите название группы: ')
+        try:
+            if command == 'join':
+                join_group(self.transport, self.account_name, group)
+            else:
+                leave_group(self.transport, self.account_name, group)
+        except ServerError:
+            logger.error('Не удалось отправить информацию на сервер.')
 
     def run(self):
         """
@@ -98,14 +323,10 @@ class ClientSender(Client, metaclass=ClientVerifier):
                 self.print_help()
 
             elif command == 'exit':
-                with sock_lock:
-                    try:
-                        self.sock.send(encode_message(self.create_exit_message()))
-                    except:
-                        pass
-                    print('Завершение соединения.')
-                    logger.info('Завершение работы по команде пользователя.')
-                sleep(0.5)  # Задержка необходима, чтобы успело уйти сообщение о выходе
+                # Сообщение о выходе уходит до закрытия соединения.
+                self.transport.close(self.create_exit_message())
+                print('Завершение соединения.')
+                logger.info('Завершение работы по команде пользователя.')
                 break
 
             elif command == 'contacts':
@@ -120,6 +341,18 @@ class ClientSender(Client, metaclass=ClientVerifier):
             elif command == 'history':
                 self.print_history()
 
+            elif command == 'search':
+                self.search_history()
+
+            elif command == 'archive':
+                self.print_archive()
+
+            elif command == 'group':
+                self.create_group_message()
+
+            elif command in ('join', 'leave'):
+                self.edit_groups(command)
+
             else:
                 print('Команда не распознана, попробуйте снова. help - вывести поддерживаемые команды.')
 
@@ -128,21 +361,69 @@ class ClientSender(Client, metaclass=ClientVerifier):
         Метод вывода истории сообщений
         """
 
-        ask = input('Показать входящие сообщения - in, исходящие - out, все - просто Enter: ')
-        with database_lock:
-            if ask == 'in':
-                history_list = self.database.get_history(to_who=self.account_name)
-                for message in history_list:
+        ask = input('Показать входящие сообщения - in, исходящие - out, переписку с пользователем или группой - имя, '
+                    'все - просто Enter: ')
+        if ask == 'in':
+            query = {'to_who': self.account_name}
+        elif ask == 'out':
+            query = {'from_who': self.account_name}
+        elif ask:
+            query = {'peer': ask}
+        else:
+            query = {}
+        # История выводится страницами с конца: сначала последние сообщения, затем по запросу более ранние.
+        before = None
+        while True:
+            with database_lock:
+                page = self.database.get_history(before=before, limit=HISTORY_PAGE_SIZE, **query)
+            for message in page:
+                if ask == 'in':
                     print(f'\nСообщение от пользователя: {message[0]} от {message[3]}:\n{message[2]}')
-            elif ask == 'out':
-                history_list = self.database.get_history(from_who=self.account_name)
-                for message in history_list:
+                elif ask == 'out':
                     print(f'\nСообщение пользователю: {message[1]} от {message[3]}:\n{message[2]}')
-            else:
-                history_list = self.database.get_history()
-                for message in history_list:
+                else:
                     print(
                         f'\nСообщение от пользователя: {message[0]}, пользователю {message[1]} от {message[3]}\n{message[2]}')
+            if len(page) < HISTORY_PAGE_SIZE or input('Показать более ранние сообщения? (y/n): ') != 'y':
+                break
+            before = page[0][4]
+
+    def search_history(self):
+        """
+        Метод поиска по истории сообщений
+        """
+
+        words = input('Введите слова для поиска (слово* - поиск по началу слова): ')
+        peer = input('Искать в переписке с пользователем или группой - имя, везде - просто Enter: ')
+        with database_lock:
+            found = self.database.search_history(words, peer or None)
+        if not found:
+            print('Ничего не найдено.')
+        for message in found:
+            print(f'\nСообщение от пользователя: {message[0]}, пользователю {message[1]} от {message[3]}\n'
+                  f'{message[5]}')
+
+    def print_archive(self):
+        """
+        Метод вывода переписки из архива сервера, например на новом устройстве, где локальной истории нет.
+        Страницы запрашиваются у сервера по одной, начиная с последних сообщений.
+        """
+
+        peer = input('Введите имя собеседника: ')
+        cursor = None
+        while True:
+            try:
+                page, cursor = history_request(self.transport, self.account_name, peer, cursor)
+            except ServerError:
+                logger.error('Не удалось получить историю сообщений с сервера.')
+                return
+            if not page:
+                print('Сообщений нет.')
+            for message in page:
+                print(f'\nСообщение от пользователя: {message[SENDER]}, пользователю {message[DESTINATION]} '
+                      f'от {ctime(message[TIME])}\n{message[MESSAGE_TEXT]}')
+            if cursor is None or input('Показать более ранние сообщения? (y/n): ') != 'y':
+                break
 
     def edit_contacts(self):
         """
@@ -162,11 +443,10 @@ class ClientSender(Client, metaclass=ClientVerifier):
             if self.database.check_user(edit):
                 with database_lock:
                     self.database.add_contact(edit)
-                with sock_lock:
-                    try:
-                        add_contact(self.sock, self.account_name, edit)
-                    except ServerError:
-                        logger.error('Не удалось отправить информацию на сервер.')
+                try:
+                    add_contact(self.transport, self.account_name, edit)
+                except ServerError:
+                    logger.error('Не удалось отправить информацию на сервер.')
 
     def print_help(self):
         """
@@ -176,8 +456,13 @@ class ClientSender(Client, metaclass=ClientVerifier):
         print('Поддерживаемые команды:')
         print('message - отправить сообщение. Кому и текст будет запрошены отдельно.')
         print('history - история сообщений')
+        print('search - поиск по истории сообщений')
+        print('archive - переписка с пользователем из архива сервера')
         print('contacts - список контактов')
         print('edit - редактирование списка контактов')
+        print('group - отправить сообщение в групповой чат')
+        print('join - вступить в групповой чат')
+        print('leave - выйти из группового чата')
         print('help - вывести подсказки по командам')
         print('exit - выход из программы')
 
@@ -187,47 +472,48 @@ class ClientReader(Client, metaclass=ClientVerifier):
     def run(self):
         """
         Основной цикл приёмника сообщений.
-        Принимает сообщения, выводит в консоль. Завершается при потере соединения.
+        Берёт сообщения чата из очереди транспорта, выводит в консоль и сохраняет в базу.
+        Завершается, когда транспорт закрывает соединение.
         """
 
         while True:
-            sleep(1)
-            with sock_lock:
-                try:
-                    message = decode_message(self.sock.recv(MAX_PACKAGE_LENGTH))
-                    # Принято некорректное сообщение
-                except IncorrectDataReceivedError:
-                    logger.error(f'Не удалось декодировать полученное сообщение.')
-
-                except OSError as err:
-                    if err.errno:
-                        logger.critical(f'Потеряно соединение с сервером.')
-                        break
+            message = self.transport.messages.get()
+            if message is None:
+                break
 
-                except (ConnectionError, ConnectionAbortedError, ConnectionResetError, JSONDecodeError):
-                    logger.critical(f'Потеряно соединение с сервером.')
-                    break
+            if ACTION in message and message[ACTION] == MESSAGE and SENDER in message and DESTINATION in message \
+                    and MESSAGE_TEXT in message and message[DESTINATION] == self.account_name:
+                print(f'\nПолучено сообщение от пользователя {message[SENDER]}:\n{message[MESSAGE_TEXT]}')
+                # Захватываем работу с базой данных и сохраняем в неё сообщение
+                with database_lock:
+                    try:
+                        self.database.save_message(message[SENDER], self.account_name, message[MESSAGE_TEXT])
+                    except:
+                        logger.error('Ошибка взаимодействия с базой данных')
 
-                else:
-                    if ACTION in message and message[ACTION] == MESSAGE and SENDER in message and DESTINATION in message \
-                            and MESSAGE_TEXT in message and message[DESTINATION] == self.account_name:
-                        print(f'\nПолучено сообщение от пользователя {message[SENDER]}:\n{message[MESSAGE_TEXT]}')
-                        # Захватываем работу с базой данных и сохраняем в неё сообщение
-                        with database_lock:
-                            try:
-                                self.database.save_message(message[SENDER], self.account_name, message[MESSAGE_TEXT])
-                            except:
-                                logger.error('Ошибка взаимодействия с базой данных')
-
-                        logger.info(f'Получено сообщение от пользователя {message[SENDER]}:\n{message[MESSAGE_TEXT]}')
-                    else:
-                        logger.error(f'Получено некорректное сообщение с сервера: {message}')
+                logger.info(f'Получено сообщение от пользователя {message[SENDER]}:\n{message[MESSAGE_TEXT]}')
+            elif ACTION in message and message[ACTION] == GROUP_MESSAGE and SENDER in message \
+                    and GROUP in message and MESSAGE_TEXT in message:
+                print(f'\nСообщение в группе {message[GROUP]} от пользователя {message[SENDER]}:'
+                      f'\n{message[MESSAGE_TEXT]}')
+                with database_lock:
+                    try:
+                        self.database.save_message(message[SENDER], message[GROUP], message[MESSAGE_TEXT])
+                    except:
+                        logger.error('Ошибка взаимодействия с базой данных')
+            elif message.get(RESPONSE) == 400 and ERROR in message:
+                print(f'\nСервер вернул ошибку: {message[ERROR]}')
+                logger.error(f'Сервер вернул ошибку: {message[ERROR]}')
+            else:
+                logger.error(f'Получено некорректное сообщение с сервера: {message}')
 
 
 @log
-def create_presence(account_name):
+def create_presence(account_name, codec=CODEC_JSON, compression=False):
     """
-    Функция генерации запроса о присутствии клиента
+    Функция генерации запроса о присутствии клиента.
+    Если выбран не JSON, клиент предлагает серверу выбранный кодек с откатом на JSON.
+    Если нужно сжатие больших кадров, клиент запрашивает его у сервера.
     """
 
     out = {
@@ -237,6 +523,12 @@ def create_presence(account_name):
             ACCOUNT_NAME: account_name
         }
     }
+    if codec != CODEC_JSON:
+        out[CODECS] = [codec, CODEC_JSON]
+    if compression:
+        out[COMPRESSION] = COMPRESSION_ZLIB
+    # Сервер, сопоставляющий ответы по идентификаторам запросов, вернёт идентификатор в ответе на приветствие.
+    out[REQUEST_ID] = 0
     logger.debug(f'Сформировано {PRESENCE} сообщение для пользователя {account_name}')
     return out
 
@@ -267,10 +559,14 @@ def arg_parser():
     parser.add_argument('addr', default=DEFAULT_IP_ADDRESS, nargs='?')
     parser.add_argument('port', default=DEFAULT_PORT, type=int, nargs='?')
     parser.add_argument('-n', '--name', default=None, nargs='?')
+    parser.add_argument('-c', '--codec', default=CODEC_JSON, choices=(CODEC_JSON, CODEC_BINARY))
+    parser.add_argument('-z', '--compress', action='store_true')
     namespace = parser.parse_args(sys.argv[1:])
     server_address = namespace.addr
     server_port = namespace.port
     client_name = namespace.name
+    codec = namespace.codec
+    compression = namespace.compress
 
     # проверим подходящий номер порта
     if not 1023 < server_port < 65536:
@@ -278,13 +574,14 @@ def arg_parser():
             f'Попытка запуска клиента с неподходящим номером порта: {server_port}. Допустимы адреса с 1024 до 65535. Клиент завершается.')
         exit(1)
 
-    return server_address, server_port, client_name
+    return server_address, server_port, client_name, codec, compression
 
 
 @log
-def contacts_list_request(sock, name):
+def create_contacts_request(name, version=None, epoch=None):
     """
-    Запрос контакт-листа
+    Функция формирует запрос контакт-листа.
+    С версией и эпохой базы сервера из прошлой синхронизации сервер вернёт только изменения после неё.
     """
 
     logger.debug(f'Запрос контакт-листа для пользователя {name}')
@@ -293,19 +590,38 @@ def contacts_list_request(sock, name):
         TIME: time(),
         USER: name
     }
+    if version is not None:
+        req[VERSION] = version
+    if epoch is not None:
+        req[EPOCH] = epoch
+    return req
+
+
+@log
+def process_list_answer(answer):
+    """
+    Функция разбирает ответ сервера со списком. Возвращает список или генерирует исключение при ошибке.
+    """
 
-    logger.debug(f'Сформирован запрос {req}')
-    sock.send(encode_message(req))
-    answer = decode_message(sock.recv(MAX_PACKAGE_LENGTH))
     logger.debug(f'Получен ответ {answer}')
     if RESPONSE in answer and answer[RESPONSE] == 202:
         return answer[LIST_INFO]
-    else:
-        raise ServerError
+    raise ServerError(answer.get(ERROR) or 'Сервер не вернул список')
+
+
+@log
+def contacts_list_request(transport, name):
+    """
+    Запрос контакт-листа
+    """
+
+    req = create_contacts_request(name)
+    logger.debug(f'Сформирован запрос {req}')
+    return process_list_answer(transport.request(req))
 
 
 @log
-def add_contact(sock, username, contact):
+def add_contact(transport, username, contact):
     """
     Добавление пользователя в контакт лист
     """
@@ -317,9 +633,7 @@ def add_contact(sock, username, contact):
         USER: username,
         ACCOUNT_NAME: contact
     }
-    sock.send(encode_message(req))
-    encoded_response = sock.recv(MAX_PACKAGE_LENGTH)
-    answer = decode_message(encoded_response)
+    answer = transport.request(req)
     if RESPONSE in answer and answer[RESPONSE] == 200:
         pass
     else:
@@ -328,9 +642,11 @@ def add_contact(sock, username, contact):
 
 
 @log
-def user_list_request(sock, username):
+def create_users_request(username, version=None, epoch=None):
     """
-    Запрос списка известных пользователей
+    Функция формирует запрос списка известных пользователей.
+    С версией и эпохой базы сервера из прошлой синхронизации сервер вернёт только пользователей,
+    зарегистрированных после неё.
     """
 
     logger.debug(f'Запрос списка известных пользователей {username}')
@@ -339,17 +655,43 @@ def user_list_request(sock, username):
         TIME: time(),
         ACCOUNT_NAME: username
     }
-    sock.send(encode_message(req))
-    encoded_response = sock.recv(MAX_PACKAGE_LENGTH)
-    answer = decode_message(encoded_response)
-    if RESPONSE in answer and answer[RESPONSE] == 202:
-        return answer[LIST_INFO]
-    else:
-        raise ServerError
+    if version is not None:
+        req[VERSION] = version
+    if epoch is not None:
+        req[EPOCH] = epoch
+    return req
 
 
 @log
-def remove_contact(sock, username, contact):
+def history_request(transport, username, peer, cursor=None):
+    """
+    Запрос страницы переписки с пользователем peer из архива сервера.
+    Возвращает (сообщения, курсор для запроса предыдущей страницы или None, если более ранних сообщений нет).
+    """
+
+    req = {
+        ACTION: GET_HISTORY,
+        TIME: time(),
+        USER: username,
+        ACCOUNT_NAME: peer
+    }
+    if cursor is not None:
+        req[CURSOR] = cursor
+    answer = transport.request(req)
+    return process_list_answer(answer), answer.get(CURSOR)
+
+
+@log
+def user_list_request(transport, username):
+    """
+    Запрос списка известных пользователей
+    """
+
+    return process_list_answer(transport.request(create_users_request(username)))
+
+
+@log
+def remove_contact(transport, username, contact):
     """
     Удаление пользователя из контакт-листа
     """
@@ -361,9 +703,7 @@ def remove_contact(sock, username, contact):
         USER: username,
         ACCOUNT_NAME: contact
     }
-    sock.send(encode_message(req))
-    encoded_response = sock.recv(MAX_PACKAGE_LENGTH)
-    answer = decode_message(encoded_response)
+    answer = transport.request(req)
     if RESPONSE in answer and answer[RESPONSE] == 200:
         pass
     else:
@@ -372,27 +712,99 @@ def remove_contact(sock, username, contact):
 
 
 @log
-def database_load(sock, database, username):
+def join_group(transport, username, group):
+    """
+    Вступление в групповой чат
+    """
+
+    logger.debug(f'Вступление в группу {group}')
+    req = {
+        ACTION: JOIN_GROUP,
+        TIME: time(),
+        USER: username,
+        GROUP: group
+    }
+    answer = transport.request(req)
+    if RESPONSE in answer and answer[RESPONSE] == 200:
+        pass
+    else:
+        raise ServerError('Ошибка вступления в группу')
+    print('Удачное вступление в группу.')
+
+
+@log
+def leave_group(transport, username, group):
+    """
+    Выход из группового чата
+    """
+
+    logger.debug(f'Выход из группы {group}')
+    req = {
+        ACTION: LEAVE_GROUP,
+        TIME: time(),
+        USER: username,
+        GROUP: group
+    }
+    answer = transport.request(req)
+    if RESPONSE in answer and answer[RESPONSE] == 200:
+        pass
+    else:
+        raise ServerError('Ошибка выхода из группы')
+    print('Удачный выход из группы.')
+
+
+def open_database(account_name):
+    """
+    Функция открытия базы клиента. Модуль базы импортирует SQLAlchemy – это самая долгая часть запуска клиента,
+    поэтому он загружается не при импорте client.py, а здесь: после отправки приветствия серверу.
+    """
+
+    from client_DB import ClientDB
+    return ClientDB(account_name)
+
+
+@log
+def database_load(transport, database, username):
     """
     Загрузка БД.
+    Запросы списков пользователей и контактов уходят сразу оба, ответы ожидаются вместе – один обмен с сервером.
+    Клиент передаёт версии списков из прошлой синхронизации и получает только изменения после них.
+    Полный список приходит при первой синхронизации, от сервера без версий или если сервер не знает версию клиента:
+    например, база сервера пересоздана, и её эпоха отличается от сохранённой.
     """
 
+    users_version, users_epoch = database.get_version(database.SYNC_USERS)
+    contacts_version, contacts_epoch = database.get_version(database.SYNC_CONTACTS)
     try:
-        users_list = user_list_request(sock, username)
+        users_answer, contacts_answer = transport.request_many((
+            create_users_request(username, users_version or 0, users_epoch),
+            create_contacts_request(username, contacts_version or 0, contacts_epoch)))
+    except ServerError as error:
+        logger.error(f'Ошибка загрузки списков с сервера: {error}')
+        return
+
+    try:
+        users_list = process_list_answer(users_answer)
     except ServerError:
         logger.error('Ошибка запроса списка известных пользователей.')
     else:
-        database.add_users(users_list)
+        if users_answer.get(DELTA) and users_version is not None:
+            database.update_users(users_list, users_answer[VERSION], users_answer.get(EPOCH))
+        else:
+            database.add_users(users_list, users_answer.get(VERSION), users_answer.get(EPOCH))
 
     # Загружаем список контактов
 
     try:
-        contacts_list = contacts_list_request(sock, username)
+        contacts_list = process_list_answer(contacts_answer)
     except ServerError:
         logger.error('Ошибка запроса списка контактов.')
     else:
-        for contact in contacts_list:
-            database.add_contact(contact)
+        if contacts_answer.get(DELTA) and contacts_version is not None:
+            database.update_contacts(contacts_list, contacts_answer.get(REMOVED, []), contacts_answer[VERSION],
+                                     contacts_answer.get(EPOCH))
+        else:
+            database.replace_contacts(contacts_list, contacts_answer.get(VERSION), contacts_answer.get(EPOCH))
 
 
 @log
@@ -401,7 +813,7 @@ def main():
     print('Консольный мессенджер. Клиентский модуль.')
 
     # Загружаем параметры командной строки
-    server_address, server_port, client_name = arg_parser()
+    server_address, server_port, client_name, codec, compression = arg_parser()
 
     # Если имя пользователя не было задано, необходимо запросить пользователя.
     if not client_name:
@@ -414,12 +826,21 @@ def main():
 
     # Инициализация сокета и сообщение серверу о нашем появлении
     try:
-        transport = socket(AF_INET, SOCK_STREAM)
-        transport.settimeout(1)
-        transport.connect((server_address, server_port))
-        transport.send(encode_message(create_presence(client_name)))
-        encoded_response = transport.recv(MAX_PACKAGE_LENGTH)
-        answer = process_response_ans(decode_message(encoded_response))
+        sock = socket(AF_INET, SOCK_STREAM)
+        sock.settimeout(1)
+        sock.connect((server_address, server_port))
+        decoder = FrameDecoder()
+        encoder = FrameEncoder()
+        send_message(sock, create_presence(client_name, codec, compression), encoder)
+        # Пока сервер отвечает на приветствие, в фоновом потоке открывается база клиента.
+        opening = ThreadPoolExecutor(max_workers=1, thread_name_prefix='client-db')
+        database = opening.submit(open_database, client_name)
+        opening.shutdown(wait=False)
+        response = get_message(sock, decoder)
+        answer = process_response_ans(response)
+        # Дальше отправляем сообщения кодеком, который выбрал сервер. Старый сервер кодек не указывает – остаётся JSON.
+        encoder.codec = response.get(CODEC, CODEC_JSON)
+        encoder.compression = response.get(COMPRESSION) == COMPRESSION_ZLIB
 
         logger.info(f'Установлено соединение с сервером. Ответ сервера: {answer}')
         print(f'Установлено соединение с сервером.')
@@ -437,7 +858,13 @@ def main():
             f'Не удалось подключиться к серверу {server_address}:{server_port}, конечный компьютер отверг запрос на подключение.')
         exit(1)
     else:
-        database = ClientDB(client_name)  # Инициализация БД
+        # Дальше с сокетом работает только поток транспорта.
+        # Ответ без идентификатора от сервера, который их поддерживает, – ошибка, не относящаяся к запросам клиента
+        # (например, сообщение в группу, где пользователь не состоит), и она не должна достаться ожидающему запросу.
+        transport = ClientTransport(sock, decoder, encoder, REQUEST_ID in response)
+        transport.start()
+
+        database = database.result()
         database_load(transport, database, client_name)
 
         # Если соединение с сервером установлено корректно, запускаем клиентский процесс приёма сообщений.
@@ -462,4 +889,5 @@ def main():
 
 
 if __name__ == '__main__':
+    use_logger('client')
     main()
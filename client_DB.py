@@ -1,6 +1,6 @@
 import os
 
-from sqlalchemy import create_engine, Table, Column, Integer, String, Text, MetaData, DateTime
+from sqlalchemy import create_engine, Table, Column, Integer, String, Text, MetaData, DateTime, Index, select, text, or_
 from sqlalchemy.orm import mapper, sessionmaker
 from common.variables import *
 import datetime
@@ -11,6 +11,12 @@ class ClientDB:
     Класс – база данных для клиента
     """
 
+    # Списки, синхронизируемые с сервером по версиям
+    SYNC_USERS = 'users'
+    SYNC_CONTACTS = 'contacts'
+    # Сколько последних совпадений ранжирует полнотекстовый поиск
+    SEARCH_WINDOW = 1000
+
     class KnownUsers:
         """
         Отображение известных пользователей
@@ -44,13 +50,16 @@ class ClientDB:
             self.id = None
             self.name = contact
 
-    def __init__(self, name):
-        DB_dir = 'client_DB'
-        if not os.path.exists(DB_dir):
-            os.mkdir(DB_dir)
+    def __init__(self, name, path=None):
+        # path – адрес базы данных для SQLAlchemy, по умолчанию файл пользователя в каталоге client_DB
+        if path is None:
+            DB_dir = 'client_DB'
+            if not os.path.exists(DB_dir):
+                os.mkdir(DB_dir)
+            path = f'sqlite:///{DB_dir}/client_{name}_db.db3'
 
         self.database_engine = create_engine(
-            f'sqlite:///{DB_dir}/client_{name}_db.db3',
+            path,
             echo=False,
             pool_recycle=7200,
             connect_args={
@@ -82,8 +91,36 @@ class ClientDB:
                          Column('name', String, unique=True)
                          )
 
+        # таблица версий списков, полученных от сервера при последней синхронизации, и эпох базы сервера,
+        # к которым они относятся
+        versions = Table('sync_versions', self.metadata,
+                         Column('name', String, primary_key=True),
+                         Column('version', Integer),
+                         Column('epoch', Integer)
+                         )
+
+        # Таблицы нужны и для массовой записи в обход ORM
+        self.users_table = users
+        self.history_table = history
+        self.contacts_table = contacts
+        self.versions_table = versions
+
+        # Версии, сохранённые прежней версией клиента без эпохи, сравнить с базой сервера нельзя:
+        # такая таблица пересоздаётся, и следующая синхронизация получает полные списки.
+        with self.database_engine.begin() as connection:
+            columns = [row[1] for row in connection.exec_driver_sql('PRAGMA table_info(sync_versions)')]
+            if columns and 'epoch' not in columns:
+                connection.exec_driver_sql('DROP TABLE sync_versions')
+
         # создание всех таблиц
         self.metadata.create_all(self.database_engine)
+        # Индексы создаются отдельно: create_all не добавляет их в таблицы, созданные прежними версиями клиента.
+        # Индексы истории – для выборок входящих, исходящих и переписки с одним собеседником по порядку id.
+        for index in (Index('known_users_username', users.c.username),
+                      Index('message_history_from_user_id', history.c.from_user, history.c.id),
+                      Index('message_history_to_user_id', history.c.to_user, history.c.id)):
+            index.create(self.database_engine, checkfirst=True)
+        self.create_search()
 
         # ORM связь классов отображения с соответствующими таблицами
         mapper(self.KnownUsers, users)
@@ -94,19 +131,102 @@ class ClientDB:
         Session = sessionmaker(bind=self.database_engine)
         self.session = Session()
 
-        # очистка таблицы контактов при создании новой сессии
-        self.session.query(self.Contacts).delete()
-        self.session.commit()
+    def create_search(self):
+        """
+        Метод создания полнотекстового индекса истории сообщений (SQLite FTS5).
+        Индекс хранит только слова и ссылается на строки message_history по id, триггеры обновляют его
+        при любом изменении истории. Для базы, созданной прежней версией клиента, индекс заполняется один раз.
+        Имена отправителя и получателя индексируются в шестнадцатеричном виде через представление:
+        так имя целиком – одно слово индекса, и фильтр по собеседнику выполняется самим индексом.
+        """
+
+        with self.database_engine.begin() as connection:
+            if connection.exec_driver_sql("SELECT 1 FROM sqlite_master WHERE name = 'message_search'").first():
+                return
+            connection.exec_driver_sql("CREATE VIEW message_search_content AS SELECT id, message, "
+                                       "hex(from_user) AS from_user, hex(to_user) AS to_user FROM message_history")
+            connection.exec_driver_sql("CREATE VIRTUAL TABLE message_search USING fts5(message, from_user, to_user, "
+                                       "content='message_search_content', content_rowid='id')")
+            insert = ("INSERT INTO message_search (rowid, message, from_user, to_user) "
+                      "VALUES (new.id, new.message, hex(new.from_user), hex(new.to_user));")
+            delete = ("INSERT INTO message_search (message_search, rowid, message, from_user, to_user) "
+                      "VALUES ('delete', old.id, old.message, hex(old.from_user), hex(old.to_user));")
+            connection.exec_driver_sql(f"CREATE TRIGGER message_search_insert AFTER INSERT ON message_history "
+                                       f"BEGIN {insert} END")
+            connection.exec_driver_sql(f"CREATE TRIGGER message_search_delete AFTER DELETE ON message_history "
+                                       f"BEGIN {delete} END")
+            connection.exec_driver_sql(f"CREATE TRIGGER message_search_update AFTER UPDATE ON message_history "
+                                       f"BEGIN {delete} {insert} END")
+            connection.exec_driver_sql("INSERT INTO message_search (message_search) VALUES ('rebuild')")
 
     def add_contact(self, contact):
         """
         Метод добавления контактов
         """
 
-        if not self.session.query(self.Contacts).filter_by(name=contact).count():
-            contact_row = self.Contacts(contact)
-            self.session.add(contact_row)
-            self.session.commit()
+        self.add_contacts((contact,))
+
+    def add_contacts(self, contacts):
+        """
+        Метод добавления списка контактов одной транзакцией.
+        Имя контакта уникально, уже известные контакты пропускаются самой базой без отдельной проверки.
+        """
+
+        self.insert_contacts(contacts)
+        self.session.commit()
+
+    def insert_contacts(self, contacts):
+        """
+        Метод пакетной вставки контактов в текущую транзакцию без дубликатов
+        """
+
+        rows = [{'name': contact} for contact in contacts]
+        if rows:
+            self.session.execute(self.contacts_table.insert().prefix_with('OR IGNORE'), rows)
+
+    def replace_contacts(self, contacts, version=None, epoch=None):
+        """
+        Метод замены списка контактов полным списком с сервера и версией синхронизации одной транзакцией
+        """
+
+        self.session.query(self.Contacts).delete()
+        self.insert_contacts(contacts)
+        self.set_version(self.SYNC_CONTACTS, version, epoch)
+        self.session.commit()
+
+    def update_contacts(self, added, removed, version, epoch=None):
+        """
+        Метод применения изменений списка контактов с сервера и новой версии синхронизации одной транзакцией
+        """
+
+        self.insert_contacts(added)
+        if removed:
+            self.session.query(self.Contacts).filter(self.Contacts.name.in_(removed)). \
+                delete(synchronize_session=False)
+        self.set_version(self.SYNC_CONTACTS, version, epoch)
+        self.session.commit()
+
+    def get_version(self, name):
+        """
+        Метод получения версии списка name из последней синхронизации и эпохи базы сервера, к которой она относится.
+        Возвращает (None, None), если синхронизации не было.
+        """
+
+        row = self.session.execute(select(self.versions_table.c.version, self.versions_table.c.epoch).
+                                   where(self.versions_table.c.name == name)).first()
+        return tuple(row) if row else (None, None)
+
+    def set_version(self, name, version, epoch=None):
+        """
+        Метод записи версии списка и эпохи базы сервера в текущую транзакцию.
+        None – версия неизвестна (сервер без синхронизации).
+        """
+
+        if version is None:
+            self.session.execute(self.versions_table.delete().where(self.versions_table.c.name == name))
+        else:
+            self.session.execute(self.versions_table.insert().prefix_with('OR REPLACE'),
+                                 {'name': name, 'version': version, 'epoch': epoch})
 
     def del_contact(self, contact):
         """
@@ -115,15 +235,30 @@ class ClientDB:
 
         self.session.query(self.Contacts).filter_by(name=contact).delete()
 
-    def add_users(self, users_list):
+    def add_users(self, users_list, version=None, epoch=None):
         """
-        Метод добавления известных пользователей.
+        Метод замены списка известных пользователей.
+        Старый список удаляется, новый записывается одним пакетным insert в той же транзакции, что и версия.
         """
 
         self.session.query(self.KnownUsers).delete()
-        for user in users_list:
-            user_row = self.KnownUsers(user)
-            self.session.add(user_row)
+        rows = [{'username': user} for user in users_list]
+        if rows:
+            self.session.execute(self.users_table.insert(), rows)
+        self.set_version(self.SYNC_USERS, version, epoch)
+        self.session.commit()
+
+    def update_users(self, users_list, version, epoch=None):
+        """
+        Метод добавления новых пользователей с сервера и новой версии синхронизации одной транзакцией.
+        Уже известные пользователи не дублируются.
+        """
+
+        rows = [{'username': user} for user in users_list]
+        if rows:
+            self.session.execute(text('INSERT INTO known_users (username) SELECT :username WHERE NOT EXISTS '
+                                      '(SELECT 1 FROM known_users WHERE username = :username)'), rows)
+        self.set_version(self.SYNC_USERS, version, epoch)
         self.session.commit()
 
     def save_message(self, from_user, to_user, message):
@@ -131,8 +266,19 @@ class ClientDB:
         Метод сохранения сообщений
         """
 
-        message_row = self.MessageHistory(from_user, to_user, message)
-        self.session.add(message_row)
+        self.save_messages(((from_user, to_user, message),))
+
+    def save_messages(self, messages):
+        """
+        Метод сохранения нескольких сообщений одной транзакцией.
+        messages – кортежи (от кого, кому, текст).
+        """
+
+        date = datetime.datetime.now()
+        rows = [{'from_user': from_user, 'to_user': to_user, 'message': message, 'date': date}
+                for from_user, to_user, message in messages]
+        if rows:
+            self.session.execute(self.history_table.insert(), rows)
         self.session.commit()
 
     def get_contacts(self):
@@ -169,15 +315,90 @@ class ClientDB:
         else:
             return False
 
-    def get_history(self, from_who=None, to_who=None):
+    def get_history(self, from_who=None, to_who=None, peer=None, before=None, after=None, limit=None):
         """
-        Метод, возвращающий историю переписки
+        Метод, возвращающий историю переписки в порядке сохранения: кортежи (от кого, кому, текст, дата, id).
+        peer – только переписка с этим пользователем или группой.
+        Страницы выбираются по id сообщения: after – сообщения после него, before – до него,
+        limit – не больше стольких сообщений; без after это последние сообщения до before.
+        Без курсоров и limit возвращается вся история.
         """
 
-        query = self.session.query(self.MessageHistory)
+        history = self.history_table
+        query = select(history.c.from_user, history.c.to_user, history.c.message, history.c.date, history.c.id)
         if from_who:
-            query = query.filter_by(from_user=from_who)
+            query = query.where(history.c.from_user == from_who)
         if to_who:
-            query = query.filter_by(to_user=to_who)
-        return [(history_row.from_user, history_row.to_user, history_row.message, history_row.date)
-                for history_row in query.all()]
+            query = query.where(history.c.to_user == to_who)
+        if peer:
+            query = query.where(or_(history.c.from_user == peer, history.c.to_user == peer))
+        if after is not None:
+            query = query.where(history.c.id > after)
+        if before is not None:
+            query = query.where(history.c.id < before)
+        if limit is not None and after is None:
+            # Последние limit сообщений выбираются с конца и разворачиваются в порядок сохранения.
+            rows = self.session.execute(query.order_by(history.c.id.desc()).limit(limit)).all()
+            rows.reverse()
+        else:
+            rows = self.session.execute(query.order_by(history.c.id).limit(limit)).all()
+        return [tuple(row) for row in rows]
+
+    def iter_history(self, from_who=None, to_who=None, peer=None, page_size=HISTORY_PAGE_SIZE):
+        """
+        Метод, лениво перебирающий историю переписки в порядке сохранения.
+        В памяти находится только одна страница из page_size сообщений, сколько бы их ни было в базе.
+        """
+
+        after = 0
+        while True:
+            page = self.get_history(from_who, to_who, peer, after=after, limit=page_size)
+            yield from page
+            if len(page) < page_size:
+                return
+            after = page[-1][4]
+
+    @staticmethod
+    def search_query(words, peer=None):
+        """
+        Преобразование введённой пользователем строки в запрос FTS5: каждое слово ищется как есть,
+        без операторов FTS5, слово со * на конце – как префикс. Сообщение должно содержать все слова.
+        peer – только сообщения от этого пользователя или ему. Пустая строка – запрос без слов.
+        """
+
+        terms = []
+        for word in words.split():
+            prefix = word.endswith('*')
+            word = word.rstrip('*')
+            if word:
+                terms.append('"' + word.replace('"', '""') + '"' + ('*' if prefix else ''))
+        if not terms:
+            return ''
+        query = f'message : ({" ".join(terms)})'
+        if peer:
+            query += f' AND {{from_user to_user}} : "{peer.encode().hex()}"'
+        return query
+
+    def search_history(self, words, peer=None, limit=HISTORY_PAGE_SIZE):
+        """
+        Метод полнотекстового поиска по истории сообщений.
+        Возвращает не больше limit самых подходящих сообщений (ранжирование bm25 по тексту) кортежами
+        (от кого, кому, текст, дата, id, фрагмент), в фрагменте найденные слова выделены [ ].
+        peer – только переписка с этим пользователем или группой.
+        Ранжируются SEARCH_WINDOW последних совпадений: сортировка всех совпадений частого слова
+        на большой истории занимала бы сотни миллисекунд.
+        """
+
+        query = self.search_query(words, peer)
+        if not query:
+            return []
+        statement = text(
+            'SELECT h.from_user AS from_user, h.to_user AS to_user, h.message AS message, h.date AS date, '
+            "h.id AS id, snippet(message_search, 0, '[', ']', '...', 10) AS snippet "
+            'FROM message_search JOIN message_history AS h ON h.id = message_search.rowid '
+            'WHERE message_search MATCH :query AND message_search.rowid >= '
+            '(SELECT min(rowid) FROM (SELECT rowid FROM message_search WHERE message_search MATCH :query '
+            'ORDER BY rowid DESC LIMIT :window)) '
+            'ORDER BY bm25(message_search, 1.0, 0.0, 0.0) LIMIT :limit').columns(date=DateTime)
+        rows = self.session.execute(statement, {'query': query, 'window': self.SEARCH_WINDOW, 'limit': limit})
+        return [tuple(row) for row in rows]
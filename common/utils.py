@@ -1,12 +1,18 @@
 from sys import path
+from collections import deque
 from json import dumps, loads
-from common.variables import ENCODING
+from struct import Struct, error as StructError
+from zlib import compressobj, decompressobj, Z_SYNC_FLUSH, error as ZlibError
+from common.variables import *
 from errors import IncorrectDataReceivedError, NonDictInputError
 from decos import log
 path.append('../')
 
+# Заголовок кадра: длина полезной нагрузки, беззнаковое 32-битное целое в сетевом порядке байт.
+FRAME_HEADER = Struct('!I')
 
-@log
+
+@log(sample=100)
 def decode_message(encoded_response):
     """
     Функция декодирования сообщения от клиента.
@@ -25,7 +31,7 @@ def decode_message(encoded_response):
         raise IncorrectDataReceivedError
 
 
-@log
+@log(sample=100)
 def encode_message(message):
     """
     Функция кодирования сообщения.
@@ -37,3 +43,323 @@ def encode_message(message):
     js_message = dumps(message)
     encoded_message = js_message.encode(ENCODING)
     return encoded_message
+
+
+# Двоичный кодек. Значение кодируется байтом типа и данными:
+# целые и дробные числа – 8 байт, строки и списки – длина и содержимое, словари – число пар и пары ключ-значение.
+# Целые вне диапазона int64 (в JSON их может прислать любой клиент) – длина и байты в дополнительном коде.
+# Ключи протокола передаются одним байтом-идентификатором, прочие ключи – байтом 0xFF и строкой.
+TAG_NONE, TAG_TRUE, TAG_FALSE, TAG_INT, TAG_FLOAT, TAG_STR, TAG_LIST, TAG_DICT, TAG_BIGINT = range(9)
+# Длины до 254 занимают один байт, длинные – байт 0xFF и 4 байта.
+LONG_LENGTH = 0xFF
+INT64 = Struct('!q')
+INT64_MIN, INT64_MAX = -2 ** 63, 2 ** 63 - 1
+FLOAT64 = Struct('!d')
+UINT32 = Struct('!I')
+
+# Идентификаторы ключей протокола. Список можно только дополнять, не меняя порядок существующих ключей.
+BINARY_KEYS = (ACTION, TIME, USER, ACCOUNT_NAME, SENDER, DESTINATION, RESPONSE, ERROR, MESSAGE_TEXT, LIST_INFO,
+               GROUP, CODECS, CODEC, REQUEST_ID, VERSION, DELTA, REMOVED, CURSOR, LIMIT, EPOCH)
+BINARY_KEY_IDS = {key: bytes((key_id,)) for key_id, key in enumerate(BINARY_KEYS)}
+
+
+def _pack_length(length, out):
+    if length < LONG_LENGTH:
+        out.append(length)
+    else:
+        out.append(LONG_LENGTH)
+        out += UINT32.pack(length)
+
+
+def _pack_str(value, out):
+    data = value.encode(ENCODING)
+    _pack_length(len(data), out)
+    out += data
+
+
+def _pack_value(value, out):
+    # bool проверяется раньше int, так как является его подклассом.
+    if isinstance(value, str):
+        out.append(TAG_STR)
+        _pack_str(value, out)
+    elif value is None:
+        out.append(TAG_NONE)
+    elif value is True:
+        out.append(TAG_TRUE)
+    elif value is False:
+        out.append(TAG_FALSE)
+    elif isinstance(value, int):
+        if INT64_MIN <= value <= INT64_MAX:
+            out.append(TAG_INT)
+            out += INT64.pack(value)
+        else:
+            data = value.to_bytes(value.bit_length() // 8 + 1, 'big', signed=True)
+            out.append(TAG_BIGINT)
+            _pack_length(len(data), out)
+            out += data
+    elif isinstance(value, float):
+        out.append(TAG_FLOAT)
+        out += FLOAT64.pack(value)
+    elif isinstance(value, dict):
+        out.append(TAG_DICT)
+        _pack_length(len(value), out)
+        for key, item in value.items():
+            key_id = BINARY_KEY_IDS.get(key)
+            if key_id is None:
+                out.append(LONG_LENGTH)
+                _pack_str(key, out)
+            else:
+                out += key_id
+            _pack_value(item, out)
+    elif isinstance(value, (list, tuple)):
+        out.append(TAG_LIST)
+        _pack_length(len(value), out)
+        for item in value:
+            _pack_value(item, out)
+    else:
+        raise TypeError(f'Тип {type(value).__name__} не поддерживается двоичным кодеком')
+
+
+def _unpack_length(data, pos):
+    length = data[pos]
+    if length < LONG_LENGTH:
+        return length, pos + 1
+    return UINT32.unpack_from(data, pos + 1)[0], pos + 5
+
+
+def _unpack_str(data, pos):
+    length, pos = _unpack_length(data, pos)
+    end = pos + length
+    if end > len(data):
+        raise IncorrectDataReceivedError
+    return data[pos:end].decode(ENCODING), end
+
+
+def _unpack_value(data, pos):
+    tag = data[pos]
+    pos += 1
+    if tag == TAG_STR:
+        return _unpack_str(data, pos)
+    elif tag == TAG_INT:
+        return INT64.unpack_from(data, pos)[0], pos + 8
+    elif tag == TAG_FLOAT:
+        return FLOAT64.unpack_from(data, pos)[0], pos + 8
+    elif tag == TAG_BIGINT:
+        length, pos = _unpack_length(data, pos)
+        end = pos + length
+        if end > len(data):
+            raise IncorrectDataReceivedError
+        return int.from_bytes(data[pos:end], 'big', signed=True), end
+    elif tag == TAG_DICT:
+        count, pos = _unpack_length(data, pos)
+        result = {}
+        for _ in range(count):
+            key_id = data[pos]
+            if key_id == LONG_LENGTH:
+                key, pos = _unpack_str(data, pos + 1)
+            else:
+                key = BINARY_KEYS[key_id]
+                pos += 1
+            result[key], pos = _unpack_value(data, pos)
+        return result, pos
+    elif tag == TAG_LIST:
+        count, pos = _unpack_length(data, pos)
+        result = []
+        for _ in range(count):
+            item, pos = _unpack_value(data, pos)
+            result.append(item)
+        return result, pos
+    elif tag == TAG_NONE:
+        return None, pos
+    elif tag == TAG_TRUE:
+        return True, pos
+    elif tag == TAG_FALSE:
+        return False, pos
+    raise IncorrectDataReceivedError
+
+
+def encode_binary(message):
+    """
+    Функция кодирования сообщения двоичным кодеком.
+    Если сообщение не словарь – бросает исключение.
+    """
+
+    if not isinstance(message, dict):
+        raise NonDictInputError
+    out = bytearray()
+    _pack_value(message, out)
+    return bytes(out)
+
+
+def decode_binary(encoded_message):
+    """
+    Функция декодирования сообщения двоичным кодеком.
+    Бросает исключение, если данные повреждены или сообщение не словарь.
+    """
+
+    try:
+        message, pos = _unpack_value(encoded_message, 0)
+    except (IndexError, StructError, UnicodeDecodeError):
+        raise IncorrectDataReceivedError
+    if not isinstance(message, dict) or pos != len(encoded_message):
+        raise IncorrectDataReceivedError
+    return message
+
+
+# Функции кодирования по названию кодека.
+ENCODERS = {
+    CODEC_JSON: encode_message,
+    CODEC_BINARY: encode_binary,
+}
+
+
+def decode_payload(payload):
+    """
+    Функция декодирования полезной нагрузки кадра.
+    Кодек определяется по первому байту: JSON-объект всегда начинается с '{', двоичный словарь – с TAG_DICT.
+    Поэтому смена кодека после согласования не зависит от того, какие кадры уже находятся в пути.
+    """
+
+    if payload[:1] == b'{':
+        return decode_message(payload)
+    return decode_binary(payload)
+
+
+def pack_frame(payload):
+    """
+    Функция упаковки закодированного сообщения в кадр: заголовок с длиной и полезная нагрузка.
+    """
+
+    return FRAME_HEADER.pack(len(payload)) + payload
+
+
+class FrameDecoder:
+    """
+    Инкрементальный декодер кадров, один на соединение.
+    Принимает байты в том виде, в каком их вернул recv, и возвращает все полностью принятые сообщения.
+    Неполный хвост кадра остаётся в буфере до следующего вызова feed.
+    """
+
+    def __init__(self, max_frame_length=MAX_FRAME_LENGTH):
+        self.buffer = bytearray()
+        self.max_frame_length = max_frame_length
+        # Сообщения, принятые сверх запрошенного функцией get_message.
+        self.backlog = deque()
+        # Поток распаковки zlib, общий для всех сжатых кадров соединения. Создаётся при первом сжатом кадре.
+        self.decompressor = None
+
+    def feed(self, data):
+        """
+        Метод добавляет принятые байты в буфер и возвращает список готовых сообщений (возможно, пустой).
+        Бросает IncorrectDataReceivedError, если заявленная длина кадра превышает допустимую
+        или кадр не удалось декодировать. Некорректный кадр удаляется из буфера, а сообщения,
+        принятые до него тем же вызовом, сохраняются в backlog.
+        """
+
+        buffer = self.buffer
+        buffer += data
+        messages = []
+        offset = 0
+        try:
+            while len(buffer) - offset >= FRAME_HEADER_LENGTH:
+                header, = FRAME_HEADER.unpack_from(buffer, offset)
+                length = header & ~FRAME_COMPRESSED
+                if length > self.max_frame_length:
+                    raise IncorrectDataReceivedError
+                end = offset + FRAME_HEADER_LENGTH + length
+                if len(buffer) < end:
+                    break
+                payload = bytes(buffer[offset + FRAME_HEADER_LENGTH:end])
+                # Кадр считается обработанным до декодирования: ошибка в нём не должна повторяться при каждом вызове.
+                offset = end
+                if header & FRAME_COMPRESSED:
+                    payload = self.decompress(payload)
+                messages.append(decode_payload(payload))
+        except (IncorrectDataReceivedError, ValueError) as err:
+            # ValueError – повреждённый JSON или текст не в UTF-8.
+            self.backlog.extend(messages)
+            if isinstance(err, ValueError):
+                raise IncorrectDataReceivedError from err
+            raise
+        finally:
+            # Обработанные кадры удаляем из буфера один раз, а не после каждого кадра.
+            if offset:
+                del buffer[:offset]
+        return messages
+
+    def decompress(self, payload):
+        """
+        Метод распаковки сжатого кадра. Распакованные данные тоже ограничены максимальной длиной кадра.
+        """
+
+        if self.decompressor is None:
+            self.decompressor = decompressobj()
+        try:
+            payload = self.decompressor.decompress(payload, self.max_frame_length)
+        except ZlibError:
+            raise IncorrectDataReceivedError
+        if self.decompressor.unconsumed_tail:
+            raise IncorrectDataReceivedError
+        return payload
+
+
+class FrameEncoder:
+    """
+    Кодировщик исходящих кадров, один на соединение.
+    Хранит кодек и сжатие, согласованные при подключении. До согласования используется JSON без сжатия.
+    Сжимаются только кадры не меньше порога, короткие сообщения отправляются как есть.
+    """
+
+    def __init__(self, codec=CODEC_JSON, compression=False, threshold=COMPRESSION_THRESHOLD):
+        self.codec = codec
+        self.compression = compression
+        self.threshold = threshold
+        # Поток сжатия zlib на всё соединение: словарь повторяющихся ключей и имён переходит из кадра в кадр.
+        self.compressor = None
+
+    def encode(self, message):
+        """
+        Метод кодирования сообщения в кадр согласованным кодеком.
+        """
+
+        return self.frame(ENCODERS[self.codec](message))
+
+    def frame(self, payload, plain_frame=None):
+        """
+        Метод упаковки закодированного сообщения в кадр, при необходимости со сжатием.
+        plain_frame – уже упакованный несжатый кадр для этой полезной нагрузки, если он есть.
+        """
+
+        if not self.compression or len(payload) < self.threshold:
+            return plain_frame or pack_frame(payload)
+        if self.compressor is None:
+            self.compressor = compressobj(COMPRESSION_LEVEL)
+        # Z_SYNC_FLUSH завершает кадр целиком, не сбрасывая накопленный словарь потока.
+        data = self.compressor.compress(payload) + self.compressor.flush(Z_SYNC_FLUSH)
+        return FRAME_HEADER.pack(len(data) | FRAME_COMPRESSED) + data
+
+
+def send_message(sock, message, encoder=None):
+    """
+    Функция кодирования и отправки сообщения одним кадром.
+    Без кодировщика соединения сообщение кодируется в JSON.
+    """
+
+    if encoder is None:
+        sock.sendall(pack_frame(encode_message(message)))
+    else:
+        sock.sendall(encoder.encode(message))
+
+
+def get_message(sock, decoder):
+    """
+    Функция приёма одного сообщения из сокета.
+    Лишние сообщения, пришедшие тем же recv, сохраняются в декодере и возвращаются следующими вызовами.
+    """
+
+    while not decoder.backlog:
+        data = sock.recv(MAX_PACKAGE_LENGTH)
+        if not data:
+            raise ConnectionResetError
+        decoder.backlog.extend(decoder.feed(data))
+    return decoder.backlog.popleft()
@@ -1,20 +1,84 @@
 """Константы"""
-from logging import DEBUG
+from os import environ
 
 # Порт по умолчанию для сетевого dpfbvjltqcndbz
 DEFAULT_PORT = 7777
 # IP адрес по умолчанию для подключения клиента
 DEFAULT_IP_ADDRESS = '127.0.0.1'
-# Максимальная очередь подключений
-MAX_CONNECTIONS = 5
-# Максимальная длинна сообщения в байтах
-MAX_PACKAGE_LENGTH = 1024
+# Максимальная очередь подключений (backlog слушающего сокета), рассчитана на одновременное переподключение клиентов
+MAX_CONNECTIONS = 1024
+# Размер блока, читаемого из сокета за один вызов recv (может содержать несколько кадров)
+MAX_PACKAGE_LENGTH = 64 * 1024
+# Размер заголовка кадра (длина полезной нагрузки, big-endian uint32)
+FRAME_HEADER_LENGTH = 4
+# Максимальный размер полезной нагрузки одного кадра в байтах
+MAX_FRAME_LENGTH = 16 * 1024 * 1024
+# Старший бит заголовка кадра – признак сжатой полезной нагрузки
+FRAME_COMPRESSED = 0x80000000
+# Сжимаются только кадры с полезной нагрузкой не меньше порога, байт
+COMPRESSION_THRESHOLD = 1024
+# Уровень сжатия zlib
+COMPRESSION_LEVEL = 6
+# Исходящий буфер соединения: верхняя и нижняя отметки заполнения в байтах.
+# Выше верхней отметки к новым сообщениям применяется политика переполнения, ниже нижней – буфер снова свободен.
+OUTBOUND_HIGH_WATERMARK = 1024 * 1024
+OUTBOUND_LOW_WATERMARK = 256 * 1024
+# Политики переполнения исходящего буфера:
+# drop - отбросить сообщение, disconnect - отключить клиента,
+# spill - сохранить во временный файл и отправить, когда клиент разгрузит буфер.
+OVERFLOW_DROP = 'drop'
+OVERFLOW_DISCONNECT = 'disconnect'
+OVERFLOW_SPILL = 'spill'
+OUTBOUND_OVERFLOW_POLICY = OVERFLOW_SPILL
+# Максимальный объём данных во временном файле одного клиента, при превышении клиент отключается
+OUTBOUND_SPILL_LIMIT = 64 * 1024 * 1024
 # Кодировка проекта
 ENCODING = 'utf-8'
-# Текущий уровень логирования
-LOGGING_LEVEL = DEBUG
+# Текущий уровень логирования, задаётся переменной окружения LOG_LEVEL (DEBUG, INFO, WARNING, ERROR)
+LOGGING_LEVEL = environ.get('LOG_LEVEL', 'INFO').upper()
+# Наибольшее число записей в очереди логов, ожидающих записи фоновым потоком. Лишние записи отбрасываются.
+LOG_QUEUE_SIZE = 10000
+# Число рабочих процессов кластера по умолчанию
+CLUSTER_WORKERS = 4
+# Число виртуальных узлов каждого процесса на кольце согласованного хеширования
+CLUSTER_VIRTUAL_NODES = 64
 # База данных:
 SERVER_DATABASE = 'sqlite:///server_db.db3'
+# Настройки SQLite, применяемые при каждом подключении к базе данных сервера (PRAGMA имя = значение):
+# журнал WAL - чтение не блокирует запись, synchronous NORMAL - в режиме WAL fsync только при контрольной точке,
+# cache_size - кеш страниц в КиБ (отрицательное значение), mmap_size - отображение файла в память, байт,
+# busy_timeout - ожидание блокировки другим процессом (режим кластера), мс
+SERVER_DATABASE_PROFILE = {
+    'journal_mode': 'WAL',
+    'synchronous': 'NORMAL',
+    'cache_size': -64000,
+    'mmap_size': 256 * 1024 * 1024,
+    'busy_timeout': 5000,
+}
+# Число подключений к файлу базы данных сервера в пуле
+DB_POOL_SIZE = 5
+# Число потоков, выполняющих запросы к базе данных вне цикла сервера (0 - запросы выполняет сам цикл)
+DB_WORKERS = 2
+# Отложенная запись в базу данных сервера: sync - фиксировать каждое изменение сразу, batch - пакетами
+DB_DURABILITY_SYNC = 'sync'
+DB_DURABILITY_BATCH = 'batch'
+DB_DURABILITY = DB_DURABILITY_BATCH
+# Пакет записывается, когда набирается столько изменений
+DB_BATCH_SIZE = 500
+# или когда с первого незаписанного изменения прошло столько секунд
+DB_FLUSH_INTERVAL = 1.0
+# Число пар имя - id пользователя в кеше базы данных сервера
+USER_ID_CACHE_SIZE = 10000
+# Сколько секунд клиент ждёт ответа сервера на запрос
+REQUEST_TIMEOUT = 5
+# Число сообщений истории на одной странице клиента
+HISTORY_PAGE_SIZE = 20
+# Наибольшее число сообщений архива сервера, которое можно запросить одной страницей
+HISTORY_PAGE_LIMIT = 100
+# Срок хранения сообщений для пользователей не в сети, секунд
+OFFLINE_MESSAGE_TTL = 7 * 24 * 60 * 60
+# Как часто сервер удаляет сообщения для пользователей не в сети с истёкшим сроком хранения, секунд
+OFFLINE_PURGE_INTERVAL = 60 * 60
 
 # Протокол JIM основные ключи:
 ACTION = 'action'
@@ -36,6 +100,31 @@ LIST_INFO = 'data_list'
 REMOVE_CONTACT = 'remove'
 ADD_CONTACT = 'add'
 USERS_REQUEST = 'get_users'
+GROUP = 'group'
+JOIN_GROUP = 'join'
+LEAVE_GROUP = 'leave'
+GROUP_MESSAGE = 'group_message'
+CODECS = 'codecs'
+CODEC = 'codec'
+COMPRESSION = 'compression'
+# Необязательный идентификатор запроса, сервер возвращает его в ответе
+REQUEST_ID = 'request_id'
+# Синхронизация списков: версия, известная клиенту (в ответе – текущая версия сервера),
+# признак ответа только с изменениями, список удалённых элементов и эпоха базы сервера, к которой относится версия
+VERSION = 'version'
+DELTA = 'delta'
+REMOVED = 'removed'
+EPOCH = 'epoch'
+# Архив сообщений на сервере: запрос страницы переписки, курсор страницы [время, id] и число сообщений на странице
+GET_HISTORY = 'get_history'
+CURSOR = 'cursor'
+LIMIT = 'limit'
+
+# Кодеки сообщений: json - по умолчанию, bin - компактный двоичный с короткими идентификаторами ключей
+CODEC_JSON = 'json'
+CODEC_BINARY = 'bin'
+# Алгоритм сжатия кадров
+COMPRESSION_ZLIB = 'zlib'
 
 # Словари - ответы:
 # 200
@@ -1,22 +1,87 @@
-import sys
-import logs.config_server_log
-import logs.config_client_log
-from logging import getLogger
+from functools import wraps
+from itertools import count
+from logging import getLogger, Logger, DEBUG
+from time import perf_counter
 
-# метод определения модуля, источника запуска.
-if sys.argv[0].find('client') == -1:
-    # если не клиент то сервер!
-    logger = getLogger('server')
-else:
-    # ну, раз не сервер, то клиент
-    logger = getLogger('client')
+# Логгер, в который пишут декорированные функции. Точка входа (клиент или сервер) назначает свой через use_logger,
+# до этого записи уходят в логгер модуля без обработчиков, и отладочные записи отключены.
+logger = getLogger(__name__)
 
+# Статистика времени выполнения функций, декорированных с timing=True: полное имя функции -> CallStats
+TIMINGS = dict()
 
-def log(func_to_log):
+
+def use_logger(name):
+    """
+    Назначение логгера для всех декорированных функций: имя логгера или сам логгер
+    """
+
+    global logger
+    logger = name if isinstance(name, Logger) else getLogger(name)
+
+
+class CallStats:
+    """
+    Накопленное время выполнения одной функции: число вызовов, суммарное и наибольшее время в секундах
+    """
+
+    __slots__ = ('name', 'calls', 'total', 'max')
+
+    def __init__(self, name):
+        self.name = name
+        self.calls = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, elapsed):
+        self.calls += 1
+        self.total += elapsed
+        if elapsed > self.max:
+            self.max = elapsed
+
+    def __repr__(self):
+        average = self.total / self.calls * 1e6 if self.calls else 0
+        return f'{self.name}: вызовов {self.calls}, в среднем {average:.1f} мкс, наибольшее {self.max * 1e6:.1f} мкс'
+
+
+def log(func_to_log=None, *, sample=1, timing=False):
+    """
+    Декоратор отладочного логирования вызовов: имя функции, параметры и время выполнения.
+    Пока уровень DEBUG у логгера выключен, параметры не форматируются и время не замеряется:
+    обёртка добавляет к вызову только проверку уровня.
+    sample – записывать только каждый sample-й вызов, для часто вызываемых функций.
+    timing – всегда собирать статистику времени выполнения в TIMINGS, даже без логирования.
+    Применяется как @log или @log(sample=100, timing=True).
+    """
+
+    if func_to_log is None:
+        return lambda func: log(func, sample=sample, timing=timing)
+
+    stats = None
+    if timing:
+        name = f'{func_to_log.__module__}.{func_to_log.__qualname__}'
+        stats = TIMINGS[name] = CallStats(name)
+    # Номер вызова для выборки; next() у count не прерывается другими потоками.
+    calls = count(1)
+
+    @wraps(func_to_log)
     def log_saver(*args, **kwargs):
-        logger.debug(
-            f'Была вызвана функция {func_to_log.__name__} c параметрами {args} , {kwargs}. Вызов из модуля {func_to_log.__module__}')
-        ret = func_to_log(*args, **kwargs)
-        return ret
+        if not logger.isEnabledFor(DEBUG) or (sample > 1 and next(calls) % sample):
+            if stats is None:
+                return func_to_log(*args, **kwargs)
+            start = perf_counter()
+            try:
+                return func_to_log(*args, **kwargs)
+            finally:
+                stats.add(perf_counter() - start)
+        start = perf_counter()
+        try:
+            return func_to_log(*args, **kwargs)
+        finally:
+            elapsed = perf_counter() - start
+            if stats is not None:
+                stats.add(elapsed)
+            logger.debug('Была вызвана функция %s c параметрами %r , %r. Вызов из модуля %s. Время выполнения %.1f мкс',
+                         func_to_log.__name__, args, kwargs, func_to_log.__module__, elapsed * 1e6, stacklevel=2)
 
     return log_saver
@@ -2,6 +2,7 @@ import sys
 import os
 from logging import Formatter, StreamHandler, ERROR, FileHandler, getLogger
 from common.variables import LOGGING_LEVEL, ENCODING
+from logs.log_queue import QueueLogging
 sys.path.append('../')
 
 # создаём формировщик логов (formatter):
@@ -18,10 +19,9 @@ STREAM_HANDLER.setLevel(ERROR)
 LOG_FILE = FileHandler(PATH, encoding=ENCODING)
 LOG_FILE.setFormatter(CLIENT_FORMATTER)
 
-# создаём регистратор и настраиваем его
+# создаём регистратор и настраиваем его: записи идут через очередь, в файл и на экран их пишет фоновый поток
 LOGGER = getLogger('client')
-LOGGER.addHandler(STREAM_HANDLER)
-LOGGER.addHandler(LOG_FILE)
+LOG_QUEUE = QueueLogging(LOGGER, (STREAM_HANDLER, LOG_FILE))
 LOGGER.setLevel(LOGGING_LEVEL)
 
 # отладка
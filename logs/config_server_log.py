@@ -3,6 +3,7 @@ import os
 from logging import Formatter, StreamHandler, handlers, getLogger, ERROR
 
 from common.variables import LOGGING_LEVEL, ENCODING
+from logs.log_queue import QueueLogging
 
 sys.path.append('../')
 
@@ -20,10 +21,9 @@ STREAM_HANDLER.setLevel(ERROR)
 LOG_FILE = handlers.TimedRotatingFileHandler(PATH, encoding=ENCODING, interval=1, when='D')
 LOG_FILE.setFormatter(SERVER_FORMATTER)
 
-# создаём регистратор и настраиваем его
+# создаём регистратор и настраиваем его: записи идут через очередь, в файл и на экран их пишет фоновый поток
 LOGGER = getLogger('server')
-LOGGER.addHandler(STREAM_HANDLER)
-LOGGER.addHandler(LOG_FILE)
+LOG_QUEUE = QueueLogging(LOGGER, (STREAM_HANDLER, LOG_FILE))
 LOGGER.setLevel(LOGGING_LEVEL)
 
 # отладка
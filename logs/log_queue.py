@@ -0,0 +1,101 @@
+"""Неблокирующая запись логов: записи кладутся в очередь в памяти, в файл и на экран их пишет фоновый поток"""
+
+import os
+import atexit
+from logging import makeLogRecord, WARNING
+from logging.handlers import QueueHandler, QueueListener
+from queue import Queue, Full
+
+from common.variables import LOG_QUEUE_SIZE
+
+
+class DroppingQueueHandler(QueueHandler):
+    """
+    Обработчик, который кладёт записи в ограниченную очередь и никогда не ждёт.
+    При переполнении очереди запись отбрасывается и учитывается в счётчике dropped,
+    о потерянных записях сообщает предупреждение, которое идёт следом за первой поместившейся записью.
+    """
+
+    def __init__(self, queue):
+        super().__init__(queue)
+        self.dropped = 0
+        self.reported = 0
+
+    def prepare(self, record):
+        # Поток записи работает в этом же процессе, поэтому запись не копируется и не форматируется целиком,
+        # как в QueueHandler. Сообщение собирается сразу: аргументы могут измениться, пока запись ждёт в очереди.
+        # Исключение форматирует поток записи.
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+    def enqueue(self, record):
+        # Handler.handle вызывает emit под блокировкой обработчика, поэтому счётчики не требуют своей.
+        try:
+            self.queue.put_nowait(record)
+        except Full:
+            self.dropped += 1
+            return
+        if self.dropped != self.reported:
+            lost = self.dropped - self.reported
+            try:
+                self.queue.put_nowait(makeLogRecord({
+                    'name': record.name, 'levelno': WARNING, 'levelname': 'WARNING',
+                    'filename': os.path.basename(__file__),
+                    'msg': f'Очередь логов переполнена, потеряно записей: {lost}, всего: {self.dropped}'}))
+            except Full:
+                return
+            self.reported = self.dropped
+
+
+class BlockingSentinelListener(QueueListener):
+    """
+    Поток записи логов. Признак остановки ставится в очередь с ожиданием:
+    в заполненную очередь put_nowait его бы не поставил, и записи в очереди потерялись бы.
+    """
+
+    def enqueue_sentinel(self):
+        self.queue.put(self._sentinel)
+
+
+class QueueLogging:
+    """
+    Подключение логгера к обработчикам через очередь: в потоке, который пишет в лог,
+    остаётся только постановка записи в очередь. Поток записи запускается сразу,
+    останавливается при выходе из программы, дописав очередь.
+    После fork поток в дочернем процессе не существует, поэтому дочерний процесс
+    получает новую очередь и свой поток записи. В процессах multiprocessing atexit не выполняется,
+    такой процесс должен сам вызвать stop перед завершением.
+    """
+
+    def __init__(self, logger, handlers, size=LOG_QUEUE_SIZE):
+        self.handlers = handlers
+        self.handler = DroppingQueueHandler(Queue(size))
+        self.listener = None
+        logger.addHandler(self.handler)
+        self.start()
+        atexit.register(self.stop)
+        os.register_at_fork(after_in_child=self.restart)
+
+    def start(self):
+        self.listener = BlockingSentinelListener(self.handler.queue, *self.handlers, respect_handler_level=True)
+        self.listener.start()
+
+    def stop(self):
+        """
+        Запись оставшихся в очереди записей и остановка потока записи
+        """
+
+        if self.listener is not None:
+            self.listener.stop()
+            self.listener = None
+
+    def restart(self):
+        """
+        Новая очередь и поток записи в дочернем процессе: очередь родителя могла остаться
+        заблокированной его потоком записи в момент fork
+        """
+
+        self.handler.queue = Queue(self.handler.queue.maxsize)
+        self.handler.dropped = self.handler.reported = 0
+        self.start()
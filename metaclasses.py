@@ -1,4 +1,64 @@
-import dis
+import os
+import sys
+from zlib import crc32, adler32
+
+# Файл отпечатков классов, уже прошедших проверку метаклассом. Разбор байт-кода всех методов – заметная часть
+# запуска клиента и сервера, а код классов между запусками обычно не меняется.
+VERIFIED_CACHE = os.path.join(os.path.dirname(os.path.abspath(__file__)), '__pycache__', 'verified_classes')
+# Отпечатки, загруженные из файла, – при первой проверке
+verified = None
+
+
+def class_digest(verifier, clsdict):
+    """
+    Отпечаток класса для кеша проверок: код правил метакласса и всё, что разбирает проверка, – байт-код
+    и имена каждой функции класса, строки словаря класса (в том числе его полное имя).
+    """
+
+    parts = [type(verifier).__name__.encode(), type(verifier).__init__.__code__.co_code,
+             repr(type(verifier).__init__.__code__.co_consts).encode()]
+    for name, value in clsdict.items():
+        parts.append(name.encode())
+        value = getattr(value, '__func__', value)
+        code = getattr(value, '__code__', None)
+        if code is not None:
+            parts.append(code.co_code)
+            parts.append(' '.join(code.co_names).encode())
+        elif isinstance(value, str):
+            parts.append(value.encode(errors='surrogatepass'))
+    data = b'\0'.join(parts)
+    return f'{crc32(data):08x}{adler32(data):08x}{len(data):x}'
+
+
+def is_verified(digest):
+    """
+    Проверка, что класс с таким отпечатком уже проходил проверку
+    """
+
+    global verified
+    if verified is None:
+        try:
+            with open(VERIFIED_CACHE, encoding='ascii') as file:
+                verified = set(file.read().split())
+        except (OSError, ValueError):
+            verified = set()
+    return digest in verified
+
+
+def remember(digest):
+    """
+    Запись отпечатка класса, прошедшего проверку. Кеш не сохраняется, если каталог недоступен для записи
+    или запись байт-кода отключена (python -B).
+    """
+
+    verified.add(digest)
+    if sys.dont_write_bytecode:
+        return
+    try:
+        with open(VERIFIED_CACHE, 'a', encoding='ascii') as file:
+            file.write(digest + '\n')
+    except OSError:
+        pass
 
 
 class ServerVerifier(type):
@@ -7,6 +67,12 @@ class ServerVerifier(type):
     """
 
     def __init__(self, clsname, bases, clsdict):
+        # Класс, код которого не менялся с прошлой проверки, не разбирается повторно.
+        digest = class_digest(self, clsdict)
+        if is_verified(digest):
+            super().__init__(clsname, bases, clsdict)
+            return
+        import dis
 
         # Список методов, которые используются в функциях класса:
         methods = []
@@ -41,6 +107,7 @@ class ServerVerifier(type):
         # Если сокет не инициализировался константами SOCK_STREAM(TCP) AF_INET(IPv4), тоже исключение.
         if not ('SOCK_STREAM' in attrs or 'SOCK_STREAM' in methods and 'AF_INET' in attrs or 'AF_INET' in methods):
             raise TypeError('Некорректная инициализация сокета.')
+        remember(digest)
         # Обязательно вызываем конструктор предка:
         super().__init__(clsname, bases, clsdict)
 
@@ -51,8 +118,17 @@ class ClientVerifier(type):
     """
 
     def __init__(self, clsname, bases, clsdict):
+        # Класс, код которого не менялся с прошлой проверки, не разбирается повторно.
+        digest = class_digest(self, clsdict)
+        if is_verified(digest):
+            super().__init__(clsname, bases, clsdict)
+            return
+        import dis
+
         # Список методов, которые используются в функциях класса:
         methods = []
+        # Атрибуты, используемые в функциях классов
+        attrs = []
         for func in clsdict:
             # Пробуем
             try:
@@ -66,13 +142,20 @@ class ClientVerifier(type):
                     if i.opname == 'LOAD_GLOBAL':
                         if i.argval not in methods:
                             methods.append(i.argval)
+                    elif i.opname == 'LOAD_ATTR':
+                        if i.argval not in attrs:
+                            attrs.append(i.argval)
         # Если обнаружено использование недопустимого метода accept, listen, socket бросаем исключение:
         for command in ('accept', 'listen', 'socket'):
             if command in methods:
                 raise TypeError('В классе обнаружено использование запрещённого метода')
         # Вызов get_message или send_message из utils считаем корректным использованием сокетов
-        if 'decode_message' in methods or 'encode_message' in methods:
-            pass
+        for command in ('decode_message', 'encode_message', 'get_message', 'send_message'):
+            if command in methods:
+                break
         else:
-            raise TypeError('Отсутствуют вызовы функций, работающих с сокетами.')
+            # Как и обращение к транспорту клиента, который сам работает с сокетом
+            if 'transport' not in attrs:
+                raise TypeError('Отсутствуют вызовы функций, работающих с сокетами.')
+        remember(digest)
         super().__init__(clsname, bases, clsdict)
@@ -1,15 +1,19 @@
 import sys
+import asyncio
 from argparse import ArgumentParser
+from functools import partial
 from logging import getLogger
-from select import select
-from socket import socket, AF_INET, SOCK_STREAM
+from selectors import DefaultSelector, EVENT_READ, EVENT_WRITE
+from signal import signal, SIGTERM, SIG_IGN
+from struct import error as StructError
+from socket import socket, AF_INET, SOCK_STREAM, IPPROTO_TCP, TCP_NODELAY
+from tempfile import TemporaryFile
 from common.variables import *
 from common.utils import *
 import logs.config_server_log
-from decos import log
+from decos import log, use_logger
 from descrptrs import Port
 from metaclasses import ServerVerifier
-from server_DB import ServerDB
 
 # Инициализация логирования сервера.
 logger = getLogger('server')
@@ -23,16 +27,183 @@ def arg_parser():
     parser = ArgumentParser()
     parser.add_argument('-p', default=DEFAULT_PORT, type=int, nargs='?')
     parser.add_argument('-a', default='', nargs='?')
+    parser.add_argument('-e', '--engine', default='sync', choices=('sync', 'asyncio'))
+    parser.add_argument('--overflow', default=OUTBOUND_OVERFLOW_POLICY,
+                        choices=(OVERFLOW_DROP, OVERFLOW_DISCONNECT, OVERFLOW_SPILL))
+    parser.add_argument('-w', '--workers', default=0, type=int, nargs='?', const=CLUSTER_WORKERS)
+    parser.add_argument('--durability', default=DB_DURABILITY, choices=(DB_DURABILITY_SYNC, DB_DURABILITY_BATCH))
+    parser.add_argument('--db-workers', default=DB_WORKERS, type=int)
     namespace = parser.parse_args(sys.argv[1:])
     listen_address = namespace.a
     listen_port = namespace.p
-    return listen_address, listen_port
+    engine = namespace.engine
+    overflow_policy = namespace.overflow
+    workers = namespace.workers
+    durability = namespace.durability
+    db_workers = namespace.db_workers
+    return listen_address, listen_port, engine, overflow_policy, workers, durability, db_workers
+
+
+class SpillFile:
+    """
+    Временный файл для данных, не поместившихся в исходящий буфер соединения (политика spill).
+    Данные читаются в том же порядке, в котором были записаны.
+    """
+
+    def __init__(self):
+        self.file = TemporaryFile()
+        self.read_pos = 0
+        self.write_pos = 0
+
+    def __len__(self):
+        return self.write_pos - self.read_pos
+
+    def write(self, data):
+        self.file.seek(self.write_pos)
+        self.file.write(data)
+        self.write_pos += len(data)
+
+    def read(self, size):
+        self.file.seek(self.read_pos)
+        data = self.file.read(size)
+        self.read_pos += len(data)
+        # Файл прочитан полностью – начинаем его заново, чтобы он не рос бесконечно.
+        if self.read_pos == self.write_pos:
+            self.read_pos = self.write_pos = 0
+            self.file.truncate(0)
+        return data
+
+    def close(self):
+        self.file.close()
+
+
+class BufferedClient:
+    """
+    Базовый класс соединения с ограниченным исходящим буфером.
+    Пока буфер заполнен выше верхней отметки, к новым данным применяется политика переполнения,
+    обычный режим восстанавливается, когда буфер опустеет ниже нижней отметки.
+    """
+
+    def __init__(self, address, high_watermark, low_watermark, overflow_policy):
+        self.address = address
+        self.high_watermark = high_watermark
+        self.low_watermark = low_watermark
+        self.overflow_policy = overflow_policy
+        # Признак переполнения буфера.
+        self.congested = False
+        # Временный файл для политики spill, создаётся при первом переполнении.
+        self.spill = None
+        # Количество отброшенных сообщений для политики drop.
+        self.dropped = 0
+        # Кодировщик исходящих кадров с кодеком, согласованным при подключении.
+        self.encoder = FrameEncoder()
+
+    def overflow(self, data):
+        """
+        Метод применения политики переполнения к данным, не поместившимся в буфер.
+        """
+
+        if self.overflow_policy == OVERFLOW_DROP:
+            self.dropped += 1
+            logger.warning(f'Буфер клиента {self} переполнен, сообщение отброшено. Всего отброшено: {self.dropped}')
+        elif self.overflow_policy == OVERFLOW_SPILL and len(self.spill or ()) + len(data) <= OUTBOUND_SPILL_LIMIT:
+            if self.spill is None:
+                self.spill = SpillFile()
+            self.spill.write(data)
+        else:
+            logger.warning(f'Буфер клиента {self} переполнен, клиент будет отключён.')
+            raise ConnectionError
+
+    def getpeername(self):
+        return self.address
+
+    def close(self):
+        if self.spill is not None:
+            self.spill.close()
+
+    def __repr__(self):
+        return f'<{self.__class__.__name__} {self.address}>'
+
+
+class ClientConnection(BufferedClient):
+    """
+    Неблокирующее соединение с клиентом для синхронного сервера.
+    Данные отправляются сразу, насколько позволяет сокет, остаток копится в исходящем буфере
+    и досылается по готовности сокета к записи. Медленный клиент никого не задерживает.
+    """
+
+    def __init__(self, sock, address, on_pending, high_watermark=OUTBOUND_HIGH_WATERMARK,
+                 low_watermark=OUTBOUND_LOW_WATERMARK, overflow_policy=OUTBOUND_OVERFLOW_POLICY):
+        super().__init__(address, high_watermark, low_watermark, overflow_policy)
+        self.sock = sock
+        self.sock.setblocking(False)
+        self.outbound = bytearray()
+        # Вызывается, когда в буфере остались неотправленные данные и нужно ждать готовности к записи.
+        self.on_pending = on_pending
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def recv(self, size):
+        return self.sock.recv(size)
+
+    def sendall(self, data):
+        # Первый кадр в пустой буфер принимается всегда, даже если он больше верхней отметки.
+        if not self.congested and self.outbound and len(self.outbound) + len(data) > self.high_watermark:
+            self.congested = True
+        if self.congested:
+            self.overflow(data)
+            return
+        was_empty = not self.outbound
+        self.outbound += data
+        if was_empty and not self.flush():
+            self.on_pending(self)
+
+    def flush(self):
+        """
+        Метод отправки накопленных данных без блокировки.
+        Возвращает True, если буфер и временный файл опустошены полностью.
+        """
+
+        while True:
+            if self.spill and len(self.outbound) < self.low_watermark:
+                self.outbound += self.spill.read(self.high_watermark - len(self.outbound))
+            if not self.outbound:
+                break
+            try:
+                sent = self.sock.send(self.outbound)
+            except (BlockingIOError, InterruptedError):
+                break
+            del self.outbound[:sent]
+        if self.congested and len(self.outbound) < self.low_watermark and not self.spill:
+            self.congested = False
+        return not self.outbound
+
+    def close(self):
+        super().close()
+        self.sock.close()
+
+
+def handles(action, *required, owner=None):
+    """
+    Декоратор, помечающий метод сервера как обработчик действия протокола.
+    required – обязательные поля сообщения, owner – поле с именем пользователя,
+    которое должно принадлежать отправившему сообщение клиенту.
+    """
+
+    def decorator(method):
+        method.handles = (action, required, owner)
+        return method
+
+    return decorator
 
 
 class Server(metaclass=ServerVerifier):
     port = Port()
 
-    def __init__(self, listen_address, listen_port, database):
+    def __init__(self, listen_address, listen_port, database, overflow_policy=OUTBOUND_OVERFLOW_POLICY,
+                 high_watermark=OUTBOUND_HIGH_WATERMARK, low_watermark=OUTBOUND_LOW_WATERMARK, compression=True,
+                 db_pool=None):
         """
         Основной класс сервера
         """
@@ -41,11 +212,22 @@ class Server(metaclass=ServerVerifier):
         self.addr = listen_address
         self.port = listen_port
 
+        # Параметры исходящих буферов клиентов
+        self.overflow_policy = overflow_policy
+        self.high_watermark = high_watermark
+        self.low_watermark = low_watermark
+
+        # Разрешено ли клиентам включать сжатие больших кадров
+        self.compression = compression
+
         # База данных сервера
         self.database = database
 
-        # Список подключённых клиентов.
-        self.clients = []
+        # Пул потоков для медленных запросов к базе. Без пула запросы выполняются прямо в цикле сервера.
+        self.db_pool = db_pool
+
+        # Множество подключённых клиентов.
+        self.clients = set()
 
         # Список сообщений на отправку.
         self.messages = []
@@ -53,6 +235,28 @@ class Server(metaclass=ServerVerifier):
         # Словарь содержащий сопоставленные имена и соответствующие им сокеты.
         self.names = dict()
 
+        # Словарь с декодерами кадров для каждого подключённого сокета.
+        self.decoders = dict()
+
+        # Участники групповых чатов: имя группы -> множество имён. Загружается из базы при первом обращении.
+        self.groups = dict()
+
+        # Контакты пользователей в сети: имя -> множество имён контактов. Загружается из базы при первом обращении,
+        # изменяется вместе с базой и удаляется при отключении пользователя.
+        self.contacts = dict()
+
+        # Селектор событий сокетов, создаётся в init_socket.
+        self.selector = None
+
+        # Реестр обработчиков действий: действие -> (обработчик, обязательные поля, поле владельца).
+        # Собирается из методов, помеченных декоратором handles, в том числе в наследниках.
+        self.handlers = dict()
+        for name in dir(type(self)):
+            method = getattr(type(self), name)
+            if hasattr(method, 'handles'):
+                action, required, owner = method.handles
+                self.register_action(action, getattr(self, name), *required, owner=owner)
+
     def init_socket(self):
         """
         Инициализация сокета
@@ -60,14 +264,20 @@ class Server(metaclass=ServerVerifier):
 
         logger.info(
             f'Запущен сервер, порт для подключений: {self.port} , адрес с которого принимаются подключения: {self.addr}. Если адрес не указан, принимаются соединения с любых адресов.')
-        # Готовим сокет
+        # Готовим неблокирующий сокет
         transport = socket(AF_INET, SOCK_STREAM)
         transport.bind((self.addr, self.port))
-        transport.settimeout(0.5)
+        transport.setblocking(False)
 
         # Начинаем слушать сокет.
         self.sock = transport
-        self.sock.listen()
+        self.sock.listen(MAX_CONNECTIONS)
+
+        # Слушающий сокет регистрируется в селекторе один раз, клиентские – при подключении.
+        self.selector = DefaultSelector()
+        self.selector.register(self.sock, EVENT_READ)
+        if self.db_pool:
+            self.selector.register(self.db_pool, EVENT_READ)
 
     def main_loop(self):
         """
@@ -77,131 +287,625 @@ class Server(metaclass=ServerVerifier):
         # Инициализация Сокета
         self.init_socket()
 
-        # Основной цикл программы сервера
+        # Основной цикл программы сервера. Цикл просыпается по событиям сокетов,
+        # а если в базе есть незаписанный пакет – не позже срока его записи.
+        timeout = None
+        while True:
+            for key, events in self.selector.select(timeout):
+                if key.fileobj is self.sock:
+                    self.accept_clients()
+                    continue
+                if key.fileobj is self.db_pool:
+                    self.db_pool.run_callbacks()
+                    continue
+                if events & EVENT_WRITE:
+                    self.write_client(key.fileobj)
+                if events & EVENT_READ:
+                    self.read_client(key.fileobj)
+
+            # Если есть сообщения, обрабатываем каждое.
+            self.deliver_messages()
+            timeout = self.database.tick()
+
+    def accept_clients(self):
+        """
+        Метод приёма подключений. Забирает из очереди слушающего сокета все ожидающие подключения,
+        а не одно за проход цикла.
+        """
+
         while True:
-            # Ждём подключения, если таймаут вышел, ловим исключение.
             try:
                 client, client_address = self.sock.accept()
-            except OSError:
-                pass
-            else:
-                logger.info(f'Установлено соединение с ПК {client_address}')
-                self.clients.append(client)
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError as err:
+                # Например, исчерпан лимит открытых файлов. Оставшиеся подключения примем на следующем проходе.
+                logger.error(f'Не удалось принять подключение: {err}')
+                return
+            self.add_client(client, client_address)
+
+    def add_client(self, sock, address):
+        """
+        Метод регистрации нового клиента: оборачивает сокет в неблокирующее соединение и подписывается на чтение.
+        """
 
-            recv_data_lst = []
-            send_data_lst = []
-            err_lst = []
-            # Проверяем на наличие ждущих клиентов
-            try:
-                if self.clients:
-                    recv_data_lst, send_data_lst, err_lst = select(self.clients, self.clients, [], 0)
-            except OSError:
-                pass
-
-            # принимаем сообщения и если ошибка, исключаем клиента.
-            if recv_data_lst:
-                for client_with_message in recv_data_lst:
-                    try:
-                        encoded_response = client_with_message.recv(MAX_PACKAGE_LENGTH)
-                        self.process_client_message(decode_message(encoded_response), client_with_message)
-                    except:
-                        logger.info(f'Клиент {client_with_message.getpeername()} отключился от сервера.')
-                        self.clients.remove(client_with_message)
+        logger.info(f'Установлено соединение с ПК {address}')
+        # Кадр уходит одним вызовом send, поэтому алгоритм Нейгла только задерживает короткие сообщения
+        # до подтверждения предыдущих, а клиент подтверждает приём с задержкой до 40 мс.
+        sock.setsockopt(IPPROTO_TCP, TCP_NODELAY, 1)
+        client = ClientConnection(sock, address, self.wait_writable, self.high_watermark,
+                                  self.low_watermark, self.overflow_policy)
+        self.clients.add(client)
+        self.decoders[client] = FrameDecoder()
+        self.selector.register(client, EVENT_READ)
+        return client
+
+    def wait_writable(self, client):
+        """
+        Метод подписки на готовность клиента к записи, когда в его буфере остались данные.
+        """
 
-            # Если есть сообщения, обрабатываем каждое.
-            for message in self.messages:
-                try:
-                    self.process_message(message, send_data_lst)
-                except:
-                    logger.info(f'Связь с клиентом с именем {message[DESTINATION]} была потеряна')
-                    self.clients.remove(self.names[message[DESTINATION]])
-                    del self.names[message[DESTINATION]]
-            self.messages.clear()
+        if client in self.decoders:
+            self.selector.modify(client, EVENT_READ | EVENT_WRITE)
+
+    def write_client(self, client):
+        """
+        Метод досылки исходящего буфера клиента. Когда буфер опустеет, подписка на запись снимается.
+        """
+
+        try:
+            if client.flush():
+                self.selector.modify(client, EVENT_READ)
+        except OSError:
+            logger.info(f'Клиент {client} отключился от сервера.')
+            self.remove_client(client)
+
+    def read_client(self, client, data=None):
+        """
+        Метод приёма данных от клиента, если ошибка – исключаем клиента.
+        Один recv может содержать несколько кадров или только часть кадра – их собирает декодер клиента.
+        data – байты, прочитанные из сокета клиента ещё до его передачи серверу.
+        """
+
+        if client not in self.decoders:
+            return
+        try:
+            if data is None:
+                data = client.recv(MAX_PACKAGE_LENGTH)
+                if not data:
+                    raise ConnectionResetError
+            for message in self.decoders[client].feed(data):
+                self.process_client_message(message, client)
+                # Клиент мог быть отключён обработчиком (выход, занятое имя).
+                if client not in self.decoders:
+                    break
+        except (BlockingIOError, InterruptedError):
+            pass
+        except:
+            logger.info(f'Клиент {client} отключился от сервера.')
+            self.remove_client(client)
+
+    def deliver_messages(self):
+        """
+        Метод отправки накопленных сообщений адресатам.
+        Клиенты, связь с которыми потеряна, отключаются.
+        """
 
-    def process_message(self, message, listen_socks):
+        for message in self.messages:
+            try:
+                self.process_message(message)
+            except Exception as err:
+                # Ошибка базы данных не должна останавливать сервер и не означает потерю связи с получателем.
+                logger.error(f'Ошибка обработки сообщения для {message[DESTINATION]} от {message[SENDER]}, '
+                             f'сообщение пропущено: {err}')
+        self.messages.clear()
+
+    def remove_client(self, client):
+        """
+        Метод отключения клиента: удаляет сокет из всех структур сервера, отмечает выход пользователя
+        в базе данных и закрывает соединение. Повторный вызов для того же клиента ничего не делает.
+        """
+
+        for name, sock in self.names.items():
+            if sock == client:
+                del self.names[name]
+                self.contacts.pop(name, None)
+                self.database.user_logout(name)
+                break
+        if client in self.decoders:
+            del self.decoders[client]
+            self.clients.remove(client)
+            if self.selector:
+                self.selector.unregister(client)
+            client.close()
+
+    def process_message(self, message):
         """
         Метод адресной отправки сообщения определённому клиенту.
-        Принимает словарь сообщение, список зарегистрированных пользователей и слушающие сокеты. Ничего не возвращает.
+        Сообщение ставится в исходящий буфер получателя, при переполнении буфера действует политика соединения.
+        Ничего не возвращает.
         """
 
-        if message[DESTINATION] in self.names and self.names[message[DESTINATION]] in listen_socks:
-            self.names[message[DESTINATION]].send(encode_message(message))
+        recipient = self.names.get(message[DESTINATION])
+        if recipient is not None:
+            try:
+                send_message(recipient, message, recipient.encoder)
+            except (ConnectionError, OSError):
+                logger.info(f'Связь с клиентом с именем {message[DESTINATION]} была потеряна')
+                self.remove_client(recipient)
+                # Сообщение не ушло – оставляем его до следующего подключения получателя.
+                recipient = None
+        if recipient is not None:
+            self.database.process_message(message[SENDER], message[DESTINATION], message[MESSAGE_TEXT])
             logger.info(f'Отправлено сообщение пользователю {message[DESTINATION]} от пользователя {message[SENDER]}.')
-        elif message[DESTINATION] in self.names and self.names[message[DESTINATION]] not in listen_socks:
-            raise ConnectionError
+        elif self.database.store_offline_message(message[DESTINATION], message):
+            self.database.process_message(message[SENDER], message[DESTINATION], message[MESSAGE_TEXT])
+            logger.info(f'Пользователь {message[DESTINATION]} не в сети, сообщение сохранено до его подключения.')
         else:
             logger.error(
                 f'Пользователь {message[DESTINATION]} не зарегистрирован на сервере, отправка сообщения невозможна.')
 
+    def register_action(self, action, handler, *required, owner=None):
+        """
+        Метод регистрации обработчика действия протокола без изменения класса сервера.
+        handler вызывается как handler(message, client), required – обязательные поля сообщения,
+        owner – поле с именем пользователя, которое должно принадлежать отправившему сообщение клиенту.
+        """
+
+        self.handlers[action] = (handler, required, owner)
+
     def process_client_message(self, message, client):
         """
-        Метод-обработчик сообщений от клиентов. Принимает словарь-сообщение от клиента, проверяет корректность, отправляет
-        словарь-ответ в случае необходимости.
+        Метод-обработчик сообщений от клиентов. Находит обработчик действия в реестре, проверяет обязательные поля
+        и принадлежность имени пользователя клиенту. Если сообщение некорректно, отвечает 400.
         """
 
-        logger.debug(f'Разбор сообщения от клиента : {message}')
-        # Если это сообщение о присутствии, принимаем и отвечаем
-        if ACTION in message and message[ACTION] == PRESENCE and TIME in message and USER in message:
-            # Если такой пользователь ещё не зарегистрирован, регистрируем, иначе отправляем ответ и завершаем соединение.
-            if message[USER][ACCOUNT_NAME] not in self.names.keys():
-                self.names[message[USER][ACCOUNT_NAME]] = client
-                client_ip, client_port = client.getpeername()
-                self.database.user_login(message[USER][ACCOUNT_NAME], client_ip, client_port)
-                client.send(encode_message(RESPONSE_200))
+        logger.debug('Разбор сообщения от клиента : %s', message)
+        entry = self.handlers.get(message.get(ACTION))
+        if entry is not None:
+            handler, required, owner = entry
+            for field in required:
+                if field not in message:
+                    break
             else:
-                response = RESPONSE_400
-                response[ERROR] = 'Имя пользователя уже занято.'
-                client.send(encode_message(response))
-                self.clients.remove(client)
-                client.close()
-            return
+                if owner is None or self.names.get(message[owner]) is client:
+                    handler(message, client)
+                    return
+        self.bad_request(client, 'Запрос некорректен.', message)
+
+    def query_database(self, client, request, callback, method, *args):
+        """
+        Метод выполнения запроса method(*args) к базе данных для запроса клиента request.
+        С пулом потоков запрос выполняется вне цикла сервера, а callback(client, request, результат) вызывается
+        в цикле, когда запрос готов. Ответы на такие запросы могут прийти клиенту позже ответов на более поздние
+        запросы, клиент сопоставляет их по идентификатору запроса.
+        """
 
-        # Если это сообщение, то добавляем его в очередь сообщений. Ответ не требуется.
-        elif ACTION in message and message[ACTION] == MESSAGE and DESTINATION in message and TIME in message \
-                and SENDER in message and MESSAGE_TEXT in message:
-            self.messages.append(message)
+        if self.db_pool is None:
+            callback(client, request, method(*args))
+        else:
+            self.db_pool.submit(partial(self.query_done, client, request, callback), method, *args)
+
+    def query_done(self, client, request, callback, future):
+        """
+        Метод завершения запроса к базе данных из пула в цикле сервера
+        """
+
+        # Клиент мог отключиться, пока выполнялся запрос.
+        if client not in self.clients:
+            return
+        try:
+            result = future.result()
+        except Exception as err:
+            logger.error(f'Ошибка запроса к базе данных для клиента {client}: {err}')
+            self.bad_request(client, 'Ошибка базы данных.', request)
             return
+        try:
+            callback(client, request, result)
+        except Exception:
+            logger.info(f'Клиент {client} отключился от сервера.')
+            self.remove_client(client)
 
-        # Если клиент выходит
-        elif ACTION in message and message[ACTION] == EXIT and ACCOUNT_NAME in message:
-            self.database.user_logout(message[ACCOUNT_NAME])
-            self.clients.remove(self.names[ACCOUNT_NAME])
-            self.names[ACCOUNT_NAME].close()
-            del self.names[ACCOUNT_NAME]
+    def reply(self, client, request, response):
+        """
+        Метод отправки ответа на запрос. Если в запросе есть идентификатор, ответ возвращает его клиенту:
+        так клиент может отправить несколько запросов подряд и сопоставить ответы, пришедшие в любом порядке.
+        Общие словари ответов не изменяются.
+        """
+
+        if REQUEST_ID in request:
+            response = dict(response)
+            response[REQUEST_ID] = request[REQUEST_ID]
+        send_message(client, response, client.encoder)
+
+    def bad_request(self, client, text, request=None):
+        """
+        Метод отправки ответа 400 с текстом ошибки.
+        """
+
+        response = dict(RESPONSE_400)
+        response[ERROR] = text
+        self.reply(client, request or {}, response)
+
+    # Если это сообщение о присутствии, принимаем и отвечаем
+    @handles(PRESENCE, TIME, USER)
+    def process_presence(self, message, client):
+        # Если такой пользователь ещё не зарегистрирован, регистрируем, иначе отправляем ответ и завершаем соединение.
+        if message[USER][ACCOUNT_NAME] not in self.names:
+            self.names[message[USER][ACCOUNT_NAME]] = client
+            client_ip, client_port = client.getpeername()
+            self.database.user_login(message[USER][ACCOUNT_NAME], client_ip, client_port)
+            # Клиент перечисляет поддерживаемые кодеки в порядке предпочтения, выбираем первый известный серверу.
+            # Ответ уходит ещё в JSON без сжатия, следующие кадры – выбранным кодеком и со сжатием, если оно согласовано.
+            response = dict(RESPONSE_200)
+            codec = next((codec for codec in message.get(CODECS, ()) if codec in ENCODERS), None)
+            if codec:
+                response[CODEC] = codec
+            compression = self.compression and message.get(COMPRESSION) == COMPRESSION_ZLIB
+            if compression:
+                response[COMPRESSION] = COMPRESSION_ZLIB
+            self.reply(client, message, response)
+            client.encoder.codec = codec or CODEC_JSON
+            client.encoder.compression = compression
+            self.deliver_offline_messages(message[USER][ACCOUNT_NAME], client)
+        else:
+            self.bad_request(client, 'Имя пользователя уже занято.', message)
+            self.remove_client(client)
+
+    def deliver_offline_messages(self, username, client):
+        """
+        Метод доставки сообщений, накопленных, пока пользователь был не в сети.
+        Все кадры отправляются одной записью в порядке поступления сообщений.
+        Сообщение, которое не удалось закодировать кодеком клиента, пропускается, остальные доставляются.
+        Из очереди сообщения удаляются только после того, как соединение приняло кадры. Если отправка не удалась
+        или кадры отброшены политикой переполнения, сообщения остаются в очереди до следующего подключения,
+        ошибка отправки передаётся вызывающему, и клиент отключается.
+        """
+
+        last_id, messages = self.database.offline_messages(username)
+        if not messages:
             return
+        frames = []
+        for message in messages:
+            try:
+                frames.append(client.encoder.encode(message))
+            except (TypeError, StructError) as err:
+                logger.error(f'Сообщение для {username} не удалось закодировать, оно пропущено: {err}')
+        dropped = client.dropped
+        client.sendall(b''.join(frames))
+        if client.dropped != dropped:
+            logger.warning(f'Сообщения для {username}, ожидавшие подключения, не поместились в буфер '
+                           f'и остаются в очереди: {len(messages)}')
+            return
+        self.database.remove_offline_messages(username, last_id)
+        logger.info(f'Пользователю {username} доставлено сообщений, ожидавших подключения: {len(messages)}')
+
+    # Если это сообщение, то добавляем его в очередь сообщений. Ответ не требуется.
+    @handles(MESSAGE, DESTINATION, TIME, SENDER, MESSAGE_TEXT, owner=SENDER)
+    def process_chat_message(self, message, client):
+        self.messages.append(message)
+
+    # Если это сообщение в групповой чат, рассылаем его участникам в сети
+    @handles(GROUP_MESSAGE, TIME, SENDER, GROUP, MESSAGE_TEXT, owner=SENDER)
+    def process_group_message(self, message, client):
+        members = self.group_members(message[GROUP])
+        if message[SENDER] not in members:
+            self.bad_request(client, 'Пользователь не состоит в группе.', message)
+            return
+        self.deliver_group_message(message, members)
+
+    def deliver_group_message(self, message, members):
+        """
+        Метод рассылки группового сообщения участникам группы, подключённым к этому серверу
+        """
+
+        # Сообщение кодируется один раз для каждого кодека, всем участникам с этим кодеком уходят одни и те же байты.
+        # Сжатие зависит от состояния потока конкретного соединения, поэтому большие кадры сжимаются отдельно.
+        frames = dict()
+        for member in members:
+            if member != message[SENDER] and member in self.names:
+                connection = self.names[member]
+                cached = frames.get(connection.encoder.codec)
+                if cached is None:
+                    try:
+                        payload = ENCODERS[connection.encoder.codec](message)
+                    except (TypeError, StructError) as err:
+                        # Ошибка кодирования – ошибка этого сообщения, а не связи с участником.
+                        logger.error(f'Сообщение в группу {message[GROUP]} не удалось закодировать: {err}')
+                        return
+                    cached = frames[connection.encoder.codec] = (payload, pack_frame(payload))
+                frame = connection.encoder.frame(*cached)
+                try:
+                    connection.sendall(frame)
+                except:
+                    logger.info(f'Связь с клиентом с именем {member} была потеряна')
+                    self.remove_client(self.names[member])
+        logger.info(f'Отправлено сообщение в группу {message[GROUP]} от пользователя {message[SENDER]}.')
+
+    # Если это вступление в групповой чат
+    @handles(JOIN_GROUP, TIME, USER, GROUP, owner=USER)
+    def process_join_group(self, message, client):
+        self.database.join_group(message[USER], message[GROUP])
+        self.group_members(message[GROUP]).add(message[USER])
+        self.reply(client, message, RESPONSE_200)
+
+    # Если это выход из группового чата
+    @handles(LEAVE_GROUP, TIME, USER, GROUP, owner=USER)
+    def process_leave_group(self, message, client):
+        self.database.leave_group(message[USER], message[GROUP])
+        self.group_members(message[GROUP]).discard(message[USER])
+        self.reply(client, message, RESPONSE_200)
+
+    def group_members(self, group):
+        """
+        Метод получения множества участников группы из памяти сервера, при первом обращении – из базы данных
+        """
 
-        # Если это запрос контакт-листа
-        elif ACTION in message and message[ACTION] == GET_CONTACTS and USER in message and \
-                self.names[message[USER]] == client:
-            response = RESPONSE_202
-            response[LIST_INFO] = self.database.get_contacts(message[USER])
-            client.send(encode_message(response))
-
-        # Если это добавление контакта
-        elif ACTION in message and message[ACTION] == ADD_CONTACT and ACCOUNT_NAME in message and USER in message \
-                and self.names[message[USER]] == client:
-            self.database.add_contact(message[USER], message[ACCOUNT_NAME])
-            client.send(encode_message(RESPONSE_200))
-
-        # Если это удаление контакта
-        elif ACTION in message and message[ACTION] == REMOVE_CONTACT and ACCOUNT_NAME in message and USER in message \
-                and self.names[message[USER]] == client:
-            self.database.remove_contact(message[USER], message[ACCOUNT_NAME])
-            client.send(encode_message(RESPONSE_200))
-
-        # Если это запрос известных пользователей
-        elif ACTION in message and message[ACTION] == USERS_REQUEST and ACCOUNT_NAME in message \
-                and self.names[message[ACCOUNT_NAME]] == client:
-            response = RESPONSE_202
-            response[LIST_INFO] = [user[0] for user in self.database.users_list()]
-            client.send(encode_message(response))
-
-        # Иначе отдаём Bad request
+        if group not in self.groups:
+            self.groups[group] = set(self.database.group_members(group))
+        return self.groups[group]
+
+    # Если клиент выходит
+    @handles(EXIT, ACCOUNT_NAME)
+    def process_exit(self, message, client):
+        self.remove_client(client)
+
+    # Если это запрос контакт-листа. С версией в запросе клиент получает только изменения после неё.
+    @handles(GET_CONTACTS, USER, owner=USER)
+    def process_get_contacts(self, message, client):
+        # Полный список отдаётся из кеша контактов, журнал изменений читается только для настоящих изменений.
+        # Кеш совпадает с базой на любой версии: контакты пользователя меняет только этот процесс.
+        response = dict(RESPONSE_202)
+        since = self.sync_since(message)
+        if since is None:
+            response[LIST_INFO] = sorted(self.contact_set(message[USER]))
         else:
-            response = RESPONSE_400
-            response[ERROR] = 'Запрос некорректен.'
-            client.send(encode_message(response))
+            version, delta = self.database.sync_base(since, message.get(EPOCH))
+            if delta:
+                added, removed = self.database.contacts_changes(message[USER], since, version)
+                response.update({LIST_INFO: added, REMOVED: removed})
+            else:
+                response[LIST_INFO] = sorted(self.contact_set(message[USER]))
+            response.update({VERSION: version, EPOCH: self.database.epoch, DELTA: delta})
+        self.reply(client, message, response)
+
+    @staticmethod
+    def sync_since(message):
+        """
+        Метод получения версии списка, известной клиенту, None – если клиент её не передал
+        """
+
+        since = message.get(VERSION)
+        if isinstance(since, int) and not isinstance(since, bool) and since >= 0:
+            return since
+        return None
+
+    # Если это добавление контакта
+    @handles(ADD_CONTACT, ACCOUNT_NAME, USER, owner=USER)
+    def process_add_contact(self, message, client):
+        if self.database.add_contact(message[USER], message[ACCOUNT_NAME]) and message[USER] in self.contacts:
+            self.contacts[message[USER]].add(message[ACCOUNT_NAME])
+        self.reply(client, message, RESPONSE_200)
+
+    # Если это удаление контакта
+    @handles(REMOVE_CONTACT, ACCOUNT_NAME, USER, owner=USER)
+    def process_remove_contact(self, message, client):
+        self.database.remove_contact(message[USER], message[ACCOUNT_NAME])
+        if message[USER] in self.contacts:
+            self.contacts[message[USER]].discard(message[ACCOUNT_NAME])
+        self.reply(client, message, RESPONSE_200)
+
+    def contact_set(self, username):
+        """
+        Метод получения множества контактов пользователя из памяти сервера, при первом обращении – из базы данных.
+        Кешируются только контакты пользователей в сети.
+        """
+
+        contacts = self.contacts.get(username)
+        if contacts is None:
+            contacts = set(self.database.get_contacts(username))
+            if username in self.names:
+                self.contacts[username] = contacts
+        return contacts
+
+    def is_contact(self, username, contact):
+        """
+        Метод проверки, есть ли contact в списке контактов пользователя username
+        """
+
+        return contact in self.contact_set(username)
+
+    # Если это запрос известных пользователей. Список всех пользователей может быть большим, он читается в пуле.
+    # С версией в запросе клиент получает только пользователей, зарегистрированных после неё.
+    @handles(USERS_REQUEST, ACCOUNT_NAME, owner=ACCOUNT_NAME)
+    def process_users_request(self, message, client):
+        since = self.sync_since(message)
+        if since is None:
+            self.query_database(client, message, self.send_users_list, self.database.users_list)
+        else:
+            self.query_database(client, message, self.send_users_changes, self.database.users_changes, since,
+                                message.get(EPOCH))
+
+    def send_users_list(self, client, request, users):
+        response = dict(RESPONSE_202)
+        response[LIST_INFO] = [user[0] for user in users]
+        self.reply(client, request, response)
+
+    def send_users_changes(self, client, request, changes):
+        version, users, delta = changes
+        response = dict(RESPONSE_202)
+        response.update({LIST_INFO: users, VERSION: version, EPOCH: self.database.epoch, DELTA: delta})
+        self.reply(client, request, response)
+
+    # Если это запрос страницы переписки из архива. Без курсора возвращаются последние сообщения,
+    # с курсором из предыдущего ответа – сообщения перед ним. Архив читается в пуле.
+    @handles(GET_HISTORY, USER, ACCOUNT_NAME, owner=USER)
+    def process_get_history(self, message, client):
+        cursor = message.get(CURSOR)
+        limit = message.get(LIMIT, HISTORY_PAGE_SIZE)
+        if cursor is not None and not (isinstance(cursor, list) and len(cursor) == 2 and
+                                       all(isinstance(value, (int, float)) and not isinstance(value, bool)
+                                           for value in cursor)):
+            self.bad_request(client, 'Некорректный курсор.', message)
+        elif not isinstance(limit, int) or isinstance(limit, bool) or not 0 < limit <= HISTORY_PAGE_LIMIT:
+            self.bad_request(client, f'Размер страницы должен быть от 1 до {HISTORY_PAGE_LIMIT}.', message)
+        else:
+            self.query_database(client, message, self.send_history, self.database.get_history,
+                                message[USER], message[ACCOUNT_NAME], cursor, limit)
+
+    def send_history(self, client, request, history):
+        messages, cursor = history
+        response = dict(RESPONSE_202)
+        response[LIST_INFO] = [{SENDER: sender, DESTINATION: recipient, MESSAGE_TEXT: text, TIME: sent}
+                               for sender, recipient, text, sent, message_id in messages]
+        response[CURSOR] = cursor
+        self.reply(client, request, response)
+
+
+class StreamClient(BufferedClient):
+    """
+    Адаптер пары потоков asyncio к интерфейсу сокета, которым пользуются обработчики Server.
+    Запись не блокирует: данные попадают в буфер транспорта и уходят по мере готовности сокета.
+    Отметки заполнения и политика переполнения работают так же, как у ClientConnection.
+    """
+
+    def __init__(self, writer, high_watermark=OUTBOUND_HIGH_WATERMARK, low_watermark=OUTBOUND_LOW_WATERMARK,
+                 overflow_policy=OUTBOUND_OVERFLOW_POLICY):
+        super().__init__(writer.get_extra_info('peername'), high_watermark, low_watermark, overflow_policy)
+        self.writer = writer
+        # drain() будет ждать, пока буфер транспорта не опустеет ниже нижней отметки.
+        self.writer.transport.set_write_buffer_limits(high_watermark, low_watermark)
+        self.refill_task = None
+
+    def sendall(self, data):
+        buffered = self.writer.transport.get_write_buffer_size()
+        # Без временного файла досылать нечего, и refill не запускается: переполнение снимается здесь,
+        # когда буфер транспорта разгрузился до нижней отметки.
+        if self.congested and not self.spill and buffered <= self.low_watermark:
+            self.congested = False
+        if not self.congested and buffered and buffered + len(data) > self.high_watermark:
+            self.congested = True
+        if self.congested:
+            self.overflow(data)
+            if self.spill and self.refill_task is None:
+                self.refill_task = asyncio.get_running_loop().create_task(self.refill())
             return
+        self.writer.write(data)
+
+    async def refill(self):
+        """
+        Корутина досылки данных из временного файла по мере разгрузки буфера транспорта.
+        """
+
+        try:
+            await self.writer.drain()
+            while self.spill:
+                self.writer.write(self.spill.read(self.high_watermark - self.low_watermark))
+                await self.writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            self.refill_task = None
+            self.congested = False
+
+    def close(self):
+        super().close()
+        self.writer.close()
+
+
+class AsyncServer(Server):
+
+    def __init__(self, *args, **kwargs):
+        """
+        Сервер на asyncio: по одной корутине на соединение, ожидание событий без опроса по таймауту.
+        Разбор сообщений (process_client_message) и работа с базой данных полностью совпадают с Server.
+        """
+
+        super().__init__(*args, **kwargs)
+
+    def main_loop(self):
+        """
+        Метод запуска цикла событий сервера
+        """
+
+        asyncio.run(self.serve())
+
+    def query_database(self, client, request, callback, method, *args):
+        """
+        Метод выполнения запроса к базе данных в потоке пула через цикл событий asyncio
+        """
+
+        if self.db_pool is None:
+            super().query_database(client, request, callback, method, *args)
+        else:
+            future = asyncio.get_running_loop().run_in_executor(self.db_pool.executor, self.db_pool.run, method, *args)
+            future.add_done_callback(partial(self.query_done, client, request, callback))
+
+    async def serve(self):
+        """
+        Корутина, принимающая подключения до остановки сервера
+        """
+
+        logger.info(
+            f'Запущен asyncio сервер, порт для подключений: {self.port} , адрес с которого принимаются подключения: {self.addr}. Если адрес не указан, принимаются соединения с любых адресов.')
+        server = await asyncio.start_server(self.handle_client, self.addr, self.port,
+                                            family=AF_INET, backlog=MAX_CONNECTIONS)
+        flusher = asyncio.create_task(self.flush_database())
+        async with server:
+            await server.serve_forever()
+        flusher.cancel()
+
+    async def flush_database(self):
+        """
+        Корутина записи накопленных изменений базы данных по истечении интервала
+        """
+
+        while True:
+            await asyncio.sleep(self.database.tick() or DB_FLUSH_INTERVAL)
+
+    async def handle_client(self, reader, writer):
+        """
+        Корутина обслуживания одного клиента: читает кадры, передаёт их обработчику сервера
+        и отправляет накопленные сообщения адресатам.
+        """
+
+        client = StreamClient(writer, self.high_watermark, self.low_watermark, self.overflow_policy)
+        logger.info(f'Установлено соединение с ПК {client.getpeername()}')
+        self.clients.add(client)
+        self.decoders[client] = FrameDecoder()
+        try:
+            while client in self.decoders:
+                data = await reader.read(MAX_PACKAGE_LENGTH)
+                if not data:
+                    break
+                for message in self.decoders[client].feed(data):
+                    self.process_client_message(message, client)
+                    if client not in self.decoders:
+                        break
+                self.deliver_messages()
+                await writer.drain()
+        except (ConnectionError, OSError):
+            # Связь с клиентом потеряна – обычное отключение.
+            pass
+        except Exception:
+            # Ошибка разбора или обработки данных клиента: как и в синхронном сервере, клиент отключается.
+            logger.exception(f'Ошибка обработки данных от клиента {client.getpeername()}, клиент будет отключён.')
+        finally:
+            logger.info(f'Клиент {client} отключился от сервера.')
+            self.remove_client(client)
+
+
+def stop_on_sigterm():
+    """
+    Функция, превращающая SIGTERM в обычное завершение программы, чтобы успели отработать блоки finally.
+    Повторные SIGTERM во время завершения игнорируются, иначе они прервут запись базы.
+    """
+
+    def stop(signum, frame):
+        signal(SIGTERM, SIG_IGN)
+        sys.exit(0)
+
+    signal(SIGTERM, stop)
 
 
 def main():
@@ -210,14 +914,37 @@ def main():
     """
 
     # Загрузка параметров командной строки. Если нет параметров, то задаём значения по умолчанию.
-    listen_address, listen_port = arg_parser()
-
-    database = ServerDB()  # база данных сервера
-
-    # Создание экземпляра класса – сервера.
-    server = Server(listen_address, listen_port, database)
-    server.main_loop()
+    listen_address, listen_port, engine, overflow_policy, workers, durability, db_workers = arg_parser()
+    stop_on_sigterm()
+
+    # Режим кластера: несколько процессов, каждый обслуживает свою долю пользователей.
+    if workers:
+        from server_cluster import ShardRouter
+        ShardRouter(listen_address, listen_port, workers, overflow_policy, durability, db_workers).main_loop()
+        return
+
+    # база данных сервера, изменения истории входов и счётчиков записываются пакетами.
+    # Модуль базы импортирует SQLAlchemy, поэтому загружается только здесь: распределителю кластера он не нужен.
+    from server_DB import ServerDB, WriteBehindDB, DBWorkerPool
+    database = WriteBehindDB(ServerDB(), durability)
+    # пул потоков для медленных запросов к базе
+    db_pool = DBWorkerPool(database, db_workers) if db_workers else None
+
+    # Создание экземпляра класса – сервера. Движок asyncio выбирается ключом --engine asyncio.
+    if engine == 'asyncio':
+        server = AsyncServer(listen_address, listen_port, database, overflow_policy, db_pool=db_pool)
+    else:
+        server = Server(listen_address, listen_port, database, overflow_policy, db_pool=db_pool)
+    try:
+        server.main_loop()
+    finally:
+        # Незаписанный пакет сохраняется при любом штатном завершении, в том числе по Ctrl+C и SIGTERM.
+        if db_pool:
+            db_pool.close()
+        database.close()
+        logger.info(f'Кеш пользователей базы данных: {database.user_ids.stats()}')
 
 
 if __name__ == '__main__':
+    use_logger('server')
     main()
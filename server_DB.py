@@ -1,7 +1,84 @@
-from sqlalchemy import create_engine, Table, Column, Integer, String, MetaData, ForeignKey, DateTime
-from sqlalchemy.orm import mapper, sessionmaker
+from sqlalchemy import create_engine, event, func, Table, Column, Integer, String, Text, MetaData, ForeignKey, \
+    DateTime, Index, Boolean, Float, tuple_, or_
+from sqlalchemy.exc import IntegrityError, OperationalError, SQLAlchemyError
+from sqlalchemy.orm import mapper, sessionmaker, scoped_session
+from sqlalchemy.pool import QueuePool
 from common.variables import *
+from json import dumps, loads
+from logging import getLogger
 import datetime
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from socket import socketpair
+from threading import Lock
+
+logger = getLogger('server')
+
+
+class UserIdCache:
+    """
+    Ограниченный кеш соответствия имён пользователей и их id с вытеснением давно не использованных записей (LRU).
+    Счётчики попаданий и промахов помогают подобрать размер кеша.
+    """
+
+    def __init__(self, capacity=USER_ID_CACHE_SIZE):
+        self.capacity = capacity
+        # Имя -> id в порядке использования: последние использованные в конце.
+        self.ids = OrderedDict()
+        # Обратное соответствие id -> имя для тех же записей.
+        self.names = dict()
+        self.hits = 0
+        self.misses = 0
+        # Кеш используют и цикл сервера, и потоки пула базы данных.
+        self.lock = Lock()
+
+    def __len__(self):
+        return len(self.ids)
+
+    def get(self, username):
+        with self.lock:
+            user_id = self.ids.get(username)
+            if user_id is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self.ids.move_to_end(username)
+            return user_id
+
+    def get_name(self, user_id):
+        with self.lock:
+            username = self.names.get(user_id)
+            if username is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self.ids.move_to_end(username)
+            return username
+
+    def put(self, username, user_id):
+        with self.lock:
+            self.ids[username] = user_id
+            self.ids.move_to_end(username)
+            self.names[user_id] = username
+            if len(self.ids) > self.capacity:
+                old_name, old_id = self.ids.popitem(last=False)
+                del self.names[old_id]
+
+    def invalidate(self, username):
+        with self.lock:
+            user_id = self.ids.pop(username, None)
+            if user_id is not None:
+                del self.names[user_id]
+
+    def stats(self):
+        """
+        Метод получения статистики кеша: размер, ёмкость, попадания, промахи и доля попаданий
+        """
+
+        total = self.hits + self.misses
+        return {'size': len(self.ids), 'capacity': self.capacity, 'hits': self.hits, 'misses': self.misses,
+                'hit_ratio': self.hits / total if total else 0.0}
 
 
 class ServerDB:
@@ -9,6 +86,24 @@ class ServerDB:
     Класс – база данных для сервера
     """
 
+    # Миграции схемы для баз, созданных прежними версиями сервера. Номер миграции – её позиция в списке, начиная с 1,
+    # номер последней применённой хранится в PRAGMA user_version. Список можно только дополнять.
+    MIGRATIONS = (
+        # 1: индексы контактов, истории входов и счётчиков сообщений. Дубликаты удаляются перед уникальными индексами.
+        ('DELETE FROM Contacts WHERE id NOT IN (SELECT MIN(id) FROM Contacts GROUP BY user, contact)',
+         'CREATE UNIQUE INDEX IF NOT EXISTS Contacts_user_contact ON Contacts (user, contact)',
+         'CREATE INDEX IF NOT EXISTS Login_history_name_date_time ON Login_history (name, date_time)',
+         'DELETE FROM History WHERE id NOT IN (SELECT MIN(id) FROM History GROUP BY user)',
+         'CREATE UNIQUE INDEX IF NOT EXISTS History_user ON History (user)'),
+        # 2: журнал изменений для синхронизации клиентов заполняется уже существующими пользователями и контактами.
+        ('INSERT INTO Changes (owner, name, removed) SELECT NULL, id, 0 FROM Users WHERE NOT EXISTS '
+         '(SELECT 1 FROM Changes WHERE owner IS NULL AND name = Users.id) ORDER BY id',
+         'INSERT INTO Changes (owner, name, removed) SELECT user, contact, 0 FROM Contacts WHERE NOT EXISTS '
+         '(SELECT 1 FROM Changes WHERE owner = Contacts.user AND name = Contacts.contact) ORDER BY id'),
+        # 3: случайная эпоха базы, выбирается один раз при её создании.
+        ('INSERT INTO Sync_epoch (epoch) SELECT random() WHERE NOT EXISTS (SELECT 1 FROM Sync_epoch)',),
+    )
+
     class AllUsers:
         """
         Отображение таблицы всех пользователей.
@@ -69,13 +164,93 @@ class ServerDB:
             self.sent = 0
             self.accepted = 0
 
-    def __init__(self):
+    class OfflineMessages:
+        """
+        Отображение очереди сообщений для пользователей не в сети.
+        Для связи с таблицей offline_messages_table
+        """
+
+        def __init__(self, user, message, expires):
+            self.id = None
+            self.user = user
+            self.message = message
+            self.expires = expires
+
+    class Groups:
         """
-        Конструктор класса базы данных
+        Отображение таблицы групповых чатов.
+        Для связи с таблицей groups_table
         """
 
+        def __init__(self, name):
+            self.id = None
+            self.name = name
+
+    class GroupMembers:
+        """
+        Отображение участников групповых чатов.
+        Для связи с таблицей group_members_table
+        """
+
+        def __init__(self, group, user):
+            self.id = None
+            self.group = group
+            self.user = user
+
+    class Changes:
+        """
+        Отображение журнала изменений списка пользователей и списков контактов.
+        Для связи с таблицей changes_table
+        """
+
+        def __init__(self, owner, name, removed=False):
+            self.id = None
+            self.owner = owner
+            self.name = name
+            self.removed = removed
+
+    class Archive:
+        """
+        Отображение архива личных сообщений.
+        Для связи с таблицей archive_table
+        """
+
+        def __init__(self, first, second, sender, time, message):
+            self.id = None
+            self.first = first
+            self.second = second
+            self.sender = sender
+            self.time = time
+            self.message = message
+
+    def __init__(self, path=SERVER_DATABASE, profile=SERVER_DATABASE_PROFILE, pool_size=DB_POOL_SIZE):
+        """
+        Конструктор класса базы данных.
+        profile – словарь PRAGMA, выполняемых при каждом подключении к SQLite.
+        pool_size – число подключений к файлу базы, которые пул держит открытыми для разных потоков.
+        Методы класса можно вызывать из нескольких потоков: у каждого потока своя сессия.
+        """
+
+        # кеш соответствия имён пользователей и id
+        self.user_ids = UserIdCache()
+
         # движок
-        self.database_engine = create_engine(SERVER_DATABASE, echo=False, pool_recycle=7200)
+        if path.startswith('sqlite') and ':memory:' not in path:
+            # Подключения переходят между потоками через пул, поэтому проверка потока sqlite3 отключается.
+            self.database_engine = create_engine(path, echo=False, pool_recycle=7200, poolclass=QueuePool,
+                                                 pool_size=pool_size, connect_args={'check_same_thread': False})
+        else:
+            # База в памяти существует только в своём подключении и с пулом потоков не используется.
+            self.database_engine = create_engine(path, echo=False, pool_recycle=7200)
+
+        # настройки производительности SQLite при каждом новом подключении
+        if profile and self.database_engine.dialect.name == 'sqlite':
+            @event.listens_for(self.database_engine, 'connect')
+            def set_profile(dbapi_connection, connection_record):
+                cursor = dbapi_connection.cursor()
+                for name, value in profile.items():
+                    cursor.execute(f'PRAGMA {name} = {value}')
+                cursor.close()
 
         # объект MetaData
         self.metadata = MetaData()
@@ -120,8 +295,63 @@ class ServerDB:
                                     Column('accepted', Integer),
                                     )
 
-        # создание всех таблиц
+        # таблица сообщений, ожидающих доставки пользователям не в сети
+        offline_messages_table = Table('Offline_messages', self.metadata,
+                                       Column('id', Integer, primary_key=True),
+                                       Column('user', ForeignKey('Users.id')),
+                                       Column('message', Text),
+                                       Column('expires', DateTime)
+                                       )
+        # выборка и удаление очереди пользователя по порядку, очистка устаревших сообщений
+        Index('Offline_messages_user_id', offline_messages_table.c.user, offline_messages_table.c.id)
+        Index('Offline_messages_expires', offline_messages_table.c.expires)
+
+        # таблица групповых чатов
+        groups_table = Table('Groups', self.metadata,
+                             Column('id', Integer, primary_key=True),
+                             Column('name', String, unique=True)
+                             )
+
+        # таблица участников групповых чатов
+        group_members_table = Table('Group_members', self.metadata,
+                                    Column('id', Integer, primary_key=True),
+                                    Column('group', ForeignKey('Groups.id')),
+                                    Column('user', ForeignKey('Users.id'))
+                                    )
+        Index('Group_members_group_user', group_members_table.c.group, group_members_table.c.user, unique=True)
+
+        # журнал изменений для синхронизации клиентов: id – номер версии, owner – владелец списка контактов
+        # (NULL – список всех пользователей), name – добавленный или удалённый пользователь
+        changes_table = Table('Changes', self.metadata,
+                              Column('id', Integer, primary_key=True),
+                              Column('owner', ForeignKey('Users.id')),
+                              Column('name', ForeignKey('Users.id')),
+                              Column('removed', Boolean)
+                              )
+        # изменения одного списка после заданной версии
+        Index('Changes_owner_id', changes_table.c.owner, changes_table.c.id)
+        # эпоха базы: номера версий имеют смысл только в пределах одной базы, пересозданная база начинает их заново
+        Table('Sync_epoch', self.metadata, Column('epoch', Integer))
+
+        # архив личных сообщений: строки только добавляются. first и second – id участников переписки
+        # по возрастанию, так обе стороны диалога читают одни строки; time – время получения сервером
+        archive_table = Table('Archive', self.metadata,
+                              Column('id', Integer, primary_key=True),
+                              Column('first', ForeignKey('Users.id')),
+                              Column('second', ForeignKey('Users.id')),
+                              Column('sender', ForeignKey('Users.id')),
+                              Column('time', Float),
+                              Column('message', Text)
+                              )
+        # страницы переписки по курсору (время, id)
+        Index('Archive_dialog_time_id', archive_table.c.first, archive_table.c.second, archive_table.c.time,
+              archive_table.c.id)
+
+        # создание всех таблиц и недостающих индексов
         self.metadata.create_all(self.database_engine)
+        self.migrate()
+        with self.database_engine.connect() as connection:
+            self.epoch = connection.exec_driver_sql('SELECT epoch FROM Sync_epoch').scalar()
 
         # ORM связь классов отображения с соответствующими таблицами
         mapper(self.AllUsers, users_table)
@@ -129,82 +359,343 @@ class ServerDB:
         mapper(self.LoginHistory, user_login_history)
         mapper(self.UsersContacts, contacts)
         mapper(self.UsersHistory, users_history_table)
+        mapper(self.OfflineMessages, offline_messages_table)
+        mapper(self.Groups, groups_table)
+        mapper(self.GroupMembers, group_members_table)
+        mapper(self.Changes, changes_table)
+        mapper(self.Archive, archive_table)
 
-        # Сессия
-        Session = sessionmaker(bind=self.database_engine)
-        self.session = Session()
+        # Сессии: своя для каждого потока, создаётся при первом обращении к self.session в потоке
+        self.Session = scoped_session(sessionmaker(bind=self.database_engine))
 
         # очистка таблицы активных пользователей при создании новой сессии
         self.session.query(self.ActiveUsers).delete()
         self.session.commit()
 
+        # удаление сообщений, срок хранения которых истёк, пока сервер не работал
+        self.purge_offline_messages()
+
+    def migrate(self):
+        """
+        Метод применения миграций схемы, которые ещё не применялись к этой базе.
+        Каждая миграция выполняется в отдельной транзакции вместе с записью её номера.
+        """
+
+        with self.database_engine.connect() as connection:
+            version = connection.exec_driver_sql('PRAGMA user_version').scalar()
+        for number, statements in enumerate(self.MIGRATIONS, 1):
+            if number > version:
+                with self.database_engine.begin() as connection:
+                    for statement in statements:
+                        connection.exec_driver_sql(statement)
+                    connection.exec_driver_sql(f'PRAGMA user_version = {number}')
+
     def user_login(self, username, ip_address, port):
         """
         Метод записи данных пользователя при входе на сервер
         """
 
-        # поиск имени пользователя в таблице всех пользователей
-        rez = self.session.query(self.AllUsers).filter_by(name=username)
+        # поиск имени пользователя в кеше или таблице всех пользователей
+        user_id = self.user_id(username)
 
-        if rez.count():  # если пользователь уже существует, то
-            user = rez.first()
-            user.last_login = datetime.datetime.now()  # обновляем время входа
+        if user_id is not None:  # если пользователь уже существует, то
+            self.session.query(self.AllUsers).filter_by(id=user_id). \
+                update({self.AllUsers.last_login: datetime.datetime.now()})  # обновляем время входа
         else:  # если пользователь новый, то
-            user = self.AllUsers(username)  # создаем пользователя
-            self.session.add(user)  # и добавляем в таблицу
-            self.session.commit()  # сохранение изменений
+            user_id = self.add_user(username).id  # создаем пользователя
 
         # создание активного пользователя
-        new_active_user = self.ActiveUsers(user.id, ip_address, port, datetime.datetime.now())
+        new_active_user = self.ActiveUsers(user_id, ip_address, port, datetime.datetime.now())
         self.session.add(new_active_user)  # добавление в таблицу активных пользователей
 
-        history = self.LoginHistory(user.id, datetime.datetime.now(), ip_address, port)  # история входов
+        history = self.LoginHistory(user_id, datetime.datetime.now(), ip_address, port)  # история входов
         self.session.add(history)  # добавление в таблицу истории входов
 
         self.session.commit()  # сохранение изменений
 
+    def add_user(self, username):
+        """
+        Метод регистрации нового пользователя вместе со строкой счётчиков сообщений
+        """
+
+        user = self.AllUsers(username)
+        self.session.add(user)
+        self.session.commit()  # фиксация нужна сразу, чтобы получить id пользователя
+        self.session.add(self.UsersHistory(user.id))
+        self.session.add(self.Changes(None, user.id))
+        self.session.commit()
+        # Имя могло остаться в кеше от другого пользователя, поэтому запись заменяется.
+        self.user_ids.invalidate(username)
+        self.user_ids.put(username, user.id)
+        return user
+
+    def user_id(self, username):
+        """
+        Метод получения id пользователя по имени, None – если пользователя нет.
+        Отсутствие пользователя не кешируется: в режиме кластера его может зарегистрировать другой процесс.
+        """
+
+        user_id = self.user_ids.get(username)
+        if user_id is None:
+            row = self.session.query(self.AllUsers.id).filter_by(name=username).first()
+            if row:
+                user_id = row[0]
+                self.user_ids.put(username, user_id)
+        return user_id
+
+    def user_name(self, user_id):
+        """
+        Метод получения имени пользователя по id, None – если пользователя нет
+        """
+
+        username = self.user_ids.get_name(user_id)
+        if username is None:
+            row = self.session.query(self.AllUsers.name).filter_by(id=user_id).first()
+            if row:
+                username = row[0]
+                self.user_ids.put(username, user_id)
+        return username
+
     def user_logout(self, username):
         """
         Метод регистрации отключённого пользователя
         """
 
-        user = self.session.query(self.AllUsers).filter_by(name=username).first()  # нужный пользователь
+        user_id = self.user_id(username)  # нужный пользователь
 
-        self.session.query(self.ActiveUsers).filter_by(user=user.id).delete()  # удаление из таблицы активных
+        self.session.query(self.ActiveUsers).filter_by(user=user_id).delete()  # удаление из таблицы активных
 
         self.session.commit()  # сохранение изменений
 
-    def process_message(self, sender, recipient):
+    def process_message(self, sender, recipient, text=None):
         """
-        Метод регистрации сообщения
+        Метод регистрации сообщения: счётчики отправителя и получателя и, если передан текст, запись в архив
         """
 
-        sender = self.session.query(self.AllUsers).filter_by(name=sender).first().id
-        recipient = self.session.query(self.AllUsers).filter_by(name=recipient).first().id
-        # Запрашиваем строки из истории и увеличиваем счётчики
-        sender_row = self.session.query(self.UsersHistory).filter_by(user=sender).first()
-        sender_row.sent += 1
-        recipient_row = self.session.query(self.UsersHistory).filter_by(user=recipient).first()
-        recipient_row.accepted += 1
-
+        sender = self.user_id(sender)
+        recipient = self.user_id(recipient)
+        # Неизвестные пользователи не учитываются, сообщение самому себе увеличивает оба счётчика одной строки.
+        counters = {}
+        for user_id, delta in ((sender, (1, 0)), (recipient, (0, 1))):
+            if user_id is not None:
+                sent, accepted = counters.get(user_id, (0, 0))
+                counters[user_id] = (sent + delta[0], accepted + delta[1])
+        if counters:
+            self.update_counters(counters)
+        if text is not None and sender is not None and recipient is not None:
+            self.session.bulk_insert_mappings(self.Archive, [self.archive_row(sender, recipient, text)])
         self.session.commit()  # add_new
 
+    @staticmethod
+    def archive_row(sender, recipient, text, sent=None):
+        """
+        Строка архива для сообщения от пользователя с id sender пользователю с id recipient.
+        sent – время получения сообщения сервером, по умолчанию текущее.
+        """
+
+        return {'first': min(sender, recipient), 'second': max(sender, recipient), 'sender': sender,
+                'time': time.time() if sent is None else sent, 'message': text}
+
+    def get_history(self, username, peer, cursor=None, limit=HISTORY_PAGE_SIZE):
+        """
+        Метод получения страницы переписки пользователей username и peer из архива.
+        Возвращает (сообщения, курсор). Сообщения – кортежи (от кого, кому, текст, время, id) по порядку,
+        это последние limit сообщений перед курсором (время, id) или самые последние, если курсора нет.
+        Курсор ответа – для запроса предыдущей страницы, None – более ранних сообщений нет.
+        Выборка идёт по индексу диалога и не зависит от размера архива.
+        """
+
+        user, other = self.user_id(username), self.user_id(peer)
+        if user is None or other is None:
+            return [], None
+        query = self.session.query(self.Archive.sender, self.Archive.message, self.Archive.time, self.Archive.id). \
+            filter(self.Archive.first == min(user, other), self.Archive.second == max(user, other))
+        if cursor is not None:
+            query = query.filter(tuple_(self.Archive.time, self.Archive.id) < tuple_(*cursor))
+        rows = query.order_by(self.Archive.time.desc(), self.Archive.id.desc()).limit(limit).all()
+        rows.reverse()
+        names = {user: username, other: peer}
+        messages = [(names[sender], names[other if sender == user else user], text, sent, message_id)
+                    for sender, text, sent, message_id in rows]
+        return messages, ([rows[0][2], rows[0][3]] if len(rows) == limit else None)
+
+    def update_counters(self, counters):
+        """
+        Метод увеличения счётчиков отправленных и принятых сообщений без фиксации транзакции.
+        counters – словарь id пользователя -> (отправлено, принято). Недостающие строки истории создаются.
+        """
+
+        existing = {row[0] for row in self.session.query(self.UsersHistory.user).
+                    filter(self.UsersHistory.user.in_(list(counters)))}
+        new_rows = []
+        for user_id, (sent, accepted) in counters.items():
+            if user_id in existing:
+                self.session.query(self.UsersHistory).filter_by(user=user_id).update(
+                    {self.UsersHistory.sent: self.UsersHistory.sent + sent,
+                     self.UsersHistory.accepted: self.UsersHistory.accepted + accepted},
+                    synchronize_session=False)
+            else:
+                new_rows.append({'user': user_id, 'sent': sent, 'accepted': accepted})
+        if new_rows:
+            self.session.bulk_insert_mappings(self.UsersHistory, new_rows)
+
+    def tick(self):
+        """
+        Метод периодического обслуживания базы из цикла сервера. Все изменения этого класса фиксируются сразу,
+        обслуживание – только удаление устаревших сообщений для пользователей не в сети раз в OFFLINE_PURGE_INTERVAL:
+        иначе сообщения тех, кто больше не подключается, копились бы до перезапуска сервера.
+        Возвращает время в секундах до следующего удаления.
+        """
+
+        remaining = self.purged_at + OFFLINE_PURGE_INTERVAL - time.monotonic()
+        if remaining <= 0:
+            try:
+                self.purge_offline_messages()
+            except SQLAlchemyError as err:
+                # Ошибка базы не должна останавливать цикл сервера, удаление повторится через интервал.
+                self.session.rollback()
+                self.purged_at = time.monotonic()
+                logger.error(f'Не удалось удалить устаревшие сообщения: {err}')
+            remaining = OFFLINE_PURGE_INTERVAL
+        return remaining
+
+    @property
+    def session(self):
+        return self.Session()
+
+    def end_session(self):
+        """
+        Метод завершения сессии текущего потока. Подключение возвращается в пул.
+        """
+
+        self.Session.remove()
+
+    def close(self):
+        """
+        Метод закрытия сессии базы данных при остановке сервера
+        """
+
+        self.end_session()
+        self.database_engine.dispose()
+
+    def store_offline_message(self, recipient, message, ttl=OFFLINE_MESSAGE_TTL):
+        """
+        Метод сохранения сообщения для пользователя не в сети.
+        Возвращает False, если такого пользователя нет.
+        """
+
+        user_id = self.user_id(recipient)
+        if user_id is None:
+            return False
+        expires = datetime.datetime.now() + datetime.timedelta(seconds=ttl)
+        self.session.add(self.OfflineMessages(user_id, dumps(message), expires))
+        self.session.commit()
+        return True
+
+    def offline_messages(self, username):
+        """
+        Метод выдачи сообщений, накопленных для пользователя, в порядке поступления.
+        Сообщения остаются в очереди, пока их не удалит remove_offline_messages после отправки.
+        Возвращает (id последнего сообщения, сообщения), None вместо id – если сообщений нет.
+        """
+
+        user_id = self.user_id(username)
+        if user_id is None:
+            return None, []
+        rows = self.session.query(self.OfflineMessages.id, self.OfflineMessages.message). \
+            filter(self.OfflineMessages.user == user_id,
+                   self.OfflineMessages.expires > datetime.datetime.now()). \
+            order_by(self.OfflineMessages.id).all()
+        return (rows[-1][0] if rows else None), [loads(row[1]) for row in rows]
+
+    def remove_offline_messages(self, username, last_id):
+        """
+        Метод удаления отправленных сообщений пользователя – по last_id включительно – и его устаревших сообщений.
+        Сообщения, сохранённые после выдачи, остаются в очереди.
+        """
+
+        user_id = self.user_id(username)
+        if user_id is None:
+            return
+        self.session.query(self.OfflineMessages). \
+            filter(self.OfflineMessages.user == user_id,
+                   or_(self.OfflineMessages.id <= last_id,
+                       self.OfflineMessages.expires <= datetime.datetime.now())). \
+            delete(synchronize_session=False)
+        self.session.commit()
+
+    def purge_offline_messages(self):
+        """
+        Метод удаления сообщений с истёкшим сроком хранения
+        """
+
+        self.session.query(self.OfflineMessages). \
+            filter(self.OfflineMessages.expires <= datetime.datetime.now()).delete()
+        self.session.commit()
+        self.purged_at = time.monotonic()
+
+    def join_group(self, username, group_name):
+        """
+        Метод добавления пользователя в групповой чат. Если группы нет, она создаётся.
+        """
+
+        user_id = self.user_id(username)
+        group = self.session.query(self.Groups).filter_by(name=group_name).first()
+        if not group:
+            group = self.Groups(group_name)
+            self.session.add(group)
+            try:
+                self.session.commit()
+            except IntegrityError:
+                # Группу одновременно создал другой процесс сервера (режим кластера).
+                self.session.rollback()
+                group = self.session.query(self.Groups).filter_by(name=group_name).first()
+        if not self.session.query(self.GroupMembers).filter_by(group=group.id, user=user_id).count():
+            self.session.add(self.GroupMembers(group.id, user_id))
+            self.session.commit()
+
+    def leave_group(self, username, group_name):
+        """
+        Метод удаления пользователя из группового чата
+        """
+
+        user_id = self.user_id(username)
+        group = self.session.query(self.Groups).filter_by(name=group_name).first()
+        if user_id is not None and group:
+            self.session.query(self.GroupMembers).filter_by(group=group.id, user=user_id).delete()
+            self.session.commit()
+
+    def group_members(self, group_name):
+        """
+        Метод получения имён участников группового чата
+        """
+
+        query = self.session.query(self.AllUsers.name). \
+            join(self.GroupMembers, self.GroupMembers.user == self.AllUsers.id). \
+            join(self.Groups, self.GroupMembers.group == self.Groups.id). \
+            filter(self.Groups.name == group_name)
+        return [row[0] for row in query.all()]
+
     def add_contact(self, user, contact):
         """
-        Метод добавления контакта в список контактов пользователя
+        Метод добавления контакта в список контактов пользователя.
+        Возвращает False, если пользователя или контакта нет.
         """
 
-        user = self.session.query(self.AllUsers).filter_by(name=user).first()  # пользователь
-        contact = self.session.query(self.AllUsers).filter_by(name=contact).first()  # пользователя-контакт
+        user = self.user_id(user)  # пользователь
+        contact = self.user_id(contact)  # пользователя-контакт
 
-        already_exist = self.session.query(self.UsersContacts).filter_by(user=user.id, contact=contact.id)
-        print(bool(already_exist))
+        if user is None or contact is None:  # пользователь или контакт не существуют
+            return False
 
-        if user and contact and not already_exist:  # если пользователь и контакт существуют,
-            # и контакта пользователя еще не существует в списке его контактов, то
-            contact_row = self.UsersContacts(user.id, contact.id)  # создается запись для таблицы контактов
+        already_exist = self.session.query(self.UsersContacts).filter_by(user=user, contact=contact).count()
+
+        if not already_exist:  # если контакта пользователя еще не существует в списке его контактов, то
+            contact_row = self.UsersContacts(user, contact)  # создается запись для таблицы контактов
             self.session.add(contact_row)  # добавляется запись в таблицу контактов
+            self.session.add(self.Changes(user, contact))  # и в журнал изменений
             self.session.commit()  # сохраняется
+        return True
 
     def remove_contact(self, user, contact):
         """
@@ -212,17 +703,19 @@ class ServerDB:
         """
 
         # контакт, который нужно удалить
-        contact = self.session.query(self.UsersContacts).filter_by(user=user, contact=contact).first()
+        contact = self.user_id(contact)
 
         # пользователь, из списка контактов которого нужно удалить контакт
-        user = self.session.query(self.AllUsers).filter_by(name=user).first()
+        user = self.user_id(user)
 
-        if user and contact:  # если пользователь существует и в списках его контактов присутствует удаляемый контакт, то
+        if user is not None and contact is not None:  # если пользователь и контакт существуют, то
             # удаляем контакт
-            self.session.query(self.UsersContacts).filter(
-                self.UsersContacts.user == user.id,
-                self.UsersContacts.contact == contact.id
+            deleted = self.session.query(self.UsersContacts).filter(
+                self.UsersContacts.user == user,
+                self.UsersContacts.contact == contact
             ).delete()
+            if deleted:
+                self.session.add(self.Changes(user, contact, True))
             self.session.commit()  # add_new
 
     def users_list(self):
@@ -237,6 +730,60 @@ class ServerDB:
 
         return query.all()
 
+    def sync_version(self):
+        """
+        Метод получения текущей версии списков для синхронизации клиентов – номера последнего изменения
+        """
+
+        return self.session.query(func.max(self.Changes.id)).scalar() or 0
+
+    def changes(self, owner, since, version):
+        """
+        Метод чтения изменений списка owner с версии since (не включая) по version включительно.
+        Возвращает словарь: имя пользователя – True, если он удалён из списка, False – если добавлен.
+        Номера изменений выдаются по порядку фиксации, поэтому все изменения до version уже записаны.
+        """
+
+        query = self.session.query(self.AllUsers.name, self.Changes.removed). \
+            join(self.Changes, self.Changes.name == self.AllUsers.id). \
+            filter(self.Changes.owner == owner, self.Changes.id > since, self.Changes.id <= version). \
+            order_by(self.Changes.id)
+        # Из нескольких изменений одного пользователя действует последнее.
+        return {name: removed for name, removed in query}
+
+    def sync_base(self, since, epoch):
+        """
+        Метод проверки версии, известной клиенту. Возвращает (текущая версия, delta).
+        delta = True, если по журналу можно выдать изменения после since: клиент уже синхронизировался (since > 0)
+        с этой же базой (эпоха совпадает), и его версия не новее текущей.
+        Иначе клиенту нужен полный список.
+        """
+
+        version = self.sync_version()
+        return version, epoch == self.epoch and 0 < since <= version
+
+    def users_changes(self, since, epoch=None):
+        """
+        Метод синхронизации списка пользователей. Возвращает (версия, имена, delta).
+        Если по since можно выдать изменения, возвращаются только пользователи, зарегистрированные после неё,
+        и delta = True. Иначе возвращается полный список и delta = False.
+        """
+
+        version, delta = self.sync_base(since, epoch)
+        if not delta:
+            return version, [row[0] for row in self.session.query(self.AllUsers.name)], False
+        return version, list(self.changes(None, since, version)), True
+
+    def contacts_changes(self, username, since, version):
+        """
+        Метод чтения изменений списка контактов пользователя после версии since по version.
+        Возвращает (добавленные, удалённые).
+        """
+
+        changes = self.changes(self.user_id(username), since, version)
+        return [name for name, removed in changes.items() if not removed], \
+            [name for name, removed in changes.items() if removed]
+
     def active_users_list(self):
         """
         Метод возврата списка активных пользователей
@@ -272,10 +819,10 @@ class ServerDB:
         Метод получения контактов конкретного пользователя
         """
 
-        user = self.session.query(self.AllUsers).filter_by(name=username).one()  # пользователь
+        user_id = self.user_id(username)  # пользователь
 
         query = self.session.query(self.UsersContacts, self.AllUsers.name). \
-            filter_by(user=user.id). \
+            filter_by(user=user_id). \
             join(self.AllUsers, self.UsersContacts.contact == self.AllUsers.id)
 
         # выбираем только имена пользователей и возвращаем их.
@@ -294,3 +841,296 @@ class ServerDB:
         ).join(self.AllUsers)
 
         return query.all()
+
+
+class WriteBehindDB:
+    """
+    Слой отложенной записи перед базой данных сервера.
+    Вход и выход пользователей, история входов, счётчики и архив сообщений накапливаются в памяти и записываются
+    одной транзакцией, когда набирается DB_BATCH_SIZE изменений или проходит DB_FLUSH_INTERVAL секунд
+    с первого незаписанного изменения. Повторные изменения одной записи объединяются.
+    Регистрация новых пользователей, контакты, группы и сообщения для пользователей не в сети
+    записываются сразу – их потеря недопустима. Остальные методы передаются базе без изменений.
+
+    Режим durability:
+        sync – каждое изменение фиксируется сразу, как без этого слоя;
+        batch – при аварийном завершении сервера теряется не больше одного пакета истории входов, счётчиков
+        и архива.
+        Таблица активных пользователей всё равно очищается при запуске сервера.
+    """
+
+    def __init__(self, database, durability=DB_DURABILITY, batch_size=DB_BATCH_SIZE, flush_interval=DB_FLUSH_INTERVAL):
+        self.database = database
+        self.durability = durability
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        # Время последнего входа: id пользователя -> время.
+        self.last_login = dict()
+        # Итоговое состояние активных пользователей: id -> (ip, порт, время входа) или None, если пользователь вышел.
+        self.active = dict()
+        # Записи истории входов в порядке поступления.
+        self.history = []
+        # Приращения счётчиков: id пользователя -> [отправлено, принято].
+        self.counters = dict()
+        # Строки архива сообщений в порядке поступления.
+        self.archive = []
+        # Число незаписанных изменений и время первого из них.
+        self.pending = 0
+        self.pending_since = None
+        # Накопленные изменения могут записываться из потока пула, пока цикл сервера добавляет новые.
+        self.lock = Lock()
+        self.flush_lock = Lock()
+
+    def __getattr__(self, name):
+        return getattr(self.database, name)
+
+    def user_login(self, username, ip_address, port):
+        """
+        Метод записи данных пользователя при входе на сервер.
+        Новый пользователь регистрируется сразу, остальное записывается с очередным пакетом.
+        """
+
+        now = datetime.datetime.now()
+        user_id = self.database.user_id(username)
+        new_user = user_id is None
+        if new_user:
+            user_id = self.database.add_user(username).id
+        with self.lock:
+            if not new_user:
+                self.last_login[user_id] = now
+            self.active[user_id] = (ip_address, port, now)
+            self.history.append({'name': user_id, 'date_time': now, 'ip': ip_address, 'port': port})
+        self.changed()
+
+    def user_logout(self, username):
+        """
+        Метод регистрации отключённого пользователя
+        """
+
+        user_id = self.database.user_id(username)
+        if user_id is not None:
+            with self.lock:
+                self.active[user_id] = None
+            self.changed()
+
+    def process_message(self, sender, recipient, text=None):
+        """
+        Метод регистрации сообщения в счётчиках отправителя и получателя и, если передан текст, в архиве.
+        Время сообщения в архиве – время вызова, а не записи пакета.
+        """
+
+        ids = []
+        for username, index in ((sender, 0), (recipient, 1)):
+            user_id = self.database.user_id(username)
+            ids.append(user_id)
+            if user_id is not None:
+                with self.lock:
+                    self.counters.setdefault(user_id, [0, 0])[index] += 1
+        if text is not None and None not in ids:
+            row = self.database.archive_row(ids[0], ids[1], text)
+            with self.lock:
+                self.archive.append(row)
+        self.changed()
+
+    def changed(self):
+        """
+        Метод учёта нового изменения: запись пакета по размеру или сразу в режиме sync
+        """
+
+        with self.lock:
+            self.pending += 1
+            if self.pending_since is None:
+                self.pending_since = time.monotonic()
+            full = self.durability == DB_DURABILITY_SYNC or self.pending >= self.batch_size
+        if full:
+            self.flush()
+
+    def tick(self):
+        """
+        Метод, вызываемый циклом сервера после обработки событий. Записывает пакет, если истёк интервал,
+        и выполняет периодическое обслуживание базы.
+        Возвращает время в секундах до следующей записи или обслуживания, None – ждать нечего.
+        """
+
+        maintenance = self.database.tick()
+        if self.pending_since is None:
+            return maintenance
+        remaining = self.pending_since + self.flush_interval - time.monotonic()
+        if remaining <= 0:
+            self.flush()
+            return maintenance
+        return remaining if maintenance is None else min(remaining, maintenance)
+
+    def flush(self):
+        """
+        Метод записи всех накопленных изменений одной транзакцией.
+        Накопленное забирается под блокировкой, а записывается без неё, чтобы цикл сервера не ждал базу.
+        Пакеты из разных потоков записываются строго по очереди.
+        Ошибка записи не передаётся вызывающему: транзакция откатывается, а пакет при временной ошибке
+        (база заблокирована другим процессом кластера) возвращается в накопленное и записывается через
+        DB_FLUSH_INTERVAL. Пакет, который база отвергла по другой причине, повторно не записать, он отбрасывается.
+        """
+
+        with self.flush_lock:
+            with self.lock:
+                if not self.pending:
+                    return
+                last_login, active, history, counters = self.last_login, self.active, self.history, self.counters
+                archive, pending = self.archive, self.pending
+                self.last_login, self.active, self.history, self.counters = dict(), dict(), [], dict()
+                self.archive = []
+                self.pending = 0
+                self.pending_since = None
+            database = self.database
+            session = database.session
+            try:
+                self.write_batch(last_login, active, history, counters, archive)
+            except OperationalError as err:
+                session.rollback()
+                logger.error(f'Не удалось записать пакет изменений в базу, запись будет повторена: {err}')
+                self.restore_batch(last_login, active, history, counters, archive, pending)
+            except SQLAlchemyError as err:
+                session.rollback()
+                logger.error(f'Пакет изменений отвергнут базой и отброшен ({pending} изменений): {err}')
+
+    def write_batch(self, last_login, active, history, counters, archive):
+        """
+        Метод записи пакета изменений одной транзакцией
+        """
+
+        database = self.database
+        session = database.session
+        if last_login:
+            session.bulk_update_mappings(database.AllUsers, [{'id': user_id, 'last_login': login_time}
+                                                             for user_id, login_time in last_login.items()])
+        if active:
+            session.query(database.ActiveUsers).filter(database.ActiveUsers.user.in_(list(active))). \
+                delete(synchronize_session=False)
+            session.bulk_insert_mappings(database.ActiveUsers, [
+                {'user': user_id, 'ip_address': state[0], 'port': state[1], 'login_time': state[2]}
+                for user_id, state in active.items() if state])
+        if history:
+            session.bulk_insert_mappings(database.LoginHistory, history)
+        if counters:
+            database.update_counters(counters)
+        if archive:
+            session.bulk_insert_mappings(database.Archive, archive)
+        session.commit()
+
+    def restore_batch(self, last_login, active, history, counters, archive, pending):
+        """
+        Метод возврата незаписанного пакета в накопленные изменения. Изменения, накопленные после того,
+        как пакет был забран, новее пакета и имеют приоритет; приращения счётчиков складываются.
+        """
+
+        with self.lock:
+            last_login.update(self.last_login)
+            active.update(self.active)
+            for user_id, (sent, accepted) in self.counters.items():
+                delta = counters.setdefault(user_id, [0, 0])
+                delta[0] += sent
+                delta[1] += accepted
+            self.last_login, self.active, self.counters = last_login, active, counters
+            self.history = history + self.history
+            self.archive = archive + self.archive
+            self.pending += pending
+            # Повтор через интервал, а не на каждом проходе цикла, пока база занята.
+            self.pending_since = time.monotonic()
+
+    def close(self):
+        """
+        Метод остановки: записывает накопленные изменения и закрывает базу
+        """
+
+        self.flush()
+        self.database.close()
+
+    # Чтение данных, которые могут быть в незаписанном пакете, выполняется после записи пакета.
+    def users_list(self):
+        self.flush()
+        return self.database.users_list()
+
+    def active_users_list(self):
+        self.flush()
+        return self.database.active_users_list()
+
+    def login_history(self, username=None):
+        self.flush()
+        return self.database.login_history(username)
+
+    def message_history(self):
+        self.flush()
+        return self.database.message_history()
+
+    def get_history(self, username, peer, cursor=None, limit=HISTORY_PAGE_SIZE):
+        self.flush()
+        return self.database.get_history(username, peer, cursor, limit)
+
+
+class DBWorkerPool:
+    """
+    Пул потоков для запросов к базе данных вне цикла сервера.
+    Запрос возвращает Future, а функция обратного вызова выполняется уже в цикле сервера:
+    поток пула кладёт готовый запрос в очередь и будит селектор байтом в служебный сокет.
+    Каждый запрос выполняется в своей сессии, после запроса подключение возвращается в пул.
+    """
+
+    def __init__(self, database, workers=DB_WORKERS):
+        self.database = database
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='server-db')
+        # Выполненные запросы, ожидающие обратного вызова в цикле сервера.
+        self.completed = deque()
+        # Служебная пара сокетов: читающий конец регистрируется в селекторе сервера.
+        self.wakeup_reader, self.wakeup_writer = socketpair()
+        self.wakeup_reader.setblocking(False)
+        self.wakeup_writer.setblocking(False)
+
+    def fileno(self):
+        return self.wakeup_reader.fileno()
+
+    def run(self, method, *args):
+        """
+        Выполнение запроса в потоке пула в собственной сессии потока
+        """
+
+        try:
+            return method(*args)
+        finally:
+            self.database.end_session()
+
+    def submit(self, callback, method, *args):
+        """
+        Метод постановки запроса method(*args) в пул. callback(future) будет вызван в цикле сервера
+        после вызова run_callbacks.
+        """
+
+        future = self.executor.submit(self.run, method, *args)
+        future.add_done_callback(lambda done: self.complete(done, callback))
+        return future
+
+    def complete(self, future, callback):
+        self.completed.append((future, callback))
+        try:
+            self.wakeup_writer.send(b'\0')
+        except BlockingIOError:
+            # Буфер служебного сокета полон – цикл и так проснётся.
+            pass
+
+    def run_callbacks(self):
+        """
+        Метод, вызываемый циклом сервера, когда служебный сокет готов к чтению
+        """
+
+        try:
+            while self.wakeup_reader.recv(4096):
+                pass
+        except BlockingIOError:
+            pass
+        while self.completed:
+            future, callback = self.completed.popleft()
+            callback(future)
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+        self.wakeup_reader.close()
+        self.wakeup_writer.close()
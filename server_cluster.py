@@ -0,0 +1,401 @@
+from bisect import bisect
+from hashlib import md5
+from logging import getLogger
+from multiprocessing import get_context
+from selectors import DefaultSelector, EVENT_READ, EVENT_WRITE
+from socket import socket, socketpair, send_fds, recv_fds, AF_INET, AF_UNIX, SOCK_STREAM, SOCK_SEQPACKET
+from common.variables import *
+from common.utils import *
+import logs.config_server_log
+from descrptrs import Port
+from metaclasses import ServerVerifier
+from server import Server, ClientConnection, stop_on_sigterm
+
+# Инициализация логирования сервера.
+logger = getLogger('server')
+
+# Сообщение о готовности рабочего процесса к приёму подключений.
+WORKER_READY = b'ready'
+
+
+class ShardRing:
+    """
+    Кольцо согласованного хеширования: определяет рабочий процесс, которому принадлежит имя пользователя.
+    Каждый процесс представлен на кольце несколькими виртуальными узлами, чтобы пользователи распределялись равномерно.
+    Хеш не зависит от PYTHONHASHSEED, поэтому все процессы получают одинаковое распределение.
+    """
+
+    def __init__(self, workers, virtual_nodes=CLUSTER_VIRTUAL_NODES):
+        points = sorted((self.hash(f'{worker}-{node}'), worker)
+                        for worker in range(workers) for node in range(virtual_nodes))
+        self.points = [point for point, worker in points]
+        self.workers = [worker for point, worker in points]
+
+    @staticmethod
+    def hash(key):
+        return int.from_bytes(md5(key.encode(ENCODING)).digest()[:8], 'big')
+
+    def owner(self, username):
+        """
+        Метод определения номера рабочего процесса, обслуживающего пользователя
+        """
+
+        return self.workers[bisect(self.points, self.hash(username)) % len(self.points)]
+
+
+class ShardWorker(Server):
+
+    def __init__(self, listen_address, listen_port, database, index, ring, control, peers,
+                 overflow_policy=OUTBOUND_OVERFLOW_POLICY, db_pool=None):
+        """
+        Рабочий процесс кластера: обслуживает пользователей своей доли кольца.
+        Подключения передаёт распределитель после сообщения о присутствии, сообщения для пользователей
+        других процессов пересылаются их владельцам через локальные сокеты.
+        """
+
+        super().__init__(listen_address, listen_port, database, overflow_policy, db_pool=db_pool)
+        self.index = index
+        self.ring = ring
+        # Канал от распределителя, по которому приходят сокеты клиентов.
+        self.control = control
+        # Сокеты связи с остальными рабочими процессами: номер процесса -> сокет.
+        self.peer_sockets = peers
+        # Соединения с остальными процессами и их декодеры кадров.
+        self.peers = dict()
+        self.peer_decoders = dict()
+
+    def init_socket(self):
+        """
+        Инициализация селектора: канал распределителя и соединения с остальными процессами.
+        Слушающего сокета у рабочего процесса нет.
+        """
+
+        logger.info(f'Запущен рабочий процесс {self.index} кластера, порт для подключений: {self.port}.')
+        self.selector = DefaultSelector()
+        self.selector.register(self.control, EVENT_READ)
+        if self.db_pool:
+            self.selector.register(self.db_pool, EVENT_READ)
+        for index, sock in self.peer_sockets.items():
+            # Пересылка между процессами не должна теряться, поэтому переполнение буфера сбрасывается во временный файл.
+            peer = ClientConnection(sock, f'worker-{index}', self.wait_peer_writable, self.high_watermark,
+                                    self.low_watermark, OVERFLOW_SPILL)
+            self.peers[index] = peer
+            self.peer_decoders[peer] = FrameDecoder()
+            self.selector.register(peer, EVENT_READ)
+
+    def main_loop(self):
+        """
+        Метод с основным бесконечным циклом рабочего процесса
+        """
+
+        self.init_socket()
+        timeout = None
+        while True:
+            for key, events in self.selector.select(timeout):
+                if key.fileobj is self.control:
+                    self.accept_handoff()
+                elif key.fileobj is self.db_pool:
+                    self.db_pool.run_callbacks()
+                elif key.fileobj in self.peer_decoders:
+                    if events & EVENT_WRITE:
+                        self.write_peer(key.fileobj)
+                    if events & EVENT_READ:
+                        self.read_peer(key.fileobj)
+                else:
+                    if events & EVENT_WRITE:
+                        self.write_client(key.fileobj)
+                    if events & EVENT_READ:
+                        self.read_client(key.fileobj)
+            self.deliver_messages()
+            timeout = self.database.tick()
+
+    def accept_handoff(self):
+        """
+        Метод приёма сокета клиента от распределителя вместе с уже прочитанными из него байтами.
+        Если распределитель завершился, рабочий процесс тоже завершается.
+        """
+
+        data, fds, flags, address = recv_fds(self.control, MAX_PACKAGE_LENGTH, 1)
+        if not fds:
+            logger.info(f'Распределитель закрыл канал, рабочий процесс {self.index} завершается.')
+            raise SystemExit
+        sock = socket(AF_INET, SOCK_STREAM, fileno=fds[0])
+        try:
+            client_address = sock.getpeername()
+        except OSError:
+            sock.close()
+            return
+        client = self.add_client(sock, client_address)
+        self.read_client(client, data)
+
+    def wait_peer_writable(self, peer):
+        self.selector.modify(peer, EVENT_READ | EVENT_WRITE)
+
+    def write_peer(self, peer):
+        if peer.flush():
+            self.selector.modify(peer, EVENT_READ)
+
+    def read_peer(self, peer):
+        """
+        Метод приёма пересланных сообщений от другого рабочего процесса
+        """
+
+        data = peer.recv(MAX_PACKAGE_LENGTH)
+        if not data:
+            logger.critical(f'Потеряна связь с процессом {peer}, рабочий процесс {self.index} завершается.')
+            raise SystemExit
+        for message in self.peer_decoders[peer].feed(data):
+            self.process_peer_message(message)
+
+    def forward(self, index, message):
+        """
+        Метод пересылки сообщения рабочему процессу index
+        """
+
+        self.peers[index].sendall(self.peers[index].encoder.encode(message))
+
+    def process_peer_message(self, message):
+        """
+        Метод обработки сообщения, пересланного другим рабочим процессом.
+        Личные сообщения ставятся в общую очередь, групповые рассылаются участникам этого процесса.
+        """
+
+        action = message.get(ACTION)
+        if action == MESSAGE:
+            self.messages.append(message)
+        elif action == GROUP_MESSAGE:
+            self.deliver_group_message(message, self.group_members(message[GROUP]), forward=False)
+
+    def process_message(self, message):
+        """
+        Метод адресной отправки сообщения: получателю этого процесса – напрямую, иначе – процессу-владельцу.
+        """
+
+        owner = self.ring.owner(message[DESTINATION])
+        if owner == self.index:
+            super().process_message(message)
+        else:
+            self.forward(owner, message)
+            logger.debug(f'Сообщение для {message[DESTINATION]} переслано процессу {owner}.')
+
+    def deliver_group_message(self, message, members, forward=True):
+        """
+        Метод рассылки группового сообщения: своим участникам напрямую, остальным процессам – одной пересылкой
+        каждому. Участников среди своих пользователей каждый процесс определяет сам: вступление и выход
+        обрабатывает процесс-владелец пользователя, поэтому его кеш участников точен для своих пользователей,
+        а кеш отправителя о чужих вступлениях мог ещё не узнать.
+        """
+
+        super().deliver_group_message(message, members)
+        if forward:
+            for index in self.peers:
+                self.forward(index, message)
+
+
+def run_worker(listen_address, listen_port, index, ring, control, peers, inherited, overflow_policy, durability,
+               db_workers):
+    """
+    Функция запуска рабочего процесса. База данных открывается в самом процессе,
+    соединения с ней не наследуются от распределителя. Модуль базы тоже импортируется только в рабочем процессе:
+    распределителю SQLAlchemy не нужна.
+    inherited – унаследованные сокеты других процессов. Они закрываются сразу, иначе процесс
+    не заметит закрытия канала распределителем или другим процессом.
+    """
+
+    for sock in inherited:
+        sock.close()
+    stop_on_sigterm()
+    from server_DB import ServerDB, WriteBehindDB, DBWorkerPool
+    database = WriteBehindDB(ServerDB(), durability)
+    db_pool = DBWorkerPool(database, db_workers) if db_workers else None
+    try:
+        worker = ShardWorker(listen_address, listen_port, database, index, ring, control, peers, overflow_policy,
+                             db_pool)
+        control.send(WORKER_READY)
+        worker.main_loop()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if db_pool:
+            db_pool.close()
+        database.close()
+        logger.info(f'Кеш пользователей базы данных процесса {index}: {database.user_ids.stats()}')
+        # Процесс multiprocessing завершается без atexit: очередь логов дописывается здесь.
+        logs.config_server_log.LOG_QUEUE.stop()
+
+
+class ShardRouter(metaclass=ServerVerifier):
+    port = Port()
+
+    def __init__(self, listen_address, listen_port, workers=CLUSTER_WORKERS, overflow_policy=OUTBOUND_OVERFLOW_POLICY,
+                 durability=DB_DURABILITY, db_workers=DB_WORKERS):
+        """
+        Распределитель подключений кластера. Принимает подключения, дожидается сообщения о присутствии
+        и передаёт сокет рабочему процессу, которому принадлежит имя пользователя.
+        Дальше распределитель в обмене не участвует.
+        """
+
+        self.addr = listen_address
+        self.port = listen_port
+        self.overflow_policy = overflow_policy
+        self.durability = durability
+        self.db_workers = db_workers
+        self.ring = ShardRing(workers)
+        # Каналы передачи сокетов рабочим процессам и сами процессы.
+        self.workers = []
+        self.processes = []
+        # Подключения, ещё не приславшие сообщение о присутствии: сокет -> (адрес, прочитанные байты, декодер).
+        self.pending = dict()
+        self.selector = None
+
+    def start_workers(self):
+        """
+        Метод запуска рабочих процессов. Процессы запускаются по очереди: следующий стартует,
+        когда предыдущий открыл базу данных, чтобы схема базы не создавалась одновременно из нескольких процессов.
+        """
+
+        count = len(set(self.ring.workers))
+        # Каждая пара процессов связана своей парой сокетов.
+        links = {(first, second): socketpair(AF_UNIX, SOCK_STREAM)
+                 for first in range(count) for second in range(first + 1, count)}
+        context = get_context('fork')
+        for index in range(count):
+            control, worker_control = socketpair(AF_UNIX, SOCK_SEQPACKET)
+            peers = dict()
+            inherited = [control] + self.workers
+            for (first, second), pair in links.items():
+                if first == index:
+                    peers[second] = pair[0]
+                    inherited.append(pair[1])
+                elif second == index:
+                    peers[first] = pair[1]
+                    inherited.append(pair[0])
+                else:
+                    inherited.extend(pair)
+            process = context.Process(target=run_worker, daemon=True,
+                                      args=(self.addr, self.port, index, self.ring, worker_control, peers,
+                                            inherited, self.overflow_policy, self.durability, self.db_workers))
+            process.start()
+            worker_control.close()
+            if control.recv(len(WORKER_READY)) != WORKER_READY:
+                raise RuntimeError(f'Рабочий процесс {index} кластера не запустился.')
+            self.workers.append(control)
+            self.processes.append(process)
+        for pair in links.values():
+            pair[0].close()
+            pair[1].close()
+
+    def init_socket(self):
+        """
+        Инициализация слушающего сокета
+        """
+
+        logger.info(
+            f'Запущен кластер из {len(self.workers)} процессов, порт для подключений: {self.port} , адрес с которого принимаются подключения: {self.addr}. Если адрес не указан, принимаются соединения с любых адресов.')
+        transport = socket(AF_INET, SOCK_STREAM)
+        transport.bind((self.addr, self.port))
+        transport.setblocking(False)
+        self.sock = transport
+        self.sock.listen(MAX_CONNECTIONS)
+        self.selector = DefaultSelector()
+        self.selector.register(self.sock, EVENT_READ)
+
+    def main_loop(self):
+        """
+        Метод с основным бесконечным циклом распределителя
+        """
+
+        self.start_workers()
+        self.init_socket()
+        try:
+            while True:
+                for key, events in self.selector.select():
+                    if key.fileobj is self.sock:
+                        self.accept_clients()
+                    else:
+                        self.read_client(key.fileobj)
+        finally:
+            for process in self.processes:
+                process.terminate()
+
+    def accept_clients(self):
+        """
+        Метод приёма всех ожидающих подключений
+        """
+
+        while True:
+            try:
+                client, client_address = self.sock.accept()
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError as err:
+                logger.error(f'Не удалось принять подключение: {err}')
+                return
+            client.setblocking(False)
+            self.pending[client] = (client_address, bytearray(), FrameDecoder(MAX_PACKAGE_LENGTH))
+            self.selector.register(client, EVENT_READ)
+
+    def read_client(self, client):
+        """
+        Метод чтения начала потока клиента до первого сообщения.
+        Вместе с сокетом рабочему процессу передаются все прочитанные байты, поэтому ничего не теряется.
+        Сообщение о присутствии должно уместиться в MAX_PACKAGE_LENGTH байт.
+        """
+
+        client_address, received, decoder = self.pending[client]
+        try:
+            data = client.recv(MAX_PACKAGE_LENGTH - len(received))
+            if not data:
+                raise ConnectionResetError
+            received += data
+            messages = decoder.feed(data)
+        except (BlockingIOError, InterruptedError):
+            return
+        except Exception:
+            self.close_client(client)
+            return
+        if messages:
+            username = self.presence_name(messages[0])
+            if username is None:
+                self.reject_client(client, 'Первым сообщением должно быть сообщение о присутствии.')
+                return
+            index = self.ring.owner(username)
+            try:
+                send_fds(self.workers[index], [bytes(received)], [client.fileno()])
+                logger.info(f'Подключение {client_address} пользователя {username} передано процессу {index}.')
+            except OSError as err:
+                logger.error(f'Не удалось передать подключение {client_address} процессу {index}: {err}')
+            self.close_client(client)
+        elif len(received) >= MAX_PACKAGE_LENGTH:
+            self.reject_client(client, 'Сообщение о присутствии слишком длинное.')
+
+    @staticmethod
+    def presence_name(message):
+        """
+        Метод получения имени пользователя из сообщения о присутствии, None – если это не оно
+        """
+
+        if message.get(ACTION) == PRESENCE and isinstance(message.get(USER), dict):
+            username = message[USER].get(ACCOUNT_NAME)
+            if isinstance(username, str):
+                return username
+        return None
+
+    def reject_client(self, client, text):
+        response = dict(RESPONSE_400)
+        response[ERROR] = text
+        try:
+            send_message(client, response)
+        except OSError:
+            pass
+        self.close_client(client)
+
+    def close_client(self, client):
+        """
+        Метод, завершающий работу распределителя с подключением. Переданный рабочему процессу сокет
+        остаётся открытым в этом процессе.
+        """
+
+        del self.pending[client]
+        self.selector.unregister(client)
+        client.close()
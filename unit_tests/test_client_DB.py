@@ -0,0 +1,210 @@
+"""Unit-тесты базы данных клиента"""
+
+import sys
+import os
+import unittest
+from tempfile import TemporaryDirectory
+from sqlalchemy.orm import clear_mappers
+sys.path.append(os.path.join(os.getcwd(), '..'))
+from client_DB import ClientDB
+
+
+class TestBulkWrites(unittest.TestCase):
+    '''
+    Тесты пакетной записи пользователей, контактов и сообщений
+    '''
+
+    def setUp(self):
+        self.database = ClientDB('user1', 'sqlite:///:memory:')
+
+    def tearDown(self):
+        clear_mappers()
+
+    def test_replace_users(self):
+        """Новый список пользователей заменяет старый"""
+        self.database.add_users([f'user{i}' for i in range(1000)])
+        self.database.add_users(['user1', 'user2'])
+        self.assertEqual(sorted(self.database.get_users()), ['user1', 'user2'])
+        self.assertTrue(self.database.check_user('user2'))
+        self.assertFalse(self.database.check_user('user3'))
+
+    def test_upsert_contacts(self):
+        """Повторно добавленные контакты не дублируются"""
+        self.database.add_contacts(['user2', 'user3'])
+        self.database.add_contacts(['user3', 'user4'])
+        self.database.add_contact('user2')
+        self.assertEqual(sorted(self.database.get_contacts()), ['user2', 'user3', 'user4'])
+
+    def test_save_messages(self):
+        """Пакет сообщений сохраняется в порядке следования"""
+        self.database.save_messages([('user1', 'user2', 'first'), ('user2', 'user1', 'second')])
+        self.database.save_message('user1', 'user2', 'third')
+        self.assertEqual([row[2] for row in self.database.get_history()], ['first', 'second', 'third'])
+        self.assertEqual([row[2] for row in self.database.get_history(to_who='user1')], ['second'])
+
+    def test_sync_users(self):
+        """Новые пользователи добавляются без дубликатов, версия сохраняется вместе с ними"""
+        self.assertEqual(self.database.get_version(ClientDB.SYNC_USERS), (None, None))
+        self.database.add_users(['user1', 'user2'], 5, 42)
+        self.database.update_users(['user2', 'user3'], 7, 42)
+        self.assertEqual(sorted(self.database.get_users()), ['user1', 'user2', 'user3'])
+        self.assertEqual(self.database.get_version(ClientDB.SYNC_USERS), (7, 42))
+        self.database.add_users(['user1'])
+        self.assertEqual(self.database.get_version(ClientDB.SYNC_USERS), (None, None))
+
+    def test_sync_contacts(self):
+        """Изменения контактов применяются к сохранённому списку"""
+        self.database.replace_contacts(['user2', 'user3'], 3)
+        self.database.update_contacts(['user4'], ['user2'], 4)
+        self.assertEqual(sorted(self.database.get_contacts()), ['user3', 'user4'])
+        self.assertEqual(self.database.get_version(ClientDB.SYNC_CONTACTS), (4, None))
+        self.assertEqual(self.database.get_version(ClientDB.SYNC_USERS), (None, None))
+
+    def test_versions_without_epoch(self):
+        """Версии, сохранённые без эпохи базы сервера, при открытии базы забываются"""
+        clear_mappers()
+        with TemporaryDirectory() as directory:
+            url = f'sqlite:///{directory}/client.db3'
+            database = ClientDB('user1', url)
+            database.session.close()
+            with database.database_engine.begin() as connection:
+                connection.exec_driver_sql('DROP TABLE sync_versions')
+                connection.exec_driver_sql('CREATE TABLE sync_versions (name VARCHAR PRIMARY KEY, version INTEGER)')
+                connection.exec_driver_sql("INSERT INTO sync_versions VALUES ('users', 5)")
+            database.database_engine.dispose()
+            clear_mappers()
+            database = ClientDB('user1', url)
+            self.assertEqual(database.get_version(ClientDB.SYNC_USERS), (None, None))
+            database.add_users(['user2'], 6, 42)
+            self.assertEqual(database.get_version(ClientDB.SYNC_USERS), (6, 42))
+            database.session.close()
+            database.database_engine.dispose()
+
+    def test_empty(self):
+        """Пустые списки ничего не меняют и не вызывают ошибок"""
+        self.database.add_users([])
+        self.database.add_contacts([])
+        self.database.save_messages([])
+        self.assertEqual(self.database.get_users(), [])
+
+
+class TestHistoryPages(unittest.TestCase):
+    '''
+    Тесты постраничной выборки истории сообщений
+    '''
+
+    def setUp(self):
+        self.database = ClientDB('user1', 'sqlite:///:memory:')
+        self.database.save_messages([('user1', 'user2', str(i)) if i % 2 else ('user3', 'user1', str(i))
+                                     for i in range(50)])
+
+    def tearDown(self):
+        clear_mappers()
+
+    def texts(self, rows):
+        return [row[2] for row in rows]
+
+    def test_last_page(self):
+        """Без курсора limit выбирает последние сообщения, before – предыдущую страницу"""
+        page = self.database.get_history(limit=10)
+        self.assertEqual(self.texts(page), [str(i) for i in range(40, 50)])
+        previous = self.database.get_history(before=page[0][4], limit=10)
+        self.assertEqual(self.texts(previous), [str(i) for i in range(30, 40)])
+
+    def test_after(self):
+        """after выбирает сообщения после курсора по порядку"""
+        first = self.database.get_history(limit=3, after=0)
+        self.assertEqual(self.texts(first), ['0', '1', '2'])
+        self.assertEqual(self.texts(self.database.get_history(after=first[-1][4], limit=2)), ['3', '4'])
+
+    def test_peer(self):
+        """Переписка с собеседником включает входящие и исходящие сообщения"""
+        self.database.save_message('user4', 'user1', 'other')
+        self.assertEqual(len(self.database.get_history(peer='user2')), 25)
+        self.assertEqual(self.texts(self.database.get_history(peer='user4')), ['other'])
+
+    def test_iter_history(self):
+        """Ленивый перебор возвращает всю историю по порядку страницами"""
+        self.assertEqual(self.texts(self.database.iter_history(page_size=7)), [str(i) for i in range(50)])
+        self.assertEqual(len(list(self.database.iter_history(to_who='user1', page_size=5))), 25)
+
+    def test_indexes_used(self):
+        """Выборка переписки с собеседником идёт по индексам, а не перебором таблицы"""
+        with self.database.database_engine.connect() as connection:
+            plan = ' '.join(row[-1] for row in connection.exec_driver_sql(
+                'EXPLAIN QUERY PLAN SELECT id FROM message_history WHERE from_user = ? OR to_user = ? '
+                'ORDER BY id DESC LIMIT 20', ('user2', 'user2')))
+        self.assertIn('message_history_from_user_id', plan)
+        self.assertIn('message_history_to_user_id', plan)
+
+
+
+class TestSearch(unittest.TestCase):
+    '''
+    Тесты полнотекстового поиска по истории сообщений
+    '''
+
+    def setUp(self):
+        self.database = ClientDB('user1', 'sqlite:///:memory:')
+        self.database.save_messages([('user2', 'user1', 'Привет, как дела?'),
+                                     ('user1', 'user2', 'Дела хорошо, завтра встреча'),
+                                     ('user3', 'user1', 'Встреча переносится, встреча будет в пятницу'),
+                                     ('user1', 'user_2', 'привет "AND" NOT')])
+
+    def tearDown(self):
+        clear_mappers()
+
+    def ids(self, rows):
+        return [row[4] for row in rows]
+
+    def test_ranking(self):
+        """Сообщение, где слово встречается чаще, выше в выдаче, фрагмент выделяет найденное слово"""
+        found = self.database.search_history('встреча')
+        self.assertEqual(self.ids(found), [3, 2])
+        self.assertIn('[встреча]', found[1][5])
+        self.assertEqual(found[1][:3], ('user1', 'user2', 'Дела хорошо, завтра встреча'))
+
+    def test_words(self):
+        """Находятся сообщения со всеми словами, без учёта регистра и с поиском по началу слова"""
+        self.assertEqual(self.ids(self.database.search_history('ДЕЛА встреча')), [2])
+        self.assertEqual(sorted(self.ids(self.database.search_history('встре*'))), [2, 3])
+        self.assertEqual(self.database.search_history('пока'), [])
+
+    def test_peer(self):
+        """Фильтр по собеседнику учитывает входящие и исходящие и сравнивает имя целиком"""
+        self.assertEqual(self.ids(self.database.search_history('привет', peer='user2')), [1])
+        self.assertEqual(self.ids(self.database.search_history('дела', peer='user2')), [1, 2])
+        self.assertEqual(self.ids(self.database.search_history('привет', peer='user_2')), [4])
+
+    def test_syntax(self):
+        """Операторы и кавычки FTS5 во вводе пользователя ищутся как обычные слова"""
+        self.assertEqual(self.ids(self.database.search_history('"and" NOT')), [4])
+        self.assertEqual(self.database.search_history(' * '), [])
+
+    def test_limit(self):
+        """limit ограничивает число найденных сообщений"""
+        self.assertEqual(len(self.database.search_history('дела', limit=1)), 1)
+
+    def test_backfill(self):
+        """База без индекса поиска индексируется при открытии, дальше индекс обновляется триггерами"""
+        clear_mappers()
+        with TemporaryDirectory() as directory:
+            url = f'sqlite:///{directory}/client.db3'
+            database = ClientDB('user1', url)
+            database.save_message('user2', 'user1', 'старое сообщение')
+            database.session.close()
+            with database.database_engine.begin() as connection:
+                for name in ('TRIGGER message_search_insert', 'TRIGGER message_search_delete',
+                             'TRIGGER message_search_update', 'TABLE message_search', 'VIEW message_search_content'):
+                    connection.exec_driver_sql(f'DROP {name}')
+            database.database_engine.dispose()
+            clear_mappers()
+            database = ClientDB('user1', url)
+            database.save_message('user1', 'user2', 'новое сообщение')
+            self.assertEqual(self.ids(database.search_history('сообщение')), [1, 2])
+            database.session.close()
+            database.database_engine.dispose()
+
+
+if __name__ == '__main__':
+    unittest.main()
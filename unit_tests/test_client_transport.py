@@ -0,0 +1,133 @@
+"""Unit-тесты транспорта клиента"""
+
+import sys
+import os
+import unittest
+from threading import Thread
+from socket import create_connection, create_server
+sys.path.append(os.path.join(os.getcwd(), '..'))
+from common.variables import ACTION, MESSAGE, SENDER, DESTINATION, TIME, MESSAGE_TEXT, RESPONSE, USER, \
+    GET_CONTACTS, LIST_INFO, REQUEST_ID, USERS_REQUEST, ACCOUNT_NAME, ERROR
+from common.utils import FrameDecoder, FrameEncoder, send_message, get_message, pack_frame, encode_message
+from errors import ServerError
+from client import ClientTransport
+
+
+class TestClientTransport(unittest.TestCase):
+    '''
+    Тесты разбора входящих кадров на ответы и сообщения чата
+    '''
+
+    message = {ACTION: MESSAGE, SENDER: 'user2', DESTINATION: 'user1', TIME: 1.1, MESSAGE_TEXT: 'text'}
+
+    def setUp(self):
+        listener = create_server(('127.0.0.1', 0))
+        sock = create_connection(listener.getsockname())
+        self.server, _ = listener.accept()
+        listener.close()
+        self.server_decoder = FrameDecoder()
+        self.transport = ClientTransport(sock, FrameDecoder(), FrameEncoder())
+        self.transport.start()
+
+    def tearDown(self):
+        self.transport.close()
+        self.server.close()
+
+    def respond(self, requests, replies):
+        """Сервер в отдельном потоке: принимает запросы и только затем отправляет ответы"""
+        def run():
+            for _ in range(requests):
+                get_message(self.server, self.server_decoder)
+            for reply in replies:
+                send_message(self.server, reply)
+        responder = Thread(target=run)
+        responder.start()
+        return responder
+
+    def test_reply_and_messages(self):
+        """Ответ достаётся запросу, сообщения до и после ответа – в очередь чата"""
+        reply = {RESPONSE: 202, LIST_INFO: ['user2']}
+        send_message(self.server, self.message)
+        responder = self.respond(1, (self.message, reply))
+        self.assertEqual(self.transport.request({ACTION: GET_CONTACTS, TIME: 1.1, USER: 'user1'}), reply)
+        responder.join()
+        self.assertEqual(self.transport.messages.get(timeout=1), self.message)
+        self.assertEqual(self.transport.messages.get(timeout=1), self.message)
+
+    def test_out_of_order(self):
+        """Ответы, пришедшие в другом порядке, сопоставляются с запросами по идентификатору"""
+        def run():
+            first = get_message(self.server, self.server_decoder)
+            second = get_message(self.server, self.server_decoder)
+            send_message(self.server, {RESPONSE: 202, LIST_INFO: ['contact'], REQUEST_ID: second[REQUEST_ID]})
+            send_message(self.server, {RESPONSE: 202, LIST_INFO: ['user'], REQUEST_ID: first[REQUEST_ID]})
+        responder = Thread(target=run)
+        responder.start()
+        users, contacts = self.transport.request_many(({ACTION: USERS_REQUEST, TIME: 1.1, ACCOUNT_NAME: 'user1'},
+                                                       {ACTION: GET_CONTACTS, TIME: 1.1, USER: 'user1'}))
+        responder.join()
+        self.assertEqual(users[LIST_INFO], ['user'])
+        self.assertEqual(contacts[LIST_INFO], ['contact'])
+
+    def test_connection_lost(self):
+        """При потере соединения ожидающий запрос получает ServerError, очередь чата – None"""
+        self.server.close()
+        with self.assertRaises(ServerError):
+            self.transport.request({ACTION: GET_CONTACTS, TIME: 1.1, USER: 'user1'})
+        self.assertIsNone(self.transport.messages.get(timeout=1))
+
+    def test_unrequested_error(self):
+        """С согласованными идентификаторами ошибка без идентификатора не достаётся ожидающему запросу"""
+        self.transport.request_ids_negotiated = True
+        error = {RESPONSE: 400, ERROR: 'Пользователь не состоит в группе.'}
+
+        def run():
+            request = get_message(self.server, self.server_decoder)
+            send_message(self.server, error)
+            send_message(self.server, {RESPONSE: 202, LIST_INFO: [], REQUEST_ID: request[REQUEST_ID]})
+        responder = Thread(target=run)
+        responder.start()
+        self.assertEqual(self.transport.request({ACTION: GET_CONTACTS, TIME: 1.1, USER: 'user1'})[RESPONSE], 202)
+        responder.join()
+        self.assertEqual(self.transport.messages.get(timeout=1), error)
+
+    def test_corrupted_frame(self):
+        """После некорректного кадра принятые до него сообщения обрабатываются, соединение закрывается"""
+        self.server.sendall(pack_frame(encode_message(self.message)) + pack_frame(b'{not json'))
+        self.assertEqual(self.transport.messages.get(timeout=1), self.message)
+        self.assertIsNone(self.transport.messages.get(timeout=1))
+
+    def test_timeout(self):
+        """Опоздавший ответ сервера без идентификаторов запросов не достаётся следующему запросу"""
+        responder = self.respond(2, ({RESPONSE: 400}, {RESPONSE: 200}))
+        with self.assertRaises(ServerError):
+            self.transport.request({ACTION: GET_CONTACTS, TIME: 1.1, USER: 'user1'}, timeout=0.1)
+        self.assertEqual(list(self.transport.pending.values()), [None])
+        self.assertEqual(self.transport.request({ACTION: GET_CONTACTS, TIME: 1.1, USER: 'user1'}),
+                         {RESPONSE: 200})
+        responder.join()
+        self.assertEqual(self.transport.pending, {})
+        self.assertTrue(self.transport.messages.empty())
+
+    def test_timeout_request_ids(self):
+        """С идентификаторами запрос после таймаута перестаёт ждать ответа, опоздавший ответ отбрасывается"""
+        self.transport.request_ids_negotiated = True
+
+        def run():
+            first = get_message(self.server, self.server_decoder)
+            second = get_message(self.server, self.server_decoder)
+            send_message(self.server, {RESPONSE: 400, REQUEST_ID: first[REQUEST_ID]})
+            send_message(self.server, {RESPONSE: 200, REQUEST_ID: second[REQUEST_ID]})
+        responder = Thread(target=run)
+        responder.start()
+        with self.assertRaises(ServerError):
+            self.transport.request({ACTION: GET_CONTACTS, TIME: 1.1, USER: 'user1'}, timeout=0.1)
+        self.assertEqual(self.transport.pending, {})
+        with self.assertLogs('client', 'ERROR'):
+            self.assertEqual(self.transport.request({ACTION: GET_CONTACTS, TIME: 1.1, USER: 'user1'})[RESPONSE], 200)
+        responder.join()
+        self.assertTrue(self.transport.messages.empty())
+
+
+if __name__ == '__main__':
+    unittest.main()
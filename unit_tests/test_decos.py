@@ -0,0 +1,93 @@
+"""Unit-тесты декоратора логирования вызовов"""
+
+import sys
+import os
+import unittest
+from logging import getLogger, DEBUG, INFO
+from unittest.mock import patch
+sys.path.append(os.path.join(os.getcwd(), '..'))
+import decos
+from decos import log, use_logger, TIMINGS
+
+
+class Arguments:
+    '''
+    Аргумент, который считает, сколько раз его форматировали для записи в лог
+    '''
+
+    def __init__(self):
+        self.formatted = 0
+
+    def __repr__(self):
+        self.formatted += 1
+        return 'Arguments()'
+
+
+def add(first, second=0):
+    return first + second
+
+
+class TestLog(unittest.TestCase):
+    '''
+    Тесты декоратора log
+    '''
+
+    def setUp(self):
+        self.logger = getLogger('test_decos')
+        self.logger.propagate = False
+        self.logger_patch = patch.object(decos, 'logger', decos.logger)
+        self.logger_patch.start()
+        use_logger(self.logger)
+
+    def tearDown(self):
+        self.logger_patch.stop()
+        self.logger.setLevel(0)
+
+    def test_disabled(self):
+        """Без уровня DEBUG вызов не записывается и аргументы не форматируются"""
+        self.logger.setLevel(INFO)
+        argument = Arguments()
+        # assertNoLogs сам включает уровень DEBUG, поэтому записи перехватываются на уровне handle.
+        with patch.object(self.logger, 'handle') as handle:
+            self.assertIs(log(lambda value: value)(argument), argument)
+        handle.assert_not_called()
+        self.assertEqual(argument.formatted, 0)
+
+    def test_enabled(self):
+        """Запись содержит имя функции, параметры и время выполнения"""
+        self.logger.setLevel(DEBUG)
+        with self.assertLogs(self.logger, DEBUG) as logs:
+            self.assertEqual(log(add)(1, second=2), 3)
+        self.assertIn('add c параметрами (1,) , {\'second\': 2}', logs.output[0])
+        self.assertIn('мкс', logs.output[0])
+        self.assertEqual(add.__name__, log(add).__name__)
+
+    def test_sample(self):
+        """С sample записывается только каждый sample-й вызов"""
+        self.logger.setLevel(DEBUG)
+        sampled = log(sample=10)(add)
+        with self.assertLogs(self.logger, DEBUG) as logs:
+            for i in range(30):
+                self.assertEqual(sampled(i), i)
+        self.assertEqual(len(logs.output), 3)
+
+    def test_timing(self):
+        """С timing время выполнения собирается и без логирования, в том числе при исключении"""
+        self.logger.setLevel(INFO)
+        timed = log(timing=True)(add)
+        stats = TIMINGS[f'{__name__}.add']
+        timed(1)
+        with self.assertRaises(TypeError):
+            timed(1, 'a')
+        self.assertEqual(stats.calls, 2)
+        self.assertGreaterEqual(stats.total, stats.max)
+        self.assertIn('вызовов 2', repr(stats))
+
+    def test_use_logger(self):
+        """use_logger принимает имя логгера"""
+        use_logger('test_decos')
+        self.assertIs(decos.logger, self.logger)
+
+
+if __name__ == '__main__':
+    unittest.main()
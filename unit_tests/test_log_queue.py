@@ -0,0 +1,116 @@
+"""Unit-тесты записи логов через очередь"""
+
+import sys
+import os
+import unittest
+from logging import getLogger, Handler, INFO
+from queue import Queue
+from threading import get_ident
+from unittest.mock import patch
+sys.path.append(os.path.join(os.getcwd(), '..'))
+from logs.log_queue import DroppingQueueHandler, QueueLogging
+
+
+class ListHandler(Handler):
+    '''
+    Обработчик, который запоминает сообщения записей и поток, в котором они записаны
+    '''
+
+    def __init__(self):
+        super().__init__()
+        self.messages = []
+        self.threads = set()
+
+    def emit(self, record):
+        self.messages.append(record.getMessage())
+        self.threads.add(get_ident())
+
+
+class TestDroppingQueueHandler(unittest.TestCase):
+    '''
+    Тесты обработчика с ограниченной очередью
+    '''
+
+    def setUp(self):
+        self.logger = getLogger('test_log_queue.dropping')
+        self.logger.propagate = False
+        self.logger.setLevel(INFO)
+        self.handler = DroppingQueueHandler(Queue(3))
+        self.logger.addHandler(self.handler)
+
+    def tearDown(self):
+        self.logger.removeHandler(self.handler)
+
+    def drain(self):
+        messages = []
+        while not self.handler.queue.empty():
+            messages.append(self.handler.queue.get_nowait().getMessage())
+        return messages
+
+    def test_drop(self):
+        """Записи сверх размера очереди отбрасываются без ожидания и учитываются"""
+        for i in range(5):
+            self.logger.info('запись %d', i)
+        self.assertEqual(self.handler.dropped, 2)
+        self.assertEqual(self.drain(), ['запись 0', 'запись 1', 'запись 2'])
+
+    def test_report(self):
+        """О потерянных записях сообщает предупреждение после первой поместившейся записи"""
+        for i in range(4):
+            self.logger.info('запись %d', i)
+        self.drain()
+        self.logger.info('после')
+        messages = self.drain()
+        self.assertEqual(messages[0], 'после')
+        self.assertIn('потеряно записей: 1', messages[1])
+        self.logger.info('ещё')
+        self.assertEqual(self.drain(), ['ещё'])
+
+
+class TestQueueLogging(unittest.TestCase):
+    '''
+    Тесты записи логов фоновым потоком
+    '''
+
+    def setUp(self):
+        self.logger = getLogger('test_log_queue.listener')
+        self.logger.propagate = False
+        self.logger.setLevel(INFO)
+        self.target = ListHandler()
+        with patch('atexit.register'), patch('os.register_at_fork'):
+            self.logging = QueueLogging(self.logger, (self.target,), size=100)
+
+    def tearDown(self):
+        self.logging.stop()
+        self.logger.removeHandler(self.logging.handler)
+
+    def test_background(self):
+        """Записи пишутся не в вызывающем потоке, stop дописывает всю очередь"""
+        for i in range(50):
+            self.logger.info('запись %d', i)
+        self.logging.stop()
+        self.assertEqual(self.target.messages, [f'запись {i}' for i in range(50)])
+        self.assertNotIn(get_ident(), self.target.threads)
+
+    def test_handler_level(self):
+        """Уровень конечного обработчика соблюдается"""
+        self.target.setLevel(INFO + 10)
+        self.logger.info('информация')
+        self.logger.warning('предупреждение')
+        self.logging.stop()
+        self.assertEqual(self.target.messages, ['предупреждение'])
+
+    def test_restart(self):
+        """После fork дочерний процесс получает новую очередь и свой поток записи"""
+        queue, listener = self.logging.handler.queue, self.logging.listener
+        self.logging.restart()
+        # В настоящем дочернем процессе прежнего потока нет, здесь он останавливается отдельно.
+        listener.stop()
+        self.assertIsNot(self.logging.handler.queue, queue)
+        self.logger.info('в дочернем процессе')
+        self.logging.stop()
+        self.assertEqual(self.target.messages, ['в дочернем процессе'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,64 @@
+"""Unit-тесты метаклассов проверки клиента и сервера"""
+
+import sys
+import os
+import unittest
+from tempfile import TemporaryDirectory
+from unittest.mock import patch
+sys.path.append(os.path.join(os.getcwd(), '..'))
+import metaclasses
+from metaclasses import ClientVerifier
+
+
+# Методы проверяемых классов. Классы создаются вызовом метакласса: вложенное в тест определение класса
+# проверка не разбирает из-за <locals> в полном имени.
+def send(self):
+    send_message()
+
+
+def accept_client(self):
+    accept()
+
+
+class TestVerifiedCache(unittest.TestCase):
+    '''
+    Тесты кеша результатов проверки классов
+    '''
+
+    def setUp(self):
+        self.directory = TemporaryDirectory()
+        self.cache = patch.multiple(metaclasses, VERIFIED_CACHE=os.path.join(self.directory.name, 'verified'),
+                                    verified=None)
+        self.cache.start()
+
+    def tearDown(self):
+        self.cache.stop()
+        self.directory.cleanup()
+
+    def create(self, run=send):
+        return ClientVerifier('Sender', (), {'__module__': __name__, '__qualname__': 'Sender', 'run': run})
+
+    def test_cached(self):
+        """Проверенный класс при следующем запуске не разбирается повторно"""
+        with patch.object(sys, 'dont_write_bytecode', False):
+            self.create()
+        metaclasses.verified = None
+        with patch('dis.get_instructions', side_effect=AssertionError('повторный разбор')):
+            self.create()
+
+    def test_changed_code(self):
+        """Изменённый класс проверяется заново, ошибка проверки не кешируется"""
+        self.create()
+        for _ in range(2):
+            with self.assertRaises(TypeError):
+                self.create(accept_client)
+
+    def test_no_cache_dir(self):
+        """Без доступного каталога кеша классы проверяются как обычно"""
+        metaclasses.VERIFIED_CACHE = os.path.join(self.directory.name, 'missing', 'verified')
+        self.create()
+        self.assertEqual(len(metaclasses.verified), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -3,9 +3,21 @@
 import sys
 import os
 import unittest
+import asyncio
+from unittest.mock import patch
+from socket import socketpair
+from selectors import DefaultSelector, EVENT_READ
+from threading import Event
 sys.path.append(os.path.join(os.getcwd(), '..'))
-from common.variables import RESPONSE, ERROR, USER, ACCOUNT_NAME, TIME, ACTION, PRESENCE
-from server import Server
+from common.variables import RESPONSE, ERROR, USER, ACCOUNT_NAME, TIME, ACTION, PRESENCE, OVERFLOW_DROP, \
+    OVERFLOW_DISCONNECT, OVERFLOW_SPILL, MESSAGE, SENDER, DESTINATION, MESSAGE_TEXT, DEFAULT_PORT, GROUP, \
+    GROUP_MESSAGE, CODECS, CODEC, CODEC_BINARY, COMPRESSION, COMPRESSION_ZLIB, GET_CONTACTS, ADD_CONTACT, \
+    REMOVE_CONTACT, LIST_INFO, USERS_REQUEST, REQUEST_ID, RESPONSE_202, RESPONSE_400, VERSION, DELTA, REMOVED, \
+    GET_HISTORY, CURSOR, LIMIT, EPOCH
+from common.utils import FrameDecoder, FrameEncoder
+from server import Server, AsyncServer, ClientConnection, StreamClient
+from sqlalchemy.orm import clear_mappers
+from server_DB import ServerDB, DBWorkerPool
 
 class TestServer(unittest.TestCase):
     '''
@@ -48,5 +60,715 @@ class TestServer(unittest.TestCase):
             {ACTION: PRESENCE, TIME: 1.1, USER: {ACCOUNT_NAME: 'Guest'}}), self.ok_dict)
 
 
+class FakeClient:
+    '''
+    Заглушка соединения, запоминающая отправленные данные
+    '''
+
+    def __init__(self):
+        self.decoder = FrameDecoder()
+        self.encoder = FrameEncoder()
+        self.received = []
+        self.raw = []
+        self.dropped = 0
+
+    def getpeername(self):
+        return '127.0.0.1', 7777
+
+    def sendall(self, data):
+        self.raw.append(data)
+        self.received.extend(self.decoder.feed(data))
+
+
+class FakeLoginDB:
+    '''
+    Заглушка базы данных для регистрации пользователя
+    '''
+
+    def user_login(self, *args):
+        pass
+
+    def offline_messages(self, username):
+        return None, []
+
+
+class FakeGroupsDB:
+    '''
+    Заглушка базы данных с одной группой
+    '''
+
+    def group_members(self, group):
+        return ['user1', 'user2', 'user3', 'user4'] if group == 'group' else []
+
+    def process_message(self, sender, recipient, text=None):
+        pass
+
+
+class FakeContactsDB:
+    '''
+    Заглушка базы данных контактов, считающая запросы списка контактов
+    '''
+
+    def __init__(self):
+        self.contacts = {'user1': ['user2']}
+        self.queries = 0
+
+    def get_contacts(self, username):
+        self.queries += 1
+        return list(self.contacts.get(username, []))
+
+    def add_contact(self, user, contact):
+        if contact == 'nobody':
+            return False
+        self.contacts.setdefault(user, []).append(contact)
+        return True
+
+    def remove_contact(self, user, contact):
+        self.contacts[user].remove(contact)
+
+    def user_logout(self, username):
+        pass
+
+
+class TestDispatch(unittest.TestCase):
+    '''
+    Тесты реестра обработчиков действий
+    '''
+
+    def setUp(self):
+        self.server = Server('', DEFAULT_PORT, None)
+        self.client = FakeClient()
+        self.server.names['user1'] = self.client
+
+    def test_message_queued(self):
+        """Корректное сообщение ставится в очередь без ответа"""
+        message = {ACTION: MESSAGE, SENDER: 'user1', DESTINATION: 'user2', TIME: 1.1, MESSAGE_TEXT: 'text'}
+        self.server.process_client_message(message, self.client)
+        self.assertEqual(self.server.messages, [message])
+        self.assertEqual(self.client.received, [])
+
+    def test_missing_field(self):
+        """Нет обязательного поля – ответ 400"""
+        self.server.process_client_message({ACTION: MESSAGE, SENDER: 'user1', TIME: 1.1}, self.client)
+        self.assertEqual(self.client.received[0][RESPONSE], 400)
+
+    def test_unknown_action(self):
+        """Неизвестное действие – ответ 400"""
+        self.server.process_client_message({ACTION: 'Wrong', TIME: 1.1}, self.client)
+        self.assertEqual(self.client.received[0][RESPONSE], 400)
+
+    def test_foreign_user(self):
+        """Запрос от имени другого пользователя – ответ 400"""
+        foreign = FakeClient()
+        self.server.process_client_message({ACTION: 'get_users', TIME: 1.1, ACCOUNT_NAME: 'user1'}, foreign)
+        self.assertEqual(foreign.received[0][RESPONSE], 400)
+
+    def test_forged_sender(self):
+        """Сообщение от имени другого пользователя не ставится в очередь и не попадает в архив"""
+        message = {ACTION: MESSAGE, SENDER: 'user3', DESTINATION: 'user2', TIME: 1.1, MESSAGE_TEXT: 'text'}
+        self.server.process_client_message(message, self.client)
+        self.assertEqual(self.server.messages, [])
+        self.assertEqual(self.client.received[0][RESPONSE], 400)
+
+    def test_request_id(self):
+        """Идентификатор запроса возвращается в ответе, общий словарь ответа не меняется"""
+        self.server.process_client_message({ACTION: 'Wrong', TIME: 1.1, REQUEST_ID: 7}, self.client)
+        self.assertEqual(self.client.received[0][REQUEST_ID], 7)
+        self.assertNotIn(REQUEST_ID, RESPONSE_400)
+
+    def test_register_action(self):
+        """Новое действие регистрируется без изменения класса сервера"""
+        calls = []
+        self.server.register_action('ping', lambda message, client: calls.append(message), TIME)
+        self.server.process_client_message({ACTION: 'ping', TIME: 1.1}, self.client)
+        self.assertEqual(calls, [{ACTION: 'ping', TIME: 1.1}])
+
+
+class TestCodecNegotiation(unittest.TestCase):
+    '''
+    Тесты согласования кодека при подключении
+    '''
+
+    def setUp(self):
+        self.server = Server('', DEFAULT_PORT, FakeLoginDB())
+        self.client = FakeClient()
+
+    def presence(self, **extra):
+        message = {ACTION: PRESENCE, TIME: 1.1, USER: {ACCOUNT_NAME: 'user1'}}
+        message.update(extra)
+        self.server.process_client_message(message, self.client)
+        return self.client.received[0]
+
+    def test_default_json(self):
+        """Клиент без списка кодеков остаётся на JSON"""
+        self.assertEqual(self.presence(), {RESPONSE: 200})
+        self.assertEqual(self.client.encoder.codec, 'json')
+
+    def test_binary(self):
+        """Сервер выбирает первый известный ему кодек из предложенных"""
+        self.assertEqual(self.presence(**{CODECS: ['unknown', CODEC_BINARY]}), {RESPONSE: 200, CODEC: CODEC_BINARY})
+        self.assertEqual(self.client.encoder.codec, CODEC_BINARY)
+
+    def test_compression(self):
+        """Сжатие включается только по запросу клиента и если сервер его разрешает"""
+        self.assertEqual(self.presence(**{COMPRESSION: COMPRESSION_ZLIB}), {RESPONSE: 200, COMPRESSION: COMPRESSION_ZLIB})
+        self.assertTrue(self.client.encoder.compression)
+
+    def test_compression_disabled(self):
+        """Сервер с выключенным сжатием не подтверждает его"""
+        self.server.compression = False
+        self.assertEqual(self.presence(**{COMPRESSION: COMPRESSION_ZLIB}), {RESPONSE: 200})
+        self.assertFalse(self.client.encoder.compression)
+
+
+class TestGroupFanOut(unittest.TestCase):
+    '''
+    Тесты рассылки сообщений в групповой чат
+    '''
+
+    def setUp(self):
+        self.server = Server('', DEFAULT_PORT, FakeGroupsDB())
+        self.clients = {name: FakeClient() for name in ('user1', 'user2', 'user3', 'outsider')}
+        self.server.names.update(self.clients)
+
+    def post(self, sender):
+        message = {ACTION: GROUP_MESSAGE, TIME: 1.1, SENDER: sender, GROUP: 'group', MESSAGE_TEXT: 'text'}
+        self.server.process_client_message(message, self.clients[sender])
+        return message
+
+    def test_fan_out_same_bytes(self):
+        """Участники в сети получают один и тот же закодированный кадр, отправитель – нет"""
+        message = self.post('user1')
+        self.assertEqual(self.clients['user1'].raw, [])
+        self.assertEqual(self.clients['user2'].received, [message])
+        self.assertIs(self.clients['user2'].raw[0], self.clients['user3'].raw[0])
+        self.assertEqual(self.clients['outsider'].raw, [])
+
+    def test_not_member(self):
+        """Сообщение от пользователя не из группы отклоняется"""
+        self.post('outsider')
+        self.assertEqual(self.clients['outsider'].received[0][RESPONSE], 400)
+        self.assertEqual(self.clients['user2'].raw, [])
+
+
+class TestContactsCache(unittest.TestCase):
+    '''
+    Тесты кеша контактов пользователей в сети
+    '''
+
+    def setUp(self):
+        self.database = FakeContactsDB()
+        self.server = Server('', DEFAULT_PORT, self.database)
+        self.client = FakeClient()
+        self.server.names['user1'] = self.client
+
+    def request(self, action, **fields):
+        message = {ACTION: action, TIME: 1.1, USER: 'user1'}
+        message.update(fields)
+        self.server.process_client_message(message, self.client)
+        return self.client.received[-1]
+
+    def test_loaded_once(self):
+        """Список контактов загружается из базы один раз"""
+        self.assertEqual(self.request(GET_CONTACTS)[LIST_INFO], ['user2'])
+        self.assertEqual(self.request(GET_CONTACTS)[LIST_INFO], ['user2'])
+        self.assertEqual(self.database.queries, 1)
+
+    def test_write_through(self):
+        """Добавление и удаление контакта меняют и базу, и кеш"""
+        self.assertTrue(self.server.is_contact('user1', 'user2'))
+        self.request(ADD_CONTACT, **{ACCOUNT_NAME: 'user3'})
+        self.request(ADD_CONTACT, **{ACCOUNT_NAME: 'nobody'})
+        self.request(REMOVE_CONTACT, **{ACCOUNT_NAME: 'user2'})
+        self.assertEqual(self.server.contacts['user1'], {'user3'})
+        self.assertEqual(self.database.contacts['user1'], ['user3'])
+        self.assertEqual(self.database.queries, 1)
+
+    def test_offline_not_cached(self):
+        """Контакты пользователей не в сети не кешируются, при отключении кеш удаляется"""
+        self.assertFalse(self.server.is_contact('user2', 'user1'))
+        self.assertNotIn('user2', self.server.contacts)
+        self.server.is_contact('user1', 'user2')
+        self.server.remove_client(self.client)
+        self.assertNotIn('user1', self.server.contacts)
+
+
+class TestSync(unittest.TestCase):
+    '''
+    Тесты синхронизации списков пользователей и контактов по версиям
+    '''
+
+    def setUp(self):
+        self.database = ServerDB('sqlite:///:memory:')
+        for name in ('user1', 'user2', 'user3'):
+            self.database.user_login(name, '127.0.0.1', 7777)
+        self.server = Server('', DEFAULT_PORT, self.database)
+        self.client = FakeClient()
+        self.server.names['user1'] = self.client
+
+    def tearDown(self):
+        clear_mappers()
+
+    def request(self, action, **fields):
+        message = {ACTION: action, TIME: 1.1, USER: 'user1', ACCOUNT_NAME: 'user1'}
+        message.update(fields)
+        self.server.process_client_message(message, self.client)
+        return self.client.received[-1]
+
+    def test_full_without_version(self):
+        """Без версии ответ прежний: полный список без полей синхронизации"""
+        response = self.request(USERS_REQUEST)
+        self.assertEqual(sorted(response[LIST_INFO]), ['user1', 'user2', 'user3'])
+        self.assertNotIn(VERSION, response)
+
+    def sync(self, action, response):
+        return self.request(action, **{VERSION: response[VERSION], EPOCH: response[EPOCH]})
+
+    def test_users_delta(self):
+        """С версией возвращаются только пользователи, зарегистрированные после неё"""
+        response = self.request(USERS_REQUEST, **{VERSION: 0})
+        self.assertEqual((sorted(response[LIST_INFO]), response[DELTA]), (['user1', 'user2', 'user3'], False))
+        self.assertEqual(response[EPOCH], self.database.epoch)
+        self.database.user_login('user4', '127.0.0.1', 7777)
+        response = self.sync(USERS_REQUEST, response)
+        self.assertEqual((response[LIST_INFO], response[DELTA]), (['user4'], True))
+        self.assertEqual(self.sync(USERS_REQUEST, response)[LIST_INFO], [])
+
+    def test_unknown_version(self):
+        """Версия не из этой базы – полный список без признака изменений"""
+        response = self.request(USERS_REQUEST, **{VERSION: 1000, EPOCH: self.database.epoch})
+        self.assertEqual((len(response[LIST_INFO]), response[DELTA]), (3, False))
+
+    def test_other_epoch(self):
+        """Версия из другой базы (сервер пересоздал базу) не даёт изменений, даже если номер не больше текущего"""
+        self.request(ADD_CONTACT, **{ACCOUNT_NAME: 'user2'})
+        for action in (USERS_REQUEST, GET_CONTACTS):
+            response = self.request(action, **{VERSION: 1, EPOCH: self.database.epoch + 1})
+            self.assertFalse(response[DELTA])
+        self.assertEqual(response[LIST_INFO], ['user2'])
+        self.assertFalse(self.request(GET_CONTACTS, **{VERSION: 1})[DELTA])
+
+    def test_contacts_delta(self):
+        """Изменения контактов после версии: добавленные и удалённые, повторные изменения сворачиваются"""
+        self.request(ADD_CONTACT, **{ACCOUNT_NAME: 'user2'})
+        response = self.request(GET_CONTACTS, **{VERSION: 0})
+        self.request(ADD_CONTACT, **{ACCOUNT_NAME: 'user3'})
+        self.request(REMOVE_CONTACT, **{ACCOUNT_NAME: 'user2'})
+        self.request(REMOVE_CONTACT, **{ACCOUNT_NAME: 'user3'})
+        self.request(ADD_CONTACT, **{ACCOUNT_NAME: 'user3'})
+        response = self.sync(GET_CONTACTS, response)
+        self.assertEqual((response[LIST_INFO], response[REMOVED], response[DELTA]), (['user3'], ['user2'], True))
+
+    def test_contacts_full_from_cache(self):
+        """Полный список контактов при синхронизации берётся из кеша, журнал изменений не читается"""
+        self.request(ADD_CONTACT, **{ACCOUNT_NAME: 'user2'})
+        self.server.contact_set('user1')
+        with patch.object(self.database, 'get_contacts') as get_contacts, \
+                patch.object(self.database, 'contacts_changes') as contacts_changes:
+            response = self.request(GET_CONTACTS, **{VERSION: 0})
+        get_contacts.assert_not_called()
+        contacts_changes.assert_not_called()
+        self.assertEqual((response[LIST_INFO], response[DELTA]), (['user2'], False))
+        self.assertEqual(response[VERSION], self.database.sync_version())
+
+
+class TestArchive(unittest.TestCase):
+    '''
+    Тесты запроса переписки из архива сервера
+    '''
+
+    def setUp(self):
+        self.database = ServerDB('sqlite:///:memory:')
+        for name in ('user1', 'user2'):
+            self.database.user_login(name, '127.0.0.1', 7777)
+        self.server = Server('', DEFAULT_PORT, self.database)
+        self.client = FakeClient()
+        self.server.names['user1'] = self.client
+        self.server.names['user2'] = FakeClient()
+
+    def tearDown(self):
+        clear_mappers()
+
+    def request(self, **fields):
+        message = {ACTION: GET_HISTORY, TIME: 1.1, USER: 'user1', ACCOUNT_NAME: 'user2'}
+        message.update(fields)
+        self.server.process_client_message(message, self.client)
+        return self.client.received[-1]
+
+    def test_delivered_archived(self):
+        """Доставленные сообщения попадают в архив и выдаются страницами с курсором"""
+        for i in range(3):
+            self.server.process_client_message({ACTION: MESSAGE, SENDER: 'user1', DESTINATION: 'user2', TIME: 1.1,
+                                                MESSAGE_TEXT: str(i)}, self.client)
+        self.server.deliver_messages()
+        response = self.request(**{LIMIT: 2})
+        self.assertEqual([message[MESSAGE_TEXT] for message in response[LIST_INFO]], ['1', '2'])
+        self.assertEqual(response[LIST_INFO][0][DESTINATION], 'user2')
+        response = self.request(**{LIMIT: 2, CURSOR: response[CURSOR]})
+        self.assertEqual(([message[MESSAGE_TEXT] for message in response[LIST_INFO]], response[CURSOR]), (['0'], None))
+
+    def test_bad_request(self):
+        """Некорректный курсор, размер страницы или чужое имя пользователя – ответ 400"""
+        self.assertEqual(self.request(**{CURSOR: 'last'})[RESPONSE], 400)
+        self.assertEqual(self.request(**{CURSOR: [1.5, None]})[RESPONSE], 400)
+        self.assertEqual(self.request(**{LIMIT: 0})[RESPONSE], 400)
+        self.assertEqual(self.request(**{LIMIT: 1000})[RESPONSE], 400)
+        self.assertEqual(self.request(**{USER: 'user2'})[RESPONSE], 400)
+
+
+class FakeDeliveryDB:
+    '''
+    Заглушка базы данных, запоминающая сообщения для пользователей не в сети; запись истории может отказать
+    '''
+
+    def __init__(self):
+        self.offline = []
+        self.failing = False
+
+    def process_message(self, sender, recipient, text=None):
+        if self.failing:
+            raise RuntimeError('база данных недоступна')
+
+    def store_offline_message(self, username, message):
+        self.offline.append((username, message[MESSAGE_TEXT]))
+        return True
+
+    def user_logout(self, username):
+        pass
+
+
+class BrokenClient(FakeClient):
+    '''
+    Заглушка соединения, связь с которым потеряна
+    '''
+
+    def sendall(self, data):
+        raise ConnectionResetError
+
+
+class CongestedClient(FakeClient):
+    '''
+    Заглушка соединения с переполненным буфером и политикой drop
+    '''
+
+    def sendall(self, data):
+        self.dropped += 1
+
+
+class TestDelivery(unittest.TestCase):
+    '''
+    Тесты доставки личных сообщений при ошибках связи и базы данных
+    '''
+
+    def setUp(self):
+        self.database = FakeDeliveryDB()
+        self.server = Server('', DEFAULT_PORT, self.database)
+
+    def send(self, destination):
+        self.server.messages.append({ACTION: MESSAGE, SENDER: 'user1', DESTINATION: destination, TIME: 1.1,
+                                     MESSAGE_TEXT: 'text'})
+        self.server.deliver_messages()
+
+    def test_connection_lost(self):
+        """Получатель с потерянной связью отключается, сообщение сохраняется до его подключения"""
+        self.server.names['user2'] = BrokenClient()
+        self.send('user2')
+        self.assertNotIn('user2', self.server.names)
+        self.assertEqual(self.database.offline, [('user2', 'text')])
+
+    def test_database_error_after_send(self):
+        """Ошибка базы после отправки не отключает получателя и не дублирует сообщение"""
+        client = self.server.names['user2'] = FakeClient()
+        self.database.failing = True
+        self.send('user2')
+        self.assertIs(self.server.names['user2'], client)
+        self.assertEqual(len(client.received), 1)
+        self.assertEqual(self.database.offline, [])
+
+    def test_big_int_binary(self):
+        """Целое вне int64 из JSON доставляется получателю с двоичным кодеком, получатель не отключается"""
+        client = self.server.names['user2'] = FakeClient()
+        client.encoder = FrameEncoder(CODEC_BINARY)
+        self.server.messages.append({ACTION: MESSAGE, SENDER: 'user1', DESTINATION: 'user2', TIME: 10 ** 30,
+                                     MESSAGE_TEXT: 'text'})
+        self.server.deliver_messages()
+        self.assertEqual(client.received[0][TIME], 10 ** 30)
+        self.assertIs(self.server.names['user2'], client)
+
+    def test_database_error_offline(self):
+        """Ошибка базы для получателя не в сети пропускает сообщение, не останавливая сервер"""
+        self.database.failing = True
+        self.send('user2')
+        self.assertEqual(self.server.messages, [])
+
+
+class TestOfflineDelivery(unittest.TestCase):
+    '''
+    Тесты доставки сообщений, накопленных для пользователя не в сети
+    '''
+
+    def setUp(self):
+        self.database = ServerDB('sqlite:///:memory:')
+        for name in ('user1', 'user2'):
+            self.database.user_login(name, '127.0.0.1', 7777)
+        self.database.store_offline_message('user2', {ACTION: MESSAGE, SENDER: 'user1', DESTINATION: 'user2',
+                                                      TIME: 1.1, MESSAGE_TEXT: 'text'})
+        self.server = Server('', DEFAULT_PORT, self.database)
+
+    def tearDown(self):
+        clear_mappers()
+
+    def stored(self):
+        return len(self.database.offline_messages('user2')[1])
+
+    def test_delivered(self):
+        """Отправленные сообщения удаляются из очереди"""
+        client = FakeClient()
+        self.server.deliver_offline_messages('user2', client)
+        self.assertEqual(client.received[0][MESSAGE_TEXT], 'text')
+        self.assertEqual(self.stored(), 0)
+
+    def test_connection_lost(self):
+        """При ошибке отправки сообщения остаются в очереди до следующего подключения"""
+        with self.assertRaises(ConnectionResetError):
+            self.server.deliver_offline_messages('user2', BrokenClient())
+        self.assertEqual(self.stored(), 1)
+
+    def test_dropped(self):
+        """Сообщения, отброшенные политикой переполнения, остаются в очереди"""
+        with self.assertLogs('server', 'WARNING'):
+            self.server.deliver_offline_messages('user2', CongestedClient())
+        self.assertEqual(self.stored(), 1)
+
+
+class FakeSlowUsersDB:
+    '''
+    Заглушка базы данных, список пользователей которой готов только по сигналу теста
+    '''
+
+    def __init__(self):
+        self.ready = Event()
+
+    def users_list(self):
+        self.ready.wait(5)
+        return [('user1', None), ('user2', None)]
+
+    def get_contacts(self, username):
+        return ['user2']
+
+    def end_session(self):
+        pass
+
+
+class TestDBPool(unittest.TestCase):
+    '''
+    Тесты выполнения запросов к базе данных в пуле потоков
+    '''
+
+    def setUp(self):
+        self.database = FakeSlowUsersDB()
+        self.pool = DBWorkerPool(self.database, 1)
+        self.server = Server('', DEFAULT_PORT, self.database, db_pool=self.pool)
+        self.client = FakeClient()
+        self.server.clients.add(self.client)
+        self.server.names['user1'] = self.client
+        self.selector = DefaultSelector()
+        self.selector.register(self.pool, EVENT_READ)
+
+    def tearDown(self):
+        self.database.ready.set()
+        self.selector.close()
+        self.pool.close()
+
+    def request_users(self):
+        self.server.process_client_message({ACTION: USERS_REQUEST, TIME: 1.1, ACCOUNT_NAME: 'user1'}, self.client)
+
+    def test_not_blocking(self):
+        """Медленный запрос не задерживает обработку, ответ уходит после готовности запроса"""
+        self.request_users()
+        self.assertEqual(self.client.received, [])
+        self.database.ready.set()
+        self.assertTrue(self.selector.select(5))
+        self.pool.run_callbacks()
+        self.assertEqual(self.client.received[0], {RESPONSE: 202, LIST_INFO: ['user1', 'user2']})
+
+    def test_request_ids_out_of_order(self):
+        """Ответ на медленный запрос приходит позже ответа на следующий, но со своим идентификатором"""
+        self.server.process_client_message({ACTION: USERS_REQUEST, TIME: 1.1, ACCOUNT_NAME: 'user1', REQUEST_ID: 1},
+                                           self.client)
+        self.server.process_client_message({ACTION: GET_CONTACTS, TIME: 1.1, USER: 'user1', REQUEST_ID: 2},
+                                           self.client)
+        self.database.ready.set()
+        self.assertTrue(self.selector.select(5))
+        self.pool.run_callbacks()
+        self.assertEqual(self.client.received, [{RESPONSE: 202, LIST_INFO: ['user2'], REQUEST_ID: 2},
+                                                {RESPONSE: 202, LIST_INFO: ['user1', 'user2'], REQUEST_ID: 1}])
+        self.assertIsNone(RESPONSE_202[LIST_INFO])
+
+    def test_client_gone(self):
+        """Ответ не отправляется клиенту, отключившемуся до готовности запроса"""
+        self.request_users()
+        self.server.clients.discard(self.client)
+        self.database.ready.set()
+        self.assertTrue(self.selector.select(5))
+        self.pool.run_callbacks()
+        self.assertEqual(self.client.received, [])
+
+
+class TestClientConnection(unittest.TestCase):
+    '''
+    Тесты исходящего буфера соединения
+    '''
+
+    def setUp(self):
+        self.server_side, self.client_side = socketpair()
+        self.pending = []
+
+    def tearDown(self):
+        self.server_side.close()
+        self.client_side.close()
+
+    def make_connection(self, policy):
+        return ClientConnection(self.server_side, 'test', self.pending.append, high_watermark=64 * 1024,
+                                low_watermark=16 * 1024, overflow_policy=policy)
+
+    def fill(self, connection, count=200):
+        """Запись в соединение, с другой стороны которого никто не читает"""
+        for _ in range(count):
+            connection.sendall(b'x' * 4096)
+
+    def test_send_immediately(self):
+        """Данные уходят сразу, если сокет готов к записи"""
+        connection = self.make_connection(OVERFLOW_DISCONNECT)
+        connection.sendall(b'hello')
+        self.assertEqual(self.client_side.recv(5), b'hello')
+        self.assertEqual(self.pending, [])
+
+    def test_drop(self):
+        """Политика drop отбрасывает данные выше верхней отметки"""
+        connection = self.make_connection(OVERFLOW_DROP)
+        self.fill(connection)
+        self.assertTrue(connection.congested)
+        self.assertGreater(connection.dropped, 0)
+        self.assertEqual(self.pending, [connection])
+
+    def test_disconnect(self):
+        """Политика disconnect бросает ConnectionError при переполнении"""
+        connection = self.make_connection(OVERFLOW_DISCONNECT)
+        self.assertRaises(ConnectionError, self.fill, connection)
+
+    def test_spill(self):
+        """Политика spill сохраняет все данные и досылает их по порядку"""
+        connection = self.make_connection(OVERFLOW_SPILL)
+        payload = b''.join(bytes([i]) * 4096 for i in range(200))
+        for i in range(200):
+            connection.sendall(payload[i * 4096:(i + 1) * 4096])
+        self.assertTrue(connection.congested)
+        received = bytearray()
+        while len(received) < len(payload):
+            received += self.client_side.recv(65536)
+            connection.flush()
+        self.assertEqual(bytes(received), payload)
+        self.assertFalse(connection.congested)
+
+
+
+class FakeTransport:
+    '''
+    Заглушка транспорта asyncio: данные копятся в буфере, пока тест не «отправит» их
+    '''
+
+    def __init__(self):
+        self.buffer = bytearray()
+
+    def set_write_buffer_limits(self, high, low):
+        pass
+
+    def get_write_buffer_size(self):
+        return len(self.buffer)
+
+
+class FakeWriter:
+    '''
+    Заглушка StreamWriter поверх FakeTransport
+    '''
+
+    def __init__(self):
+        self.transport = FakeTransport()
+        self.closed = False
+
+    def get_extra_info(self, name):
+        return '127.0.0.1', 7777
+
+    def write(self, data):
+        self.transport.buffer += data
+
+    async def drain(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+
+class FakeReader:
+    '''
+    Заглушка StreamReader: отдаёт заданные порции данных, затем конец потока
+    '''
+
+    def __init__(self, *chunks):
+        self.chunks = list(chunks)
+
+    async def read(self, size):
+        return self.chunks.pop(0) if self.chunks else b''
+
+
+class TestStreamClient(unittest.TestCase):
+    '''
+    Тесты исходящего буфера соединения сервера на asyncio
+    '''
+
+    def test_drop_recovers(self):
+        """Политика drop отбрасывает данные только пока буфер транспорта не разгрузится до нижней отметки"""
+        writer = FakeWriter()
+        client = StreamClient(writer, high_watermark=64 * 1024, low_watermark=16 * 1024, overflow_policy=OVERFLOW_DROP)
+        for _ in range(20):
+            client.sendall(b'x' * 4096)
+        self.assertTrue(client.congested)
+        self.assertGreater(client.dropped, 0)
+        writer.transport.buffer.clear()
+        client.sendall(b'after')
+        self.assertFalse(client.congested)
+        self.assertEqual(bytes(writer.transport.buffer), b'after')
+
+
+class TestAsyncServer(unittest.TestCase):
+    '''
+    Тесты обслуживания соединения сервером на asyncio
+    '''
+
+    def setUp(self):
+        self.server = AsyncServer('', DEFAULT_PORT, None)
+        self.frame = FrameEncoder().encode({ACTION: PRESENCE, TIME: 1.1, USER: {ACCOUNT_NAME: 'user1'}})
+
+    def test_handler_error(self):
+        """Ошибка обработчика записывается в лог с адресом клиента, клиент отключается"""
+        writer = FakeWriter()
+        with patch.object(self.server, 'process_client_message', side_effect=RuntimeError('сбой')), \
+                self.assertLogs('server', 'ERROR') as logs:
+            asyncio.run(self.server.handle_client(FakeReader(self.frame), writer))
+        self.assertIn('127.0.0.1', logs.output[0])
+        self.assertIs(logs.records[0].exc_info[0], RuntimeError)
+        self.assertTrue(writer.closed)
+        self.assertEqual(self.server.clients, set())
+
+    def test_connection_lost(self):
+        """Потеря связи – обычное отключение без записи об ошибке"""
+        writer = FakeWriter()
+        with patch.object(self.server, 'process_client_message', side_effect=ConnectionResetError), \
+                self.assertNoLogs('server', 'ERROR'):
+            asyncio.run(self.server.handle_client(FakeReader(self.frame), writer))
+        self.assertTrue(writer.closed)
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,454 @@
+"""Unit-тесты базы данных сервера"""
+
+import sys
+import os
+import unittest
+from selectors import DefaultSelector, EVENT_READ
+from threading import get_ident
+from tempfile import TemporaryDirectory
+from unittest.mock import patch
+from sqlalchemy.exc import IntegrityError, OperationalError
+from sqlalchemy.orm import clear_mappers
+sys.path.append(os.path.join(os.getcwd(), '..'))
+from common.variables import ACTION, MESSAGE, SENDER, DESTINATION, TIME, MESSAGE_TEXT, DB_DURABILITY_SYNC, \
+    DB_FLUSH_INTERVAL, OFFLINE_PURGE_INTERVAL
+from server_DB import ServerDB, WriteBehindDB, UserIdCache, DBWorkerPool
+
+
+class TestOfflineMessages(unittest.TestCase):
+    '''
+    Тесты очереди сообщений для пользователей не в сети
+    '''
+
+    def setUp(self):
+        self.database = ServerDB('sqlite:///:memory:')
+        self.database.user_login('user1', '127.0.0.1', 7777)
+        self.database.user_login('user2', '127.0.0.1', 7778)
+
+    def tearDown(self):
+        clear_mappers()
+
+    @staticmethod
+    def message(text):
+        return {ACTION: MESSAGE, SENDER: 'user1', DESTINATION: 'user2', TIME: 1.1, MESSAGE_TEXT: text}
+
+    def test_order_and_removal(self):
+        """Сообщения выдаются в порядке поступления и удаляются только после отправки, более новые остаются"""
+        for i in range(3):
+            self.assertTrue(self.database.store_offline_message('user2', self.message(str(i))))
+        last_id, messages = self.database.offline_messages('user2')
+        self.assertEqual(messages, [self.message(str(i)) for i in range(3)])
+        self.assertEqual(self.database.offline_messages('user2')[1], messages)
+        self.database.store_offline_message('user2', self.message('later'))
+        self.database.remove_offline_messages('user2', last_id)
+        self.assertEqual(self.database.offline_messages('user2')[1], [self.message('later')])
+
+    def test_unknown_user(self):
+        """Для неизвестного пользователя сообщение не сохраняется"""
+        self.assertFalse(self.database.store_offline_message('nobody', self.message('text')))
+
+    def test_expired(self):
+        """Сообщения с истёкшим сроком хранения не выдаются и удаляются"""
+        self.database.store_offline_message('user2', self.message('old'), ttl=-1)
+        self.database.store_offline_message('user2', self.message('new'))
+        self.database.purge_offline_messages()
+        self.assertEqual(self.database.offline_messages('user2')[1], [self.message('new')])
+
+    def test_periodic_purge(self):
+        """Цикл сервера удаляет устаревшие сообщения раз в OFFLINE_PURGE_INTERVAL, не дожидаясь перезапуска"""
+        self.database.store_offline_message('user2', self.message('old'), ttl=-1)
+        self.assertGreater(self.database.tick(), 0)
+        self.assertEqual(self.database.session.query(self.database.OfflineMessages).count(), 1)
+        self.database.purged_at -= OFFLINE_PURGE_INTERVAL
+        self.assertEqual(WriteBehindDB(self.database).tick(), OFFLINE_PURGE_INTERVAL)
+        self.assertEqual(self.database.session.query(self.database.OfflineMessages).count(), 0)
+
+
+class TestGroups(unittest.TestCase):
+    '''
+    Тесты групповых чатов
+    '''
+
+    def setUp(self):
+        self.database = ServerDB('sqlite:///:memory:')
+        for name in ('user1', 'user2', 'user3'):
+            self.database.user_login(name, '127.0.0.1', 7777)
+
+    def tearDown(self):
+        clear_mappers()
+
+    def test_join_and_leave(self):
+        """Участники добавляются один раз и удаляются при выходе"""
+        self.database.join_group('user1', 'group')
+        self.database.join_group('user2', 'group')
+        self.database.join_group('user2', 'group')
+        self.assertEqual(sorted(self.database.group_members('group')), ['user1', 'user2'])
+        self.database.leave_group('user1', 'group')
+        self.assertEqual(self.database.group_members('group'), ['user2'])
+
+    def test_unknown_group(self):
+        """У несуществующей группы нет участников"""
+        self.assertEqual(self.database.group_members('nothing'), [])
+
+
+class TestWriteBehind(unittest.TestCase):
+    '''
+    Тесты отложенной записи в базу данных
+    '''
+
+    def setUp(self):
+        self.database = ServerDB('sqlite:///:memory:')
+        self.batched = WriteBehindDB(self.database, batch_size=10, flush_interval=60)
+
+    def tearDown(self):
+        clear_mappers()
+
+    def test_new_user_immediately(self):
+        """Новый пользователь регистрируется сразу, вход записывается с пакетом"""
+        self.batched.user_login('user1', '127.0.0.1', 7777)
+        self.assertEqual(self.database.user_id('user1'), 1)
+        self.assertEqual(self.database.active_users_list(), [])
+        self.batched.flush()
+        self.assertEqual([row[0] for row in self.database.active_users_list()], ['user1'])
+        self.assertEqual(len(self.database.login_history('user1')), 1)
+
+    def test_coalesce(self):
+        """Вход и выход в одном пакете не оставляют активного пользователя, счётчики складываются"""
+        self.batched.user_login('user1', '127.0.0.1', 7777)
+        self.batched.user_login('user2', '127.0.0.1', 7778)
+        for _ in range(3):
+            self.batched.process_message('user1', 'user2')
+        self.batched.user_logout('user1')
+        self.assertEqual([row[0] for row in self.batched.active_users_list()], ['user2'])
+        self.assertEqual([row[2:] for row in self.database.message_history()], [(3, 0), (0, 3)])
+
+    def test_counters_direct(self):
+        """Без отложенной записи сообщение самому себе учитывается в обоих счётчиках, неизвестные имена пропускаются"""
+        self.database.user_login('user1', '127.0.0.1', 7777)
+        self.database.process_message('user1', 'user1')
+        self.database.process_message('user1', 'nobody')
+        self.database.process_message('nobody', 'user1')
+        self.assertEqual([row[2:] for row in self.database.message_history()], [(2, 2)])
+        self.assertEqual(self.database.session.query(self.database.UsersHistory).count(), 1)
+
+    def test_size_trigger(self):
+        """Пакет записывается, когда набирается batch_size изменений"""
+        self.batched.user_login('user1', '127.0.0.1', 7777)
+        for _ in range(9):
+            self.batched.process_message('user1', 'user1')
+        self.assertEqual(self.batched.pending, 0)
+        self.assertEqual(self.database.message_history()[0][2:], (9, 9))
+
+    def test_time_trigger(self):
+        """tick возвращает время до записи и записывает пакет, когда интервал истёк"""
+        self.batched.user_login('user1', '127.0.0.1', 7777)
+        self.assertGreater(self.batched.tick(), 0)
+        self.batched.flush_interval = 0
+        self.batched.tick()
+        self.assertEqual(self.batched.pending, 0)
+        # Записывать больше нечего, остаётся ждать только периодического обслуживания базы.
+        self.assertGreater(self.batched.tick(), DB_FLUSH_INTERVAL)
+
+    def test_sync(self):
+        """В режиме sync изменения фиксируются сразу"""
+        batched = WriteBehindDB(self.database, DB_DURABILITY_SYNC)
+        batched.user_login('user1', '127.0.0.1', 7777)
+        self.assertEqual(batched.pending, 0)
+        self.assertEqual(len(self.database.active_users_list()), 1)
+
+    def test_flush_locked(self):
+        """При временной ошибке базы пакет откатывается и возвращается в накопленное, следующая запись проходит"""
+        self.batched.user_login('user1', '127.0.0.1', 7777)
+        self.batched.process_message('user1', 'user1')
+        error = OperationalError('UPDATE', {}, Exception('database is locked'))
+        with patch.object(self.database, 'update_counters', side_effect=error), self.assertLogs('server', 'ERROR'):
+            self.batched.flush()
+        self.batched.process_message('user1', 'user1')
+        self.assertEqual(self.batched.pending, 3)
+        self.assertEqual(self.batched.counters, {1: [2, 2]})
+        self.assertEqual(self.database.active_users_list(), [])
+        self.batched.flush()
+        self.assertEqual(self.database.message_history()[0][2:], (2, 2))
+        self.assertEqual([row[0] for row in self.database.active_users_list()], ['user1'])
+        self.assertEqual(len(self.database.login_history('user1')), 1)
+
+    def test_flush_rejected(self):
+        """Пакет, отвергнутый базой, отбрасывается, а сессия остаётся рабочей"""
+        self.batched.user_login('user1', '127.0.0.1', 7777)
+        error = IntegrityError('INSERT', {}, Exception('UNIQUE constraint failed'))
+        with patch.object(self.database, 'update_counters', side_effect=error), self.assertLogs('server', 'ERROR'):
+            self.batched.process_message('user1', 'user1')
+            self.batched.flush()
+        self.assertEqual(self.batched.pending, 0)
+        self.batched.user_login('user2', '127.0.0.1', 7778)
+        self.batched.flush()
+        self.assertEqual([row[0] for row in self.database.active_users_list()], ['user2'])
+
+    def test_purge_error(self):
+        """Ошибка удаления устаревших сообщений не прерывает цикл сервера"""
+        self.database.purged_at -= OFFLINE_PURGE_INTERVAL
+        error = OperationalError('DELETE', {}, Exception('database is locked'))
+        with patch.object(self.database, 'purge_offline_messages', side_effect=error), \
+                self.assertLogs('server', 'ERROR'):
+            self.assertEqual(self.batched.tick(), OFFLINE_PURGE_INTERVAL)
+        self.assertGreater(self.database.tick(), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
+
+
+class TestUserIdCache(unittest.TestCase):
+    '''
+    Тесты кеша имён и id пользователей
+    '''
+
+    def test_lru(self):
+        """При переполнении вытесняется давно не использованная запись"""
+        cache = UserIdCache(2)
+        cache.put('user1', 1)
+        cache.put('user2', 2)
+        cache.get('user1')
+        cache.put('user3', 3)
+        self.assertEqual(cache.get('user1'), 1)
+        self.assertIsNone(cache.get('user2'))
+        self.assertIsNone(cache.get_name(2))
+        self.assertEqual(cache.get_name(3), 'user3')
+        self.assertEqual(cache.stats()['hits'], 3)
+        self.assertEqual(cache.stats()['misses'], 2)
+
+    def test_invalidate(self):
+        """Удалённая запись пропадает в обе стороны"""
+        cache = UserIdCache()
+        cache.put('user1', 1)
+        cache.invalidate('user1')
+        self.assertEqual(len(cache), 0)
+        self.assertIsNone(cache.get_name(1))
+
+
+class TestUserLookups(unittest.TestCase):
+    '''
+    Тесты поиска пользователей через кеш базы данных
+    '''
+
+    def setUp(self):
+        self.database = ServerDB('sqlite:///:memory:')
+        self.database.user_login('user1', '127.0.0.1', 7777)
+        self.database.user_login('user2', '127.0.0.1', 7778)
+
+    def tearDown(self):
+        clear_mappers()
+
+    def test_login_fills_cache(self):
+        """После входа id пользователей берутся из кеша без обращения к базе"""
+        misses = self.database.user_ids.misses
+        self.assertEqual(self.database.user_id('user1'), 1)
+        self.assertEqual(self.database.user_name(2), 'user2')
+        self.assertEqual(self.database.user_ids.misses, misses)
+
+    def test_unknown_not_cached(self):
+        """Отсутствие пользователя не кешируется"""
+        self.assertIsNone(self.database.user_id('user3'))
+        self.database.user_login('user3', '127.0.0.1', 7779)
+        self.assertEqual(self.database.user_id('user3'), 3)
+
+    def test_contacts(self):
+        """Контакт добавляется один раз и удаляется"""
+        self.database.add_contact('user1', 'user2')
+        self.database.add_contact('user1', 'user2')
+        self.assertEqual(self.database.get_contacts('user1'), ['user2'])
+        self.database.remove_contact('user1', 'user2')
+        self.assertEqual(self.database.get_contacts('user1'), [])
+
+
+class TestArchive(unittest.TestCase):
+    '''
+    Тесты архива личных сообщений и его страниц
+    '''
+
+    def setUp(self):
+        self.database = ServerDB('sqlite:///:memory:')
+        for name in ('user1', 'user2', 'user3'):
+            self.database.user_login(name, '127.0.0.1', 7777)
+
+    def tearDown(self):
+        clear_mappers()
+
+    def texts(self, page):
+        return [row[2] for row in page[0]]
+
+    def test_dialog(self):
+        """Переписка включает сообщения обеих сторон и не включает чужие диалоги"""
+        self.database.process_message('user1', 'user2', 'first')
+        self.database.process_message('user2', 'user1', 'second')
+        self.database.process_message('user1', 'user3', 'other')
+        self.database.process_message('user1', 'user2')
+        messages, cursor = self.database.get_history('user2', 'user1')
+        self.assertEqual([row[:3] for row in messages], [('user1', 'user2', 'first'), ('user2', 'user1', 'second')])
+        self.assertIsNone(cursor)
+        self.assertEqual(self.database.get_history('user1', 'nobody'), ([], None))
+
+    def test_pages(self):
+        """Страницы по курсору идут от последних сообщений к первым без пропусков и повторов,
+        сообщения с одинаковым временем упорядочиваются по id"""
+        rows = [self.database.archive_row(1, 2, str(i), 1000.0 + i // 3) for i in range(10)]
+        self.database.session.bulk_insert_mappings(self.database.Archive, rows)
+        self.database.session.commit()
+        page = self.database.get_history('user1', 'user2', limit=4)
+        self.assertEqual(self.texts(page), ['6', '7', '8', '9'])
+        self.assertEqual(page[1], [1002.0, 7])
+        page = self.database.get_history('user1', 'user2', page[1], limit=4)
+        self.assertEqual(self.texts(page), ['2', '3', '4', '5'])
+        page = self.database.get_history('user1', 'user2', page[1], limit=4)
+        self.assertEqual((self.texts(page), page[1]), (['0', '1'], None))
+
+    def test_write_behind(self):
+        """Архив записывается с пакетом, чтение архива сначала записывает пакет"""
+        batched = WriteBehindDB(self.database, batch_size=10, flush_interval=60)
+        batched.process_message('user1', 'user2', 'text')
+        self.assertEqual(self.database.get_history('user1', 'user2'), ([], None))
+        self.assertEqual(self.texts(batched.get_history('user1', 'user2')), ['text'])
+
+    def test_index_used(self):
+        """Страница переписки выбирается по индексу диалога"""
+        with self.database.database_engine.connect() as connection:
+            plan = ' '.join(row[-1] for row in connection.exec_driver_sql(
+                'EXPLAIN QUERY PLAN SELECT id FROM Archive WHERE first = 1 AND second = 2 AND (time, id) < (5.0, 9) '
+                'ORDER BY time DESC, id DESC LIMIT 20'))
+        self.assertIn('Archive_dialog_time_id', plan)
+        self.assertNotIn('TEMP B-TREE', plan)
+
+
+class TestSchema(unittest.TestCase):
+    '''
+    Тесты миграций схемы и настроек SQLite
+    '''
+
+    def setUp(self):
+        self.directory = TemporaryDirectory()
+        self.path = f'sqlite:///{self.directory.name}/server.db3'
+
+    def tearDown(self):
+        clear_mappers()
+        self.directory.cleanup()
+
+    def reopen(self, **kwargs):
+        self.database.session.close()
+        self.database.database_engine.dispose()
+        clear_mappers()
+        self.database = ServerDB(self.path, **kwargs)
+
+    def indexes(self):
+        with self.database.database_engine.connect() as connection:
+            return {row[0] for row in connection.exec_driver_sql(
+                "SELECT name FROM sqlite_master WHERE type = 'index' AND name NOT LIKE 'sqlite_%'")}
+
+    def pragma(self, name):
+        with self.database.database_engine.connect() as connection:
+            return connection.exec_driver_sql(f'PRAGMA {name}').scalar()
+
+    def test_migrate_old_database(self):
+        """База без индексов получает их при открытии, номер версии схемы сохраняется"""
+        self.database = ServerDB(self.path)
+        with self.database.database_engine.begin() as connection:
+            for index in ('Contacts_user_contact', 'Login_history_name_date_time', 'History_user'):
+                connection.exec_driver_sql(f'DROP INDEX {index}')
+            connection.exec_driver_sql('PRAGMA user_version = 0')
+        self.reopen()
+        self.assertTrue({'Contacts_user_contact', 'Login_history_name_date_time', 'History_user'} <= self.indexes())
+        self.assertEqual(self.pragma('user_version'), len(ServerDB.MIGRATIONS))
+
+    def test_changes_backfilled(self):
+        """Пользователи и контакты из базы без журнала изменений попадают в журнал при миграции"""
+        self.database = ServerDB(self.path)
+        for name in ('user1', 'user2'):
+            self.database.user_login(name, '127.0.0.1', 7777)
+        self.database.add_contact('user1', 'user2')
+        with self.database.database_engine.begin() as connection:
+            connection.exec_driver_sql('DELETE FROM Changes')
+            connection.exec_driver_sql('PRAGMA user_version = 1')
+        self.reopen()
+        self.assertEqual(sorted(self.database.users_changes(0)[1]), ['user1', 'user2'])
+        self.assertEqual(self.database.contacts_changes('user1', 0, 3), (['user2'], []))
+        self.reopen()
+        self.assertEqual(self.database.sync_version(), 3)
+
+    def test_epoch(self):
+        """Эпоха базы сохраняется при повторном открытии, у новой базы она своя"""
+        self.database = ServerDB(self.path)
+        epoch = self.database.epoch
+        self.assertIsInstance(epoch, int)
+        self.reopen()
+        self.assertEqual(self.database.epoch, epoch)
+        self.database.session.close()
+        self.database.database_engine.dispose()
+        os.remove(f'{self.directory.name}/server.db3')
+        self.reopen()
+        self.assertNotEqual(self.database.epoch, epoch)
+
+    def test_profile(self):
+        """Настройки применяются к каждому подключению, пустой профиль их не меняет"""
+        self.database = ServerDB(self.path)
+        self.assertEqual(self.pragma('journal_mode'), 'wal')
+        self.assertEqual(self.pragma('busy_timeout'), 5000)
+        self.reopen(profile={'busy_timeout': 100})
+        self.assertEqual(self.pragma('busy_timeout'), 100)
+
+
+class TestDBWorkerPool(unittest.TestCase):
+    '''
+    Тесты пула потоков для запросов к базе данных
+    '''
+
+    def setUp(self):
+        self.directory = TemporaryDirectory()
+        self.database = ServerDB(f'sqlite:///{self.directory.name}/server.db3')
+        self.database.user_login('user1', '127.0.0.1', 7777)
+        self.pool = DBWorkerPool(self.database, 2)
+        self.selector = DefaultSelector()
+        self.selector.register(self.pool, EVENT_READ)
+        self.results = []
+
+    def tearDown(self):
+        self.selector.close()
+        self.pool.close()
+        self.database.close()
+        clear_mappers()
+        self.directory.cleanup()
+
+    def wait(self, count):
+        while len(self.results) < count:
+            self.assertTrue(self.selector.select(5), 'пул не разбудил селектор')
+            self.pool.run_callbacks()
+
+    def test_callback_in_caller_thread(self):
+        """Запрос выполняется в потоке пула, обратный вызов – в потоке цикла"""
+        threads = []
+
+        def users_list():
+            threads.append(get_ident())
+            return self.database.users_list()
+
+        self.pool.submit(lambda future: self.results.append((get_ident(), future.result())), users_list)
+        self.wait(1)
+        thread, users = self.results[0]
+        self.assertEqual(thread, get_ident())
+        self.assertNotEqual(threads[0], get_ident())
+        self.assertEqual([user[0] for user in users], ['user1'])
+
+    def test_thread_writes_visible(self):
+        """Изменения, записанные в потоке пула, видны сессии цикла"""
+        for name in ('user2', 'user3'):
+            self.pool.submit(self.results.append, self.database.user_login, name, '127.0.0.1', 7778)
+        self.wait(2)
+        self.assertEqual(sorted(user[0] for user in self.database.users_list()), ['user1', 'user2', 'user3'])
+
+    def test_error_in_future(self):
+        """Исключение запроса передаётся через Future"""
+        self.pool.submit(self.results.append, self.database.get_contacts, None)
+        self.pool.submit(self.results.append, lambda: 1 / 0)
+        self.wait(2)
+        # Запросы выполняют два потока, порядок завершения не определён.
+        errors = [future.exception() for future in self.results if future.exception()]
+        self.assertEqual(len(errors), 1)
+        self.assertIsInstance(errors[0], ZeroDivisionError)
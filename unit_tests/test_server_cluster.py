@@ -0,0 +1,101 @@
+"""Unit-тесты кластера серверов"""
+
+import sys
+import os
+import unittest
+sys.path.append(os.path.join(os.getcwd(), '..'))
+from common.variables import ACTION, TIME, USER, ACCOUNT_NAME, PRESENCE, MESSAGE, SENDER, DESTINATION, \
+    MESSAGE_TEXT, GROUP, GROUP_MESSAGE, DEFAULT_PORT
+from server_cluster import ShardRing, ShardWorker, ShardRouter
+from unit_tests.test_server import FakeClient, FakeGroupsDB
+
+
+class TestShardRing(unittest.TestCase):
+    '''
+    Тесты кольца согласованного хеширования
+    '''
+
+    names = [f'user_{i}' for i in range(4000)]
+
+    def test_deterministic(self):
+        """Разные экземпляры кольца распределяют имена одинаково"""
+        first, second = ShardRing(4), ShardRing(4)
+        self.assertEqual([first.owner(name) for name in self.names], [second.owner(name) for name in self.names])
+
+    def test_balance(self):
+        """Каждому процессу достаётся заметная доля пользователей"""
+        ring = ShardRing(4)
+        counts = [0] * 4
+        for name in self.names:
+            counts[ring.owner(name)] += 1
+        for count in counts:
+            self.assertGreater(count, len(self.names) / 8)
+
+    def test_add_worker(self):
+        """При добавлении процесса пользователи переходят только к нему"""
+        old, new = ShardRing(4), ShardRing(5)
+        moved = [name for name in self.names if old.owner(name) != new.owner(name)]
+        self.assertLess(len(moved), len(self.names) / 3)
+        self.assertTrue(all(new.owner(name) == 4 for name in moved))
+
+
+class TestShardWorker(unittest.TestCase):
+    '''
+    Тесты маршрутизации сообщений рабочего процесса
+    '''
+
+    def setUp(self):
+        self.ring = ShardRing(2)
+        self.local = next(name for name in FakeGroupsDB().group_members('group') if self.ring.owner(name) == 0)
+        self.remote = next(name for name in FakeGroupsDB().group_members('group') if self.ring.owner(name) == 1)
+        self.worker = ShardWorker('', DEFAULT_PORT, FakeGroupsDB(), 0, self.ring, None, {})
+        self.peer = FakeClient()
+        self.worker.peers[1] = self.peer
+        self.client = FakeClient()
+        self.worker.names[self.local] = self.client
+
+    def test_forward_foreign(self):
+        """Сообщение пользователю другого процесса пересылается владельцу"""
+        message = {ACTION: MESSAGE, SENDER: self.local, DESTINATION: self.remote, TIME: 1.1, MESSAGE_TEXT: 'text'}
+        self.worker.process_message(message)
+        self.assertEqual(self.peer.received, [message])
+
+    def test_deliver_forwarded(self):
+        """Пересланное сообщение доставляется своему пользователю"""
+        message = {ACTION: MESSAGE, SENDER: self.remote, DESTINATION: self.local, TIME: 1.1, MESSAGE_TEXT: 'text'}
+        self.worker.process_peer_message(message)
+        self.worker.deliver_messages()
+        self.assertEqual(self.client.received, [message])
+        self.assertEqual(self.peer.received, [])
+
+    def test_group_forwarded_once(self):
+        """Групповое сообщение пересылается другому процессу один раз и не пересылается обратно"""
+        message = {ACTION: GROUP_MESSAGE, TIME: 1.1, SENDER: self.local, GROUP: 'group', MESSAGE_TEXT: 'text'}
+        self.worker.process_client_message(message, self.client)
+        self.assertEqual(self.peer.received, [message])
+        self.worker.process_peer_message(dict(message, **{SENDER: self.remote}))
+        self.assertEqual(len(self.peer.received), 1)
+        self.assertEqual(self.client.received[0][SENDER], self.remote)
+
+    def test_group_unknown_remote_member(self):
+        """Групповое сообщение пересылается другому процессу, даже если его участники ещё не известны отправителю"""
+        self.worker.groups['new'] = {self.local}
+        message = {ACTION: GROUP_MESSAGE, TIME: 1.1, SENDER: self.local, GROUP: 'new', MESSAGE_TEXT: 'text'}
+        self.worker.process_client_message(message, self.client)
+        self.assertEqual(self.peer.received, [message])
+
+
+class TestShardRouter(unittest.TestCase):
+    '''
+    Тесты разбора сообщения о присутствии распределителем
+    '''
+
+    def test_presence_name(self):
+        """Имя пользователя берётся только из корректного сообщения о присутствии"""
+        self.assertEqual(ShardRouter.presence_name({ACTION: PRESENCE, TIME: 1.1, USER: {ACCOUNT_NAME: 'user'}}), 'user')
+        self.assertIsNone(ShardRouter.presence_name({ACTION: MESSAGE, TIME: 1.1, USER: {ACCOUNT_NAME: 'user'}}))
+        self.assertIsNone(ShardRouter.presence_name({ACTION: PRESENCE, TIME: 1.1, USER: 'user'}))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -7,7 +7,8 @@ from errors import IncorrectDataReceivedError
 
 sys.path.append(os.path.join(os.getcwd(), '..'))
 from common.variables import RESPONSE, ERROR, USER, ACCOUNT_NAME, TIME, ACTION, PRESENCE, ENCODING
-from common.utils import encode_message, decode_message
+from common.utils import encode_message, decode_message, pack_frame, FrameDecoder, FrameEncoder, encode_binary, \
+    decode_binary
 
 
 class Tests(unittest.TestCase):
@@ -68,5 +69,117 @@ class Tests(unittest.TestCase):
         self.assertEqual(decode_message(dats), self.test_dict_for_decode_error)
 
 
+class TestFrameDecoder(unittest.TestCase):
+    '''
+    Тесты инкрементального декодера кадров
+    '''
+
+    first = {RESPONSE: 200}
+    second = {ACTION: PRESENCE, TIME: 1.1, USER: {ACCOUNT_NAME: 'test_test'}}
+
+    def test_several_frames_in_one_chunk(self):
+        """Несколько кадров, принятых одним recv, возвращаются все по порядку"""
+        data = pack_frame(encode_message(self.first)) + pack_frame(encode_message(self.second))
+        self.assertEqual(FrameDecoder().feed(data), [self.first, self.second])
+
+    def test_frame_split_between_chunks(self):
+        """Кадр, разрезанный между несколькими recv, собирается целиком"""
+        data = pack_frame(encode_message(self.second))
+        decoder = FrameDecoder()
+        self.assertEqual(decoder.feed(data[:2]), [])
+        self.assertEqual(decoder.feed(data[2:10]), [])
+        self.assertEqual(decoder.feed(data[10:]), [self.second])
+        self.assertEqual(decoder.buffer, bytearray())
+
+    def test_large_frame(self):
+        """Сообщение больше размера блока recv передаётся без искажений"""
+        message = {RESPONSE: 202, ERROR: 'x' * 200000}
+        data = pack_frame(encode_message(message))
+        decoder = FrameDecoder()
+        result = []
+        for i in range(0, len(data), 1024):
+            result.extend(decoder.feed(data[i:i + 1024]))
+        self.assertEqual(result, [message])
+
+    def test_frame_too_long(self):
+        """Кадр с длиной больше допустимой вызывает исключение"""
+        decoder = FrameDecoder(max_frame_length=10)
+        self.assertRaises(IncorrectDataReceivedError, decoder.feed, pack_frame(encode_message(self.second)))
+
+    def test_bad_frame_skipped(self):
+        """Некорректный кадр удаляется из буфера, принятые до него сообщения остаются в backlog"""
+        data = pack_frame(encode_message(self.first)) + pack_frame(b'{not json') + \
+            pack_frame(encode_message(self.second))
+        decoder = FrameDecoder()
+        self.assertRaises(IncorrectDataReceivedError, decoder.feed, data)
+        self.assertEqual(list(decoder.backlog), [self.first])
+        self.assertEqual(decoder.feed(b''), [self.second])
+        self.assertEqual(decoder.buffer, bytearray())
+
+
+class TestBinaryCodec(unittest.TestCase):
+    '''
+    Тесты двоичного кодека
+    '''
+
+    message = {
+        ACTION: PRESENCE,
+        TIME: 111111.111111,
+        USER: {ACCOUNT_NAME: 'тест'},
+        'unknown_key': [1, -2, None, True, False, 'x' * 300],
+    }
+
+    def test_round_trip(self):
+        """Сообщение восстанавливается без изменений"""
+        self.assertEqual(decode_binary(encode_binary(self.message)), self.message)
+
+    def test_big_int(self):
+        """Целые вне диапазона int64, допустимые в JSON, кодируются без потерь"""
+        message = {TIME: [2 ** 63 - 1, 2 ** 63, -2 ** 63, -2 ** 63 - 1, 10 ** 100, -10 ** 300]}
+        self.assertEqual(decode_binary(encode_binary(message)), message)
+
+    def test_shorter_than_json(self):
+        """Ключи протокола кодируются короче, чем в JSON"""
+        message = {ACTION: PRESENCE, TIME: 1.1, USER: {ACCOUNT_NAME: 'test'}}
+        self.assertLess(len(encode_binary(message)), len(encode_message(message)))
+
+    def test_broken_data(self):
+        """Обрезанные данные вызывают исключение"""
+        self.assertRaises(IncorrectDataReceivedError, decode_binary, encode_binary(self.message)[:-5])
+
+    def test_mixed_frames(self):
+        """Декодер различает кодек каждого кадра, поэтому смена кодека посреди потока безопасна"""
+        data = FrameEncoder().encode(self.message) + FrameEncoder('bin').encode(self.message)
+        self.assertEqual(FrameDecoder().feed(data), [self.message, self.message])
+
+
+class TestCompression(unittest.TestCase):
+    '''
+    Тесты сжатия кадров
+    '''
+
+    short = {RESPONSE: 200}
+    long = {RESPONSE: 202, 'data_list': [f'user_{i}' for i in range(500)]}
+
+    def test_short_not_compressed(self):
+        """Короткие кадры не сжимаются"""
+        encoder = FrameEncoder(compression=True)
+        self.assertEqual(encoder.encode(self.short), pack_frame(encode_message(self.short)))
+        self.assertIsNone(encoder.compressor)
+
+    def test_stream(self):
+        """Сжатые кадры вперемешку с несжатыми читаются по порядку, повтор сжимается лучше первого кадра"""
+        encoder = FrameEncoder(compression=True)
+        frames = [encoder.encode(message) for message in (self.long, self.short, self.long)]
+        self.assertLess(len(frames[0]), len(pack_frame(encode_message(self.long))))
+        self.assertLess(len(frames[2]), len(frames[0]))
+        self.assertEqual(FrameDecoder().feed(b''.join(frames)), [self.long, self.short, self.long])
+
+    def test_decompressed_too_long(self):
+        """Распакованный кадр тоже ограничен максимальной длиной"""
+        frame = FrameEncoder(compression=True).encode({ERROR: 'x' * 100000})
+        self.assertRaises(IncorrectDataReceivedError, FrameDecoder(max_frame_length=10000).feed, frame)
+
+
 if __name__ == '__main__':
     unittest.main()